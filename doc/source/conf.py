@@ -136,6 +136,8 @@ man_pages = [
      [u'OpenStack'], 1),
     ('man/glancecontrol', 'glance-control', u'Glance Daemon Control Helper ',
      [u'OpenStack'], 1),
+    ('man/glanceimporter', 'glance-importer', u'Glance Import Service',
+     [u'OpenStack'], 1),
     ('man/glancemanage', 'glance-manage', u'Glance Management Utility',
      [u'OpenStack'], 1),
     ('man/glanceregistry', 'glance-registry', u'Glance Registry Server',
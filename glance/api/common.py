@@ -57,14 +57,17 @@ def image_send_notification(bytes_written, expected_size, image_meta, request,
     """Send an image.send message to the notifier."""
     try:
         context = request.context
-        payload = {
-            'bytes_sent': bytes_written,
-            'image_id': image_meta['id'],
-            'owner_id': image_meta['owner'],
-            'receiver_tenant_id': context.tenant,
-            'receiver_user_id': context.user,
-            'destination_ip': request.remote_addr,
-        }
+
+        def payload():
+            return {
+                'bytes_sent': bytes_written,
+                'image_id': image_meta['id'],
+                'owner_id': image_meta['owner'],
+                'receiver_tenant_id': context.tenant,
+                'receiver_user_id': context.user,
+                'destination_ip': request.remote_addr,
+            }
+
         if bytes_written != expected_size:
             notify = notifier.error
         else:
@@ -209,6 +209,6 @@ class CacheFilter(wsgi.Middleware):
     def get_from_cache(self, image_id):
         """Called if cache hit"""
         with self.cache.open_for_read(image_id) as cache_file:
-            chunks = utils.chunkiter(cache_file)
+            chunks = utils.sparse_chunkiter(cache_file)
             for chunk in chunks:
                 yield chunk
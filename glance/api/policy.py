@@ -19,6 +19,8 @@
 
 import json
 import os.path
+import time
+import weakref
 
 from glance.common import exception
 from glance.common import utils
@@ -32,6 +34,8 @@ LOG = logging.getLogger(__name__)
 policy_opts = [
     cfg.StrOpt('policy_file', default='policy.json'),
     cfg.StrOpt('policy_default_rule', default='default'),
+    cfg.IntOpt('policy_file_check_interval', default=0),
+    cfg.IntOpt('policy_cache_ttl', default=0),
 ]
 
 CONF = cfg.CONF
@@ -44,22 +48,135 @@ DEFAULT_RULES = {
 }
 
 
+_MISSING = object()
+
+# Upper bound on the number of remembered decisions before the cache is
+# simply thrown away and rebuilt
+MAX_CACHED_DECISIONS = 10000
+
+
+def _compile_check(check, compiled_rules, lookup_rule):
+    """Flatten a parsed policy Check tree into a plain callable.
+
+    The resulting function takes (target, creds) and gives the same answer
+    as calling the Check tree would, without the per-node method dispatch.
+    Check types we know nothing about are called as-is.
+    """
+    if isinstance(check, policy.TrueCheck):
+        return lambda target, creds: True
+    elif isinstance(check, policy.FalseCheck):
+        return lambda target, creds: False
+    elif isinstance(check, policy.NotCheck):
+        func = _compile_check(check.rule, compiled_rules, lookup_rule)
+        return lambda target, creds: not func(target, creds)
+    elif isinstance(check, policy.AndCheck):
+        funcs = [_compile_check(c, compiled_rules, lookup_rule)
+                 for c in check.rules]
+        return lambda target, creds: all(f(target, creds) for f in funcs)
+    elif isinstance(check, policy.OrCheck):
+        funcs = [_compile_check(c, compiled_rules, lookup_rule)
+                 for c in check.rules]
+        return lambda target, creds: any(f(target, creds) for f in funcs)
+    elif type(check) is policy.RoleCheck:
+        role = check.match.lower()
+        return lambda target, creds: role in [r.lower()
+                                              for r in creds['roles']]
+    elif type(check) is policy.RuleCheck:
+        name = check.match
+
+        def rule_check(target, creds):
+            # NOTE: rules are resolved when called so that a rule may refer
+            # to one defined later in the file
+            func = lookup_rule(name)
+            if func is None:
+                return False
+            try:
+                return func(target, creds)
+            except KeyError:
+                return False
+        return rule_check
+    elif type(check) is policy.GenericCheck:
+        kind = check.kind
+        match = check.match
+        if '%(' not in match:
+            return lambda target, creds: (kind in creds and
+                                          match == unicode(creds[kind]))
+        return lambda target, creds: (kind in creds and
+                                      match % target == unicode(creds[kind]))
+    else:
+        return check
+
+
+def _is_cacheable(check, rules, seen=None):
+    """Whether a Check's result depends only on the target and creds."""
+    if seen is None:
+        seen = set()
+    if isinstance(check, (policy.TrueCheck, policy.FalseCheck)):
+        return True
+    elif isinstance(check, policy.NotCheck):
+        return _is_cacheable(check.rule, rules, seen)
+    elif isinstance(check, (policy.AndCheck, policy.OrCheck)):
+        return all(_is_cacheable(c, rules, seen) for c in check.rules)
+    elif type(check) is policy.RuleCheck:
+        if check.match in seen:
+            return True
+        seen.add(check.match)
+        try:
+            return _is_cacheable(rules[check.match], rules, seen)
+        except KeyError:
+            return True
+    elif type(check) in (policy.RoleCheck, policy.GenericCheck):
+        return True
+    return False
+
+
 class Enforcer(object):
-    """Responsible for loading and enforcing rules"""
+    """Responsible for loading and enforcing rules
+
+    Rules are compiled into plain callables whenever the policy file
+    changes. Decisions are remembered for the rest of the request they were
+    made in and, if policy_cache_ttl is set, shared across requests for
+    that many seconds. The policy file is checked for changes at most once
+    every policy_file_check_interval seconds.
+    """
 
     def __init__(self):
         self.default_rule = CONF.policy_default_rule
         self.policy_path = self._find_policy_file()
         self.policy_file_mtime = None
         self.policy_file_contents = None
+        self.check_interval = CONF.policy_file_check_interval
+        self.cache_ttl = CONF.policy_cache_ttl
+        self.last_checked = None
+        self.rules = None
+        self.compiled_rules = {}
+        self.cacheable_rules = set()
+        self.decisions = {}
+        self.request_decisions = weakref.WeakKeyDictionary()
 
     def set_rules(self, rules):
         """Create a new Rules object based on the provided dict of rules"""
         rules_obj = policy.Rules(rules, self.default_rule)
         policy.set_rules(rules_obj)
 
+        self.compiled_rules = {}
+        for name, check in rules_obj.items():
+            self.compiled_rules[name] = _compile_check(
+                    check, self.compiled_rules, self._lookup_rule)
+        self.cacheable_rules = set(name for name, check in rules_obj.items()
+                                   if _is_cacheable(check, rules_obj))
+        self.decisions.clear()
+        self.request_decisions.clear()
+        self.rules = rules
+
     def load_rules(self):
         """Set the rules found in the json file on disk"""
+        now = time.time()
+        if (self.rules is not None and self.last_checked is not None and
+                now - self.last_checked < self.check_interval):
+            return
+        self.last_checked = now
+
         if self.policy_path:
             rules = self._read_policy_file()
             rule_type = ""
@@ -67,12 +184,22 @@ class Enforcer(object):
             rules = DEFAULT_RULES
             rule_type = "default "
 
+        if rules is self.rules:
+            return
+
         text_rules = dict((k, str(v)) for k, v in rules.items())
         LOG.debug(_('Loaded %(rule_type)spolicy rules: %(text_rules)s') %
                   locals())
 
         self.set_rules(rules)
 
+    def _lookup_rule(self, name):
+        """Find a compiled rule, falling back to the default rule"""
+        func = self.compiled_rules.get(name)
+        if func is None:
+            func = self.compiled_rules.get(self.default_rule)
+        return func
+
     @staticmethod
     def _find_policy_file():
         """Locate the policy json data file"""
@@ -100,7 +227,61 @@ class Enforcer(object):
             self.policy_file_mtime = mtime
         return self.policy_file_contents
 
-    def _check(self, context, rule, target, *args, **kwargs):
+    def _decision_key(self, rule, target, credentials):
+        """Build the key a decision is cached under, or None if it can't be
+
+        The key covers everything a cacheable rule can look at: the
+        credentials and the contents of the target.
+        """
+        if not isinstance(rule, basestring):
+            return None
+        if rule not in self.cacheable_rules:
+            if rule in self.compiled_rules or \
+                    self.default_rule not in self.cacheable_rules:
+                return None
+        key = (rule, tuple(sorted(credentials['roles'])),
+               credentials['tenant'], credentials['user'],
+               tuple(sorted(target.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _get_decision(self, context, key):
+        decision = self.request_decisions.get(context, {}).get(key, _MISSING)
+        if decision is not _MISSING or not self.cache_ttl:
+            return decision
+        decision, expires = self.decisions.get(key, (_MISSING, None))
+        if decision is not _MISSING and expires < time.time():
+            del self.decisions[key]
+            return _MISSING
+        return decision
+
+    def _set_decision(self, context, key, decision):
+        self.request_decisions.setdefault(context, {})[key] = decision
+        if self.cache_ttl:
+            if len(self.decisions) >= MAX_CACHED_DECISIONS:
+                self.decisions.clear()
+            self.decisions[key] = (decision, time.time() + self.cache_ttl)
+
+    def _evaluate(self, rule, target, credentials):
+        if not isinstance(rule, basestring):
+            # Allow the rule to be a Check tree
+            if isinstance(rule, policy.BaseCheck):
+                return rule(target, credentials)
+            return False
+
+        func = self._lookup_rule(rule)
+        if func is None:
+            # If the rule doesn't exist, fail closed
+            return False
+        try:
+            return func(target, credentials)
+        except KeyError:
+            return False
+
+    def _check(self, context, rule, target, exc=None, *args, **kwargs):
         """Verifies that the action is valid on the target in this context.
 
            :param context: Glance request context
@@ -117,7 +298,20 @@ class Enforcer(object):
             'tenant': context.tenant,
         }
 
-        return policy.check(rule, target, credentials, *args, **kwargs)
+        key = self._decision_key(rule, target, credentials)
+        if key is None:
+            result = self._evaluate(rule, target, credentials)
+        else:
+            result = self._get_decision(context, key)
+            if result is _MISSING:
+                result = self._evaluate(rule, target, credentials)
+                self._set_decision(context, key, result)
+
+        # If it is False, raise the exception if requested
+        if exc and result is False:
+            raise exc(*args, **kwargs)
+
+        return result
 
     def enforce(self, context, action, target):
         """Verifies that the action is valid on the target in this context.
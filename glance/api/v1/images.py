@@ -50,6 +50,8 @@ from glance.store import (get_from_backend,
                           schedule_delayed_delete_from_backend,
                           get_store_from_location,
                           get_store_from_scheme)
+from glance.store import importer
+from glance.store.location import get_location_from_uri
 
 
 CONF = cfg.CONF
@@ -314,23 +316,30 @@ class Controller(controller.BaseController):
             'image_meta': image_meta,
         }
 
-    def _reserve(self, req, image_meta):
+    def _reserve(self, req, image_meta, uploading=False):
         """
         Adds the image metadata to the registry and assigns
         an image identifier if one is not supplied in the request
-        headers. Sets the image's status to `queued`.
+        headers. Sets the image's status to `queued`, or to `saving` if
+        `uploading`.
 
         :param req: The WSGI/Webob Request object
         :param id: The opaque image identifier
         :param image_meta: The image metadata
+        :param uploading: Whether the request body is about to be uploaded
 
         :raises HTTPConflict if image already exists
         :raises HTTPBadRequest if image metadata is not valid
         """
         location = self._external_source(image_meta, req)
 
-        image_meta['status'] = ('active' if image_meta.get('size') == 0
-                                else 'queued')
+        if image_meta.get('size') == 0:
+            image_meta['status'] = 'active'
+        elif uploading:
+            # Saves _upload moving the image from 'queued' to 'saving'
+            image_meta['status'] = 'saving'
+        else:
+            image_meta['status'] = 'queued'
 
         if location:
             store = get_store_from_location(location)
@@ -382,22 +391,16 @@ class Controller(controller.BaseController):
         :param req: The WSGI/Webob Request object
         :param image_meta: Mapping of metadata about image
 
-        :raises HTTPConflict if image already exists
-        :retval The location where the image was stored
+        :raises HTTPConflict if image already exists or is no longer in the
+                status it had in `image_meta`
+        :retval Tuple of the location where the image was stored, a
+                mapping of its size and checksum and the number of zero
+                bytes the store skipped writing, or (None, None, None) if
+                the image data could not be copied from its external source
         """
 
         copy_from = self._copy_from(req)
-        if copy_from:
-            try:
-                image_data, image_size = self._get_from_store(req.context,
-                                                              copy_from)
-            except Exception as e:
-                self._safe_kill(req, image_meta['id'])
-                msg = _("Copy from external source failed: %s") % e
-                LOG.debug(msg)
-                return
-            image_meta['size'] = image_size or image_meta['size']
-        else:
+        if not copy_from:
             try:
                 req.get_content_type('application/octet-stream')
             except exception.InvalidContentType:
@@ -413,19 +416,44 @@ class Controller(controller.BaseController):
         store = self.get_store_or_400(req, scheme)
 
         image_id = image_meta['id']
-        LOG.debug(_("Setting image %s to status 'saving'"), image_id)
-        registry.update_image_metadata(req.context, image_id,
-                                       {'status': 'saving'})
+        if image_meta['status'] != 'saving':
+            LOG.debug(_("Setting image %s to status 'saving'"), image_id)
+            try:
+                registry.update_image_metadata(
+                    req.context, image_id, {'status': 'saving'},
+                    from_state=image_meta['status'])
+            except exception.Duplicate:
+                msg = _("Cannot upload to an unqueued image")
+                LOG.debug(msg)
+                raise HTTPConflict(explanation=msg, request=req,
+                                   content_type="text/plain")
 
         LOG.debug(_("Uploading image data for image %(image_id)s "
                     "to %(scheme)s store"), locals())
 
         try:
             self.notifier.info("image.prepare", image_meta)
-            location, size, checksum = store.add(
-                image_meta['id'],
-                utils.CooperativeReader(image_data),
-                image_meta['size'])
+            location = None
+            sparse_bytes = 0
+            if copy_from:
+                # The source is only opened if the store cannot copy it
+                location, size, checksum = self._clone_in_store(
+                    store, image_id, copy_from)
+                if location is None:
+                    try:
+                        image_data, image_size = self._get_from_store(
+                            req.context, copy_from)
+                    except Exception as e:
+                        self._safe_kill(req, image_id)
+                        msg = _("Copy from external source failed: %s") % e
+                        LOG.debug(msg)
+                        return None, None, None
+                    image_meta['size'] = image_size or image_meta['size']
+            if location is None:
+                reader = utils.CooperativeReader(image_data)
+                location, size, checksum = store.add(
+                    image_meta['id'], reader, image_meta['size'])
+                sparse_bytes = reader.sparse_bytes
 
             def _kill_mismatched(image_meta, attr, actual):
                 supplied = image_meta.get(attr)
@@ -444,21 +472,19 @@ class Controller(controller.BaseController):
             # Verify any supplied size/checksum value matches size/checksum
             # returned from store when adding image
             _kill_mismatched(image_meta, 'size', size)
-            _kill_mismatched(image_meta, 'checksum', checksum)
-
-            # Update the database with the checksum returned
-            # from the backend store
-            LOG.debug(_("Updating image %(image_id)s data. "
-                      "Checksum set to %(checksum)s, size set "
-                      "to %(size)d"), locals())
-            update_data = {'checksum': checksum,
-                           'size': size}
-            image_meta = registry.update_image_metadata(req.context,
-                                                        image_id,
-                                                        update_data)
-            self.notifier.info('image.upload', image_meta)
+            update_data = {'size': size}
+            if checksum is not None:
+                _kill_mismatched(image_meta, 'checksum', checksum)
+                update_data['checksum'] = checksum
 
-            return location
+            # The checksum and size returned from the backend store are
+            # saved to the database by _activate, along with the location,
+            # which then sends the image.upload notification
+            LOG.debug(_("Uploaded image %(image_id)s data. "
+                      "Checksum is %(checksum)s, size is %(size)d"),
+                      locals())
+
+            return location, update_data, sparse_bytes
 
         except exception.Duplicate, e:
             msg = _("Attempt to upload duplicate image: %s") % e
@@ -509,7 +535,28 @@ class Controller(controller.BaseController):
             self._safe_kill(req, image_id)
             raise HTTPInternalServerError(request=req)
 
-    def _activate(self, req, image_id, location):
+    @staticmethod
+    def _clone_in_store(store, image_id, source):
+        """
+        Attempts to copy the image at `source` within the destination
+        store, without streaming its data through Glance.
+
+        :retval tuple of location, size and checksum, or (None, None, None)
+                if the store cannot copy from the source this way
+        """
+        try:
+            source_location = get_location_from_uri(source)
+        except (exception.UnknownScheme, exception.BadStoreUri):
+            return None, None, None
+        if source_location.store_name not in store.get_schemes():
+            return None, None, None
+        try:
+            return store.clone(image_id, source_location)
+        except NotImplementedError:
+            return None, None, None
+
+    def _activate(self, req, image_id, location, upload_data=None,
+                  sparse_bytes=0):
         """
         Sets the image status to `active` and the image's location
         attribute.
@@ -517,15 +564,25 @@ class Controller(controller.BaseController):
         :param req: The WSGI/Webob Request object
         :param image_id: Opaque image identifier
         :param location: Location of where Glance stored this image
+        :param upload_data: Mapping of the size and checksum of the image
+                            data just stored by _upload. These are set in
+                            the same registry call, which is only made if
+                            the image is still `saving`, and the
+                            image.upload notification is sent.
+        :param sparse_bytes: Number of zero bytes the store skipped writing
+                             while storing the uploaded data
         """
-        image_meta = {}
+        image_meta = dict(upload_data or {})
         image_meta['location'] = location
         image_meta['status'] = 'active'
+        from_state = 'saving' if upload_data is not None else None
 
         try:
-            image_meta_data = registry.update_image_metadata(req.context,
-                                                             image_id,
-                                                             image_meta)
+            image_meta_data = registry.update_image_metadata(
+                req.context, image_id, image_meta, from_state=from_state)
+            if upload_data is not None:
+                payload = dict(image_meta_data, sparse_bytes=sparse_bytes)
+                self.notifier.info('image.upload', payload)
             self.notifier.info("image.activate", image_meta_data)
             self.notifier.info("image.update", image_meta_data)
             return image_meta_data
@@ -536,6 +593,16 @@ class Controller(controller.BaseController):
             raise HTTPBadRequest(explanation=msg,
                                  request=req,
                                  content_type="text/plain")
+        except exception.Duplicate, e:
+            # The image was killed while its data was being uploaded,
+            # which leaves nothing referring to the stored data
+            msg = (_("Failed to activate image. Got error: %(e)s")
+                   % locals())
+            LOG.info(msg)
+            self._initiate_deletion(req, location, image_id)
+            raise HTTPConflict(explanation=msg,
+                               request=req,
+                               content_type="text/plain")
 
     def _kill(self, req, image_id):
         """
@@ -580,8 +647,11 @@ class Controller(controller.BaseController):
         # See: https://bitbucket.org/ianb/webob/
         # issue/12/fix-for-issue-6-broke-chunked-transfer
         req.is_body_readable = True
-        location = self._upload(req, image_meta)
-        return self._activate(req, image_id, location) if location else None
+        location, upload_data, sparse_bytes = self._upload(req, image_meta)
+        if not location:
+            return None
+        return self._activate(req, image_id, location, upload_data,
+                              sparse_bytes)
 
     def _get_size(self, context, image_meta, location):
         # retrieve the image size from remote store (if not provided)
@@ -594,6 +664,14 @@ class Controller(controller.BaseController):
                                                              image_id,
                                                              image_meta)
             image_meta = self._upload_and_activate(req, image_meta)
+        elif self._copy_from(req) and CONF.delayed_import:
+            scheme = req.headers.get('x-image-meta-store', CONF.default_store)
+            self.get_store_or_400(req, scheme)
+            msg = _('Queueing copy from external source for import')
+            LOG.info(msg)
+            importer.schedule_import(image_id, self._copy_from(req), scheme,
+                                     size=image_meta.get('size'),
+                                     checksum=image_meta.get('checksum'))
         elif self._copy_from(req):
             msg = _('Triggering asynchronous copy from external source')
             LOG.info(msg)
@@ -607,17 +685,44 @@ class Controller(controller.BaseController):
 
     def _validate_image_for_activation(self, req, id, values):
         """Ensures that all required image metadata values are valid."""
-        image = self.get_image_meta_or_404(req, id)
-        if 'disk_format' not in values:
-            values['disk_format'] = image['disk_format']
-        if 'container_format' not in values:
-            values['container_format'] = image['container_format']
-        if 'name' not in values:
-            values['name'] = image['name']
+        keys = ('disk_format', 'container_format', 'name')
+        # Callers usually pass the image as returned by the registry, so
+        # there is no need to fetch it again
+        if not all(key in values for key in keys):
+            image = self.get_image_meta_or_404(req, id)
+            for key in keys:
+                if key not in values:
+                    values[key] = image[key]
 
         values = validate_image_meta(req, values)
         return values
 
+    def _validate_upload(self, req, image_meta):
+        """
+        Checks a request to create an image with data before the image is
+        reserved, as _reserve then puts it straight into `saving` status.
+
+        :param req: The WSGI/Webob Request object
+        :param image_meta: Mapping of metadata about image
+
+        :raises HTTPBadRequest if the image data would be refused by _upload
+                or the image metadata by _validate_image_for_activation
+        """
+        try:
+            req.get_content_type('application/octet-stream')
+        except exception.InvalidContentType:
+            msg = _("Content-Type must be application/octet-stream")
+            LOG.debug(msg)
+            raise HTTPBadRequest(explanation=msg)
+
+        scheme = req.headers.get('x-image-meta-store', CONF.default_store)
+        self.get_store_or_400(req, scheme)
+
+        values = dict(image_meta)
+        for key in ('disk_format', 'container_format', 'name'):
+            values.setdefault(key, None)
+        validate_image_meta(req, values)
+
     @utils.mutating
     def create(self, req, image_meta, image_data):
         """
@@ -626,15 +731,16 @@ class Controller(controller.BaseController):
 
         1. If the image data is available directly for upload, create can be
            passed the image data as the request body and the metadata as the
-           request headers. The image will initially be 'queued', during
-           upload it will be in the 'saving' status, and then 'killed' or
-           'active' depending on whether the upload completed successfully.
+           request headers. The image will be in the 'saving' status during
+           upload, and then 'killed' or 'active' depending on whether the
+           upload completed successfully.
 
         2. If the image data exists somewhere else, you can upload indirectly
            from the external source using the x-glance-api-copy-from header.
            Once the image is uploaded, the external store is not subsequently
            consulted, i.e. the image content is served out from the configured
-           glance image store.  State transitions are as for option #1.
+           glance image store. The image will initially be 'queued', and
+           then its state transitions are as for option #1.
 
         3. If the image data exists somewhere else, you can reference the
            source using the x-image-meta-location header. The image content
@@ -666,7 +772,11 @@ class Controller(controller.BaseController):
         if is_public:
             self._enforce(req, 'publicize_image')
 
-        image_meta = self._reserve(req, image_meta)
+        uploading = image_data is not None and not self._copy_from(req)
+        if uploading:
+            self._validate_upload(req, image_meta)
+
+        image_meta = self._reserve(req, image_meta, uploading)
         id = image_meta['id']
 
         image_meta = self._handle_source(req, id, image_meta, image_data)
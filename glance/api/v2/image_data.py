@@ -56,8 +56,9 @@ class ImageDataController(object):
         try:
             image = self._get_image(req.context, image_id)
             self.notifier.info("image.prepare", image)
+            reader = utils.CooperativeReader(data)
             location, size, checksum = self.store_api.add_to_backend(
-                    req.context, 'file', image_id, data, size)
+                    req.context, 'file', image_id, reader, size)
 
         except exception.Duplicate, e:
             msg = _("Unable to upload duplicate image data for image: %s")
@@ -98,7 +99,8 @@ class ImageDataController(object):
                       'status': 'active'}
             self.db_api.image_update(req.context, image_id, values)
             updated_image = self._get_image(req.context, image_id)
-            self.notifier.info('image.upload', updated_image)
+            payload = dict(updated_image, sparse_bytes=reader.sparse_bytes)
+            self.notifier.info('image.upload', payload)
             self.notifier.info('image.activate', updated_image)
 
     def download(self, req, image_id):
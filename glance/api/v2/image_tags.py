@@ -48,6 +48,8 @@ class Controller(object):
             raise webob.exc.HTTPNotFound(explanation=unicode(e))
         except exception.Forbidden as e:
             raise webob.exc.HTTPForbidden(explanation=unicode(e))
+        except exception.ImageVersionConflict as e:
+            raise webob.exc.HTTPConflict(explanation=unicode(e))
 
     @utils.mutating
     def delete(self, req, image_id, tag_value):
@@ -62,6 +64,8 @@ class Controller(object):
             raise webob.exc.HTTPNotFound(explanation=unicode(e))
         except exception.Forbidden as e:
             raise webob.exc.HTTPForbidden(explanation=unicode(e))
+        except exception.ImageVersionConflict as e:
+            raise webob.exc.HTTPConflict(explanation=unicode(e))
 
 
 class ResponseSerializer(wsgi.JSONResponseSerializer):
@@ -121,6 +121,8 @@ class ImagesController(object):
             raise webob.exc.HTTPNotFound(explanation=msg)
         except exception.Forbidden as e:
             raise webob.exc.HTTPForbidden(explanation=unicode(e))
+        except exception.ImageVersionConflict as e:
+            raise webob.exc.HTTPConflict(explanation=unicode(e))
 
         return image
 
@@ -163,6 +165,8 @@ class ImagesController(object):
             image_repo.remove(image)
         except exception.Forbidden as e:
             raise webob.exc.HTTPForbidden(explanation=unicode(e))
+        except exception.ImageVersionConflict as e:
+            raise webob.exc.HTTPConflict(explanation=unicode(e))
         except exception.NotFound as e:
             msg = ("Failed to find image %(image_id)s to delete" % locals())
             LOG.info(msg)
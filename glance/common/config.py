@@ -80,8 +80,13 @@ CONF.import_opt('log_date_format', 'glance.openstack.common.log')
 CONF.import_opt('use_syslog', 'glance.openstack.common.log')
 CONF.import_opt('syslog_log_facility', 'glance.openstack.common.log')
 
+# Arguments of the last parse_args() call, for reload_config()
+_last_parse_args = {}
+
 
 def parse_args(args=None, usage=None, default_config_files=None):
+    _last_parse_args.update(args=args, usage=usage,
+                            default_config_files=default_config_files)
     CONF(args=args,
          project='glance',
          version=version.cached_version_string(),
@@ -89,6 +94,14 @@ def parse_args(args=None, usage=None, default_config_files=None):
          default_config_files=default_config_files)
 
 
+def reload_config():
+    """
+    Rereads the command line and configuration files last parsed with
+    parse_args(), so that changed options take effect.
+    """
+    parse_args(**_last_parse_args)
+
+
 def parse_cache_args(args=None):
     config_files = cfg.find_config_files(project='glance', prog='glance-cache')
     parse_args(args=args, default_config_files=config_files)
@@ -123,6 +123,14 @@ class NotAuthorized(Forbidden):
     message = _("You are not authorized to complete this action.")
 
 
+class ImageVersionConflict(GlanceException):
+    message = _("Image %(image_id)s was changed by another request.")
+
+
+class ImageStatusConflict(ImageVersionConflict):
+    message = _("Image %(image_id)s is not in status %(status)s.")
+
+
 class Invalid(GlanceException):
     message = _("Data supplied was not valid.")
 
@@ -27,6 +27,8 @@ try:
 except ImportError:
     from time import sleep
 
+import ctypes
+import ctypes.util
 import functools
 import os
 import platform
@@ -72,6 +74,275 @@ def chunkiter(fp, chunk_size=65536):
             break
 
 
+# lseek() whence values for locating data and holes in sparse files. The
+# os module in Python 2 does not expose them, and the values differ
+# between platforms, so they are only assumed on Linux.
+if sys.platform.startswith('linux'):
+    SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+    SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+else:
+    SEEK_DATA = getattr(os, 'SEEK_DATA', None)
+    SEEK_HOLE = getattr(os, 'SEEK_HOLE', None)
+
+# Zero-filled buffer shared by every reader emitting holes, as large as
+# the largest hole chunk requested so far
+_ZERO_CHUNK = ''
+
+
+def _zeros(length):
+    global _ZERO_CHUNK
+    if length > len(_ZERO_CHUNK):
+        _ZERO_CHUNK = '\0' * length
+    if length == len(_ZERO_CHUNK):
+        return _ZERO_CHUNK
+    # Shorter holes, such as the tail of a file, are rare enough to copy
+    return _ZERO_CHUNK[:length]
+
+
+def _data_extents(fd, size):
+    """
+    Yields (start, end) byte ranges of the file `fd` that hold data.
+    Raises IOError/OSError before yielding anything if the platform or
+    filesystem cannot report holes.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No data beyond offset; the rest of the file is a hole
+                return
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+def sparse_chunkiter(fp, chunk_size=65536):
+    """
+    Return an iterator over the contents of a file object, like
+    chunkiter(), which skips reading the holes of sparse files.
+    Holes are yielded from a shared zero-filled buffer instead.
+
+    Falls back to chunkiter() for objects that are not regular files
+    or on filesystems that do not support SEEK_DATA/SEEK_HOLE.
+
+    :param fp: a file-like object
+    :param chunk_size: maximum size of chunk
+    """
+    if SEEK_DATA is None:
+        return chunkiter(fp, chunk_size)
+    try:
+        fd = fp.fileno()
+        size = os.fstat(fd).st_size
+        start = fp.tell()
+        extents = _data_extents(fd, size)
+        first = next(extents, None)
+    except (AttributeError, IOError, OSError):
+        return chunkiter(fp, chunk_size)
+    return _sparse_chunks(fp, chunk_size, start, size, first, extents)
+
+
+def _sparse_chunks(fp, chunk_size, offset, size, first, extents):
+    def _chunks(start, end, read):
+        while start < end:
+            length = min(chunk_size, end - start)
+            chunk = read(length)
+            if not chunk:
+                return
+            start += len(chunk)
+            yield chunk
+
+    def _read_hole(length):
+        return _zeros(length)
+
+    extent = first
+    while extent is not None:
+        data_start, data_end = extent
+        if data_end > offset:
+            data_start = max(data_start, offset)
+            for chunk in _chunks(offset, data_start, _read_hole):
+                yield chunk
+            fp.seek(data_start)
+            for chunk in _chunks(data_start, data_end, fp.read):
+                yield chunk
+            offset = data_end
+        extent = next(extents, None)
+    for chunk in _chunks(offset, size, _read_hole):
+        yield chunk
+
+
+POSIX_FADV_NORMAL = 0
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+_LIBC = []
+
+
+def _libc_function(*names):
+    """
+    Returns the first of the named C library functions that exists, or
+    None if there is no C library or none of the functions exist.
+    """
+    if not _LIBC:
+        libc = None
+        name = ctypes.util.find_library('c')
+        if name:
+            try:
+                libc = ctypes.CDLL(name, use_errno=True)
+            except OSError:
+                pass
+        _LIBC.append(libc)
+    for name in names:
+        func = getattr(_LIBC[0], name, None)
+        if func is not None:
+            return func
+    return None
+
+
+def fallocate(fd, offset, length):
+    """
+    Allocates disk space for a byte range of an open file, without
+    changing its size or contents.
+
+    :param fd: the file descriptor
+    :param offset: the start of the range
+    :param length: the length of the range
+    :retval True if the space was allocated, False if the filesystem or
+            platform does not support preallocation
+    :raises OSError with errno ENOSPC if there is not enough free space
+    """
+    func = _libc_function('fallocate64', 'fallocate')
+    if func is None or length <= 0:
+        return False
+    # NOTE: mode 1 is FALLOC_FL_KEEP_SIZE. Unlike posix_fallocate(), the
+    # syscall fails rather than writing zeros on unsupported filesystems.
+    func.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.c_int64, ctypes.c_int64]
+    if func(fd, 1, offset, length) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSPC, errno.EFBIG):
+        raise OSError(err, os.strerror(err))
+    return False
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Declares the expected access pattern for a byte range of an open
+    file; a `length` of 0 extends the range to the end of the file.
+    Errors and lack of platform support are ignored.
+
+    :param fd: the file descriptor
+    :param offset: the start of the range
+    :param length: the length of the range
+    :param advice: one of the POSIX_FADV_* constants
+    :retval True if the advice was accepted, False otherwise
+    """
+    func = _libc_function('posix_fadvise64', 'posix_fadvise')
+    if func is None:
+        return False
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                     ctypes.c_int]
+    return func(fd, offset, length, advice) == 0
+
+
+def get_page_cache_residency(path):
+    """
+    Returns the number of bytes of a file currently held in the page
+    cache, or None if this cannot be determined on this platform.
+
+    :param path: path of the file
+    """
+    mmap = _libc_function('mmap64', 'mmap')
+    mincore = _libc_function('mincore')
+    munmap = _libc_function('munmap')
+    if None in (mmap, mincore, munmap):
+        return None
+    mmap.restype = ctypes.c_void_p
+    mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                     ctypes.c_int, ctypes.c_int, ctypes.c_int64]
+    mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0
+        # PROT_READ, MAP_SHARED
+        addr = mmap(None, size, 1, 1, f.fileno(), 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            return None
+        try:
+            pages = (size + page_size - 1) // page_size
+            vec = ctypes.create_string_buffer(pages)
+            if mincore(addr, size, vec) != 0:
+                return None
+            resident = sum(1 for flag in vec.raw if ord(flag) & 1)
+        finally:
+            munmap(addr, size)
+    return min(resident * page_size, size)
+
+
+def get_rss():
+    """
+    Returns the resident set size of the current process in bytes, or
+    None if this cannot be determined on this platform.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def fdatasync(fd):
+    """Flushes the data of an open file to disk."""
+    getattr(os, 'fdatasync', os.fsync)(fd)
+
+
+def is_zero_block(buf):
+    """
+    Returns True if the chunk `buf` is not empty and consists
+    entirely of zero bytes.
+
+    :param buf: a chunk of image data
+    """
+    return bool(buf) and buf.count('\0') == len(buf)
+
+
+def rechunk(iter, chunk_size):
+    """
+    Return an iterator which yields the data of an iterator in chunks
+    of exactly `chunk_size` bytes, except for a shorter final chunk.
+
+    :param iter: an iterator yielding chunks of any size
+    :param chunk_size: size of the chunks to yield
+    """
+    pending = []
+    pending_len = 0
+    for chunk in iter:
+        if not pending and len(chunk) == chunk_size:
+            yield chunk
+            continue
+        pending.append(chunk)
+        pending_len += len(chunk)
+        if pending_len >= chunk_size:
+            data = ''.join(pending)
+            offset = 0
+            while len(data) - offset >= chunk_size:
+                yield data[offset:offset + chunk_size]
+                offset += chunk_size
+            pending = [data[offset:]] if offset < len(data) else []
+            pending_len = len(data) - offset
+    if pending:
+        yield ''.join(pending)
+
+
 def cooperative_iter(iter):
     """
     Return an iterator which schedules after each
@@ -119,6 +390,8 @@ class CooperativeReader(object):
         """
         self.fd = fd
         self.iterator = None
+        # Number of all-zero bytes that the store did not need to write
+        self.sparse_bytes = 0
         # NOTE(markwash): if the underlying supports read(), overwrite the
         # default iterator-based implementation with cooperative_read which
         # is more straightforward
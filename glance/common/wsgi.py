@@ -23,22 +23,30 @@ Utility methods for working with WSGI servers
 
 import datetime
 import errno
+import fcntl
 import json
 import logging
+import multiprocessing
 import os
+import random
+import re
 import signal
 import sys
 import time
 
 import eventlet
 from eventlet.green import socket, ssl
+import eventlet.event
 import eventlet.greenio
+import eventlet.semaphore
 import eventlet.wsgi
+import greenlet
 import routes
 import routes.middleware
 import webob.dec
 import webob.exc
 
+from glance.common import config
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import cfg
@@ -53,18 +61,85 @@ bind_opts = [
 socket_opts = [
     cfg.IntOpt('backlog', default=4096),
     cfg.IntOpt('tcp_keepidle', default=600),
+    cfg.BoolOpt('reuse_port', default=False,
+                help=_("Give each worker process its own listening socket "
+                       "bound with SO_REUSEPORT, so that the kernel "
+                       "spreads new connections evenly across workers. "
+                       "Requires Linux 3.9 or later.")),
     cfg.StrOpt('ca_file'),
     cfg.StrOpt('cert_file'),
     cfg.StrOpt('key_file'),
 ]
 
-workers_opt = cfg.IntOpt('workers', default=1)
+keepalive_opts = [
+    cfg.BoolOpt('http_keepalive', default=True,
+                help=_("Keep client connections open between requests "
+                       "(HTTP/1.1 persistent connections). When disabled, "
+                       "the connection is closed after every response, "
+                       "whatever the client asks for.")),
+    cfg.IntOpt('http_keepalive_timeout', default=60,
+               help=_("Number of seconds an idle persistent connection is "
+                      "kept open waiting for the next request. 0 means no "
+                      "limit.")),
+    cfg.IntOpt('http_keepalive_max_requests', default=100,
+               help=_("Number of requests served over a persistent "
+                      "connection before it is closed. 0 means no "
+                      "limit.")),
+]
+
+admission_opts = [
+    cfg.IntOpt('admission_max_data_requests', default=0,
+               help=_("Maximum number of image uploads and downloads each "
+                      "worker process serves at once. 0 means unlimited.")),
+    cfg.IntOpt('admission_max_metadata_requests', default=0,
+               help=_("Maximum number of other requests each worker "
+                      "process serves at once. 0 means unlimited.")),
+    cfg.FloatOpt('admission_data_queue_timeout', default=10.0,
+                 help=_("Seconds an image upload or download may wait for "
+                        "a free slot before it is rejected with a 503.")),
+    cfg.FloatOpt('admission_metadata_queue_timeout', default=1.0,
+                 help=_("Seconds any other request may wait for a free "
+                        "slot before it is rejected with a 503.")),
+    cfg.IntOpt('admission_retry_after', default=5,
+               help=_("Value, in seconds, of the Retry-After header sent "
+                      "with rejected requests.")),
+]
+
+workers_opt = cfg.StrOpt('workers', default='1',
+                         help=_("Number of worker processes, or 'auto' for "
+                                "one per CPU. 0 serves requests from the "
+                                "parent process."))
+
+recycle_opts = [
+    cfg.IntOpt('worker_max_requests', default=0,
+               help=_("Number of requests after which a worker process is "
+                      "replaced by a new one, plus up to 10% to stagger "
+                      "workers. 0 means never.")),
+    cfg.IntOpt('worker_max_rss', default=0,
+               help=_("Resident memory, in MiB, above which a worker "
+                      "process is replaced by a new one. 0 means no "
+                      "limit.")),
+    cfg.IntOpt('worker_drain_timeout', default=300,
+               help=_("Seconds the server waits, when shut down with "
+                      "SIGQUIT, for workers to complete their running "
+                      "requests before killing them. 0 means no "
+                      "limit.")),
+]
 
 CONF = cfg.CONF
 CONF.register_opts(bind_opts)
 CONF.register_opts(socket_opts)
+CONF.register_opts(keepalive_opts)
+CONF.register_opts(admission_opts)
+CONF.register_opts(recycle_opts)
 CONF.register_opt(workers_opt)
 
+LOG = os_logging.getLogger(__name__)
+
+# Not exposed by the socket module of Python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
 
 class WritableLogger(object):
     """A thin wrapper that responds to `write` and logs."""
@@ -82,13 +157,15 @@ def get_bind_addr(default_port=None):
     return (CONF.bind_host, CONF.bind_port or default_port)
 
 
-def get_socket(default_port):
+def get_socket(default_port, reuse_port=False):
     """
     Bind socket to bind ip:port in conf
 
     note: Mostly comes from Swift with a few small changes...
 
     :param default_port: port to bind to if none is specified in conf
+    :param reuse_port: Set SO_REUSEPORT, allowing several sockets to
+                       listen on the same address
 
     :returns : a socket object as returned from socket.listen or
                ssl.wrap_socket if conf specifies cert_file
@@ -132,9 +209,16 @@ def get_socket(default_port):
     retry_until = time.time() + 30
     while not sock and time.time() < retry_until:
         try:
-            sock = eventlet.listen(bind_addr,
-                                   backlog=CONF.backlog,
-                                   family=address_family)
+            if reuse_port:
+                sock = socket.socket(address_family, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+                sock.bind(bind_addr)
+                sock.listen(CONF.backlog)
+            else:
+                sock = eventlet.listen(bind_addr,
+                                       backlog=CONF.backlog,
+                                       family=address_family)
             if use_ssl:
                 sock = wrap_ssl(sock)
 
@@ -157,20 +241,315 @@ def get_socket(default_port):
     return sock
 
 
+class HttpProtocol(eventlet.wsgi.HttpProtocol):
+    """
+    Closes persistent connections once they have served
+    ``http_keepalive_max_requests`` requests, or have been idle for
+    ``http_keepalive_timeout`` seconds waiting for the next one.
+    """
+
+    requests_handled = 0
+
+    # Set in a worker that is shutting down, to stop serving further
+    # requests over persistent connections
+    draining = False
+
+    # Persistent connections waiting for their next request
+    idle = set()
+
+    def setup(self):
+        eventlet.wsgi.HttpProtocol.setup(self)
+        # Requests are read through a duplicate of the connection's socket
+        self.read_socket = getattr(self.rfile, '_sock', self.connection)
+
+    def handle_one_request(self):
+        if self.requests_handled:
+            if CONF.http_keepalive_timeout:
+                self.read_socket.settimeout(CONF.http_keepalive_timeout)
+            HttpProtocol.idle.add(self)
+        try:
+            eventlet.wsgi.HttpProtocol.handle_one_request(self)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        finally:
+            HttpProtocol.idle.discard(self)
+        if (self.draining or
+                getattr(self, 'environ', {}).get('glance.close_connection')):
+            self.close_connection = 1
+
+    def parse_request(self):
+        # The request line has arrived, so the connection is no longer idle
+        HttpProtocol.idle.discard(self)
+        self.read_socket.settimeout(None)
+        self.requests_handled += 1
+        result = eventlet.wsgi.HttpProtocol.parse_request(self)
+        max_requests = CONF.http_keepalive_max_requests
+        if max_requests and self.requests_handled >= max_requests:
+            self.close_connection = 1
+        return result
+
+    @classmethod
+    def close_idle(cls):
+        """
+        Closes the persistent connections waiting for their next request,
+        so that a draining worker does not wait for them to time out.
+        """
+        for protocol in list(cls.idle):
+            protocol.close_connection = 1
+            try:
+                protocol.connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        cls.idle.clear()
+
+
+class KeepAliveMiddleware(object):
+    """
+    Marks the connection to be closed when a response body ends before
+    the length given in its Content-Length header, for instance because
+    reading the image from its store failed part way. On a persistent
+    connection the client would otherwise wait for the missing bytes,
+    or read them from the next response.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        expected = []
+
+        def _start_response(status, headers, exc_info=None):
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    expected.append(int(value))
+            return start_response(status, headers, exc_info)
+
+        result = self.application(environ, _start_response)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return result
+        return self._check_length(environ, result, expected)
+
+    def _check_length(self, environ, result, expected):
+        sent = 0
+        try:
+            for chunk in result:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if expected and sent < expected[-1]:
+            environ['glance.close_connection'] = True
+
+
+def get_num_workers():
+    """Returns the number of worker processes to start."""
+    if str(CONF.workers).strip().lower() == 'auto':
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+    try:
+        workers = int(CONF.workers)
+    except ValueError:
+        workers = -1
+    if workers < 0:
+        msg = (_("invalid workers value %s, expected 'auto' or a "
+                 "non-negative integer") % CONF.workers)
+        raise exception.WorkerCreationFailure(reason=msg)
+    return workers
+
+
+class AdmissionQueue(object):
+    """
+    Bounds the number of requests of one class served at once, holding
+    further requests for up to `timeout` seconds while a slot frees up.
+    """
+
+    def __init__(self, limit, timeout):
+        self.semaphore = eventlet.semaphore.Semaphore(limit)
+        self.timeout = timeout
+        self.stats = {'active': 0, 'queued': 0, 'admitted': 0,
+                      'rejected': 0}
+
+    def acquire(self):
+        """Returns True once a slot is held, False on timeout."""
+        acquired = False
+        self.stats['queued'] += 1
+        try:
+            with eventlet.Timeout(self.timeout, False):
+                self.semaphore.acquire()
+                acquired = True
+        finally:
+            self.stats['queued'] -= 1
+        if acquired:
+            self.stats['active'] += 1
+            self.stats['admitted'] += 1
+        else:
+            self.stats['rejected'] += 1
+        return acquired
+
+    def release(self):
+        self.stats['active'] -= 1
+        self.semaphore.release()
+
+
+class AdmissionController(object):
+    """
+    Limits the image data transfers and the metadata requests a worker
+    serves concurrently, separately, so a burst of downloads cannot starve
+    API calls and vice versa. Requests wait briefly for a slot and are
+    then shed with a 503 and a Retry-After header rather than all slowing
+    down together.
+
+    Each class keeps ``active``, ``queued``, ``admitted`` and ``rejected``
+    counts in its ``stats``, which are logged whenever a request is shed.
+    """
+
+    # v1 image downloads; uploads are told apart by their content type
+    DATA_PATHS = re.compile(r'^/v1/images/(?!detail$)[^/]+$|'
+                            r'^/v2/images/[^/]+/file$')
+
+    def __init__(self, application):
+        self.application = application
+        self.queues = {}
+        for name, limit, timeout in (
+                ('data', CONF.admission_max_data_requests,
+                 CONF.admission_data_queue_timeout),
+                ('metadata', CONF.admission_max_metadata_requests,
+                 CONF.admission_metadata_queue_timeout)):
+            if limit > 0:
+                self.queues[name] = AdmissionQueue(limit, timeout)
+
+    def classify(self, environ):
+        """Returns 'data' for image uploads and downloads, else
+        'metadata'."""
+        method = environ['REQUEST_METHOD']
+        if method in ('PUT', 'POST'):
+            content_type = environ.get('CONTENT_TYPE', '')
+            if content_type.startswith('application/octet-stream'):
+                return 'data'
+        elif method == 'GET':
+            if self.DATA_PATHS.match(environ.get('PATH_INFO', '')):
+                return 'data'
+        return 'metadata'
+
+    def stats(self):
+        return dict((name, dict(queue.stats))
+                    for name, queue in self.queues.items())
+
+    def __call__(self, environ, start_response):
+        name = self.classify(environ)
+        queue = self.queues.get(name)
+        if queue is None:
+            return self.application(environ, start_response)
+
+        if not queue.acquire():
+            LOG.warn(_("Rejecting %(name)s request %(method)s %(path)s, "
+                       "admission stats: %(stats)s") %
+                     {'name': name, 'method': environ['REQUEST_METHOD'],
+                      'path': environ.get('PATH_INFO'),
+                      'stats': self.stats()})
+            retry_after = str(CONF.admission_retry_after)
+            response = webob.exc.HTTPServiceUnavailable(
+                explanation=_("The server is too busy to handle the "
+                              "request, please retry later."),
+                headers=[('Retry-After', retry_after)])
+            return response(environ, start_response)
+
+        try:
+            result = self.application(environ, start_response)
+        except Exception:
+            queue.release()
+            raise
+        return _ReleasingIterator(result, queue.release)
+
+
+class _ReleasingIterator(object):
+    """Calls `release` once the response body has been sent."""
+
+    def __init__(self, result, release):
+        self.result = result
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            if self.release is not None:
+                self.release()
+                self.release = None
+
+
+class RecycleMiddleware(object):
+    """
+    Counts the requests served by a worker process and calls `recycle`,
+    once, when the worker has served ``worker_max_requests`` requests or
+    its resident memory exceeds ``worker_max_rss``.
+    """
+
+    def __init__(self, application, recycle):
+        self.application = application
+        self.recycle = recycle
+        self.requests = 0
+        self.max_requests = CONF.worker_max_requests
+        if self.max_requests > 0:
+            # Keeps workers started together from recycling together
+            self.max_requests += random.randint(0, self.max_requests // 10)
+        self.max_rss = CONF.worker_max_rss * 1024 * 1024
+        self.recycling = False
+
+    def __call__(self, environ, start_response):
+        self.requests += 1
+        try:
+            return self.application(environ, start_response)
+        finally:
+            if not self.recycling:
+                self._check()
+
+    def _check(self):
+        rss = utils.get_rss()
+        if self.max_requests > 0 and self.requests >= self.max_requests:
+            reason = _('served %d requests') % self.requests
+        elif self.max_rss > 0 and rss is not None and rss > self.max_rss:
+            reason = _('exceeded %d MiB') % CONF.worker_max_rss
+        else:
+            return
+        self.recycling = True
+        self.recycle(reason, rss)
+
+
 class Server(object):
     """Server class to manage multiple WSGI sockets and applications."""
 
     def __init__(self, threads=1000):
         self.threads = threads
         self.children = []
+        self.stale_children = set()
         self.running = True
-
-    def start(self, application, default_port):
+        self.shutting_down = False
+        self.reuse_port = False
+        self.reload_requested = False
+        self.recycle_requested = False
+        self.recycle_pipe = None
+        self.application = None
+        self.app_factory = None
+
+    def start(self, application, default_port, app_factory=None):
         """
         Run a WSGI server with the given application.
 
         :param application: The application to be run in the WSGI server
         :param default_port: Port to bind to if none is specified in conf
+        :param app_factory: Callable building a new application from the
+                            current configuration, called on reload so that
+                            the new workers serve the reloaded pipeline,
+                            stores and policies
         """
         def kill_children(*args):
             """Kills the entire process group."""
@@ -182,30 +561,170 @@ class Server(object):
 
         def hup(*args):
             """
-            Shuts down the server, but allows running requests to complete
+            Replaces the workers with new ones started from the reloaded
+            configuration, letting the old ones finish running requests
             """
             self.logger.info(_('SIGHUP received'))
-            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            self.reload_requested = True
+
+        def usr1(*args):
+            """A worker is asking to be replaced"""
+            self.recycle_requested = True
+
+        def graceful_shutdown(*args):
+            """
+            Shuts down the server, but allows running requests to complete
+            """
+            self.logger.info(_('SIGQUIT received'))
+            signal.signal(signal.SIGQUIT, signal.SIG_IGN)
             self.running = False
+            self.shutting_down = True
+            self.drain_children(self.children + list(self.stale_children))
 
         self.application = application
-        self.sock = get_socket(default_port)
+        self.app_factory = app_factory
+        self.default_port = default_port
+        workers = get_num_workers()
+        self.reuse_port = CONF.reuse_port and workers > 0
+        if self.reuse_port and SO_REUSEPORT is None:
+            raise RuntimeError(_("SO_REUSEPORT is not supported on this "
+                                 "platform"))
+        # With reuse_port, each worker gets its own socket in run_child
+        self.sock = None if self.reuse_port else get_socket(default_port)
 
         os.umask(027)  # ensure files are created with the correct privileges
         self.logger = os_logging.getLogger('eventlet.wsgi.server')
 
-        if CONF.workers == 0:
+        if workers == 0:
             # Useful for profiling, test, debug etc.
             self.pool = self.create_pool()
             self.pool.spawn_n(self._single_run, self.application, self.sock)
             return
         else:
-            self.logger.info(_("Starting %d workers") % CONF.workers)
+            self.logger.info(_("Starting %d workers") % workers)
             signal.signal(signal.SIGTERM, kill_children)
             signal.signal(signal.SIGINT, kill_children)
             signal.signal(signal.SIGHUP, hup)
-            while len(self.children) < CONF.workers:
+            signal.signal(signal.SIGQUIT, graceful_shutdown)
+            signal.signal(signal.SIGUSR1, usr1)
+            # Workers due for recycling write their pid here
+            self.recycle_pipe = os.pipe()
+            fcntl.fcntl(self.recycle_pipe[0], fcntl.F_SETFL, os.O_NONBLOCK)
+            while len(self.children) < workers:
+                self.run_child()
+
+    def reload(self):
+        """
+        Rereads the configuration files and starts a new set of workers,
+        then tells the previous workers to stop accepting connections and
+        exit once their running requests are complete.
+        """
+        try:
+            config.reload_config()
+            workers = get_num_workers()
+            if workers < 1:
+                raise exception.WorkerCreationFailure(
+                    reason=_('workers cannot be changed to 0 on reload'))
+            application = self.application
+            if self.app_factory is not None:
+                application = self.app_factory()
+        except Exception, e:
+            self.logger.error(_('Not reloading, unable to load the '
+                                'configuration: %s') % e)
+            return
+
+        old_application = self.application
+        old_children = self.children
+        self.application = application
+        self.children = []
+        self.logger.info(_('Reloading: starting %(workers)d workers, then '
+                           'draining %(old)d') %
+                         {'workers': workers, 'old': len(old_children)})
+        try:
+            while len(self.children) < workers:
                 self.run_child()
+        except Exception, e:
+            self.logger.error(_('Not reloading, unable to start new '
+                                'workers: %s') % e)
+            new_children = self.children
+            self.application = old_application
+            self.children = old_children
+            self.stale_children.update(new_children)
+            self.drain_children(new_children)
+            return
+        self.stale_children.update(old_children)
+        self.drain_children(old_children)
+
+    def recycle_children(self):
+        """
+        Replaces the workers that have asked to be recycled, starting the
+        new worker before draining the old one.
+        """
+        data = ''
+        while True:
+            try:
+                chunk = os.read(self.recycle_pipe[0], 4096)
+            except OSError, err:
+                if err.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+                break
+            if not chunk:
+                break
+            data += chunk
+        for pid in [int(pid) for pid in data.split()]:
+            if pid not in self.children:
+                continue
+            self.children.remove(pid)
+            self.stale_children.add(pid)
+            self.run_child()
+            self.drain_children([pid])
+
+    def drain_children(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except OSError, err:
+                if err.errno != errno.ESRCH:
+                    raise
+
+    def reap_drained_children(self, pids):
+        """
+        Waits for draining workers to exit, killing those still running
+        after ``worker_drain_timeout`` seconds.
+        """
+        pending = set(pids)
+        timeout = CONF.worker_drain_timeout
+        deadline = time.time() + timeout
+        while pending:
+            for pid in list(pending):
+                try:
+                    exited, _status = os.waitpid(pid, os.WNOHANG)
+                except OSError, err:
+                    if err.errno == errno.EINTR:
+                        continue
+                    if err.errno != errno.ECHILD:
+                        raise
+                    exited = pid
+                if exited:
+                    self.logger.info(_('Drained child %s exited') % pid)
+                    pending.discard(pid)
+            if not pending:
+                break
+            if timeout and time.time() >= deadline:
+                for pid in pending:
+                    self.logger.warn(_('Killing child %s, still running '
+                                       'requests after %d seconds') %
+                                     (pid, timeout))
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                        os.waitpid(pid, 0)
+                    except OSError, err:
+                        if err.errno not in (errno.ESRCH, errno.ECHILD):
+                            raise
+                break
+            time.sleep(0.1)
+        self.children = []
+        self.stale_children = set()
 
     def create_pool(self):
         eventlet.patcher.monkey_patch(all=False, socket=True)
@@ -213,9 +732,21 @@ class Server(object):
 
     def wait_on_children(self):
         while self.running:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+                continue
+            if self.recycle_requested:
+                self.recycle_requested = False
+                self.recycle_children()
+                continue
             try:
                 pid, status = os.wait()
-                if os.WIFEXITED(status) or os.WIFSIGNALED(status):
+                if pid in self.stale_children:
+                    if os.WIFEXITED(status) or os.WIFSIGNALED(status):
+                        self.logger.info(_('Drained child %s exited') % pid)
+                        self.stale_children.discard(pid)
+                elif os.WIFEXITED(status) or os.WIFSIGNALED(status):
                     self.logger.info(_('Removing dead child %s') % pid)
                     self.children.remove(pid)
                     if os.WIFEXITED(status) and os.WEXITSTATUS(status) != 0:
@@ -233,8 +764,12 @@ class Server(object):
             except KeyboardInterrupt:
                 self.logger.info(_('Caught keyboard interrupt. Exiting.'))
                 break
-        eventlet.greenio.shutdown_safe(self.sock)
-        self.sock.close()
+        if self.shutting_down:
+            self.reap_drained_children(self.children +
+                                       list(self.stale_children))
+        if self.sock is not None:
+            eventlet.greenio.shutdown_safe(self.sock)
+            self.sock.close()
         self.logger.debug(_('Exited'))
 
     def wait(self):
@@ -248,14 +783,26 @@ class Server(object):
             pass
 
     def run_child(self):
+        sock = self.sock
+        if self.reuse_port:
+            # Bound and listening before the fork, so that connections
+            # queue for the new worker even before it starts accepting
+            sock = get_socket(self.default_port, reuse_port=True)
         pid = os.fork()
         if pid == 0:
-            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
             signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # The parent drains workers with SIGHUP on SIGQUIT; a SIGQUIT
+            # sent to the whole process group must not abort them
+            signal.signal(signal.SIGQUIT, signal.SIG_IGN)
             # ignore the interrupt signal to avoid a race whereby
             # a child worker receives the signal before the parent
             # and is respawned unneccessarily as a result
             signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            if self.recycle_pipe is not None:
+                os.close(self.recycle_pipe[0])
+            self.sock = sock
             self.run_server()
             self.logger.info(_('Child %d exiting normally') % os.getpid())
             # self.pool.waitall() has been called by run_server, so
@@ -264,6 +811,8 @@ class Server(object):
         else:
             self.logger.info(_('Started child %s') % pid)
             self.children.append(pid)
+            if self.reuse_port:
+                sock.close()
 
     def run_server(self):
         """Run a WSGI server."""
@@ -278,21 +827,95 @@ class Server(object):
             msg = _("eventlet 'poll' hub is not available on this platform")
             raise exception.WorkerCreationFailure(reason=msg)
         self.pool = self.create_pool()
+        application = self.application
+        if CONF.worker_max_requests > 0 or CONF.worker_max_rss > 0:
+            application = RecycleMiddleware(application, self._recycle)
+        self.wsgi_server = eventlet.event.Event()
+        self.server_thread = eventlet.spawn(self._serve, application,
+                                            self.sock)
+        signal.signal(signal.SIGHUP, self._drain)
         try:
-            eventlet.wsgi.server(self.sock,
-                                 self.application,
-                                 log=WritableLogger(self.logger),
-                                 custom_pool=self.pool)
-        except socket.error, err:
-            if err[0] != errno.EINVAL:
-                raise
+            self.server_thread.wait()
+        except greenlet.GreenletExit:
+            pass
         self.pool.waitall()
 
+    def _recycle(self, reason, rss):
+        """Asks the parent to replace this worker."""
+        if rss is not None:
+            memory = _('%d MiB') % (rss // (1024 * 1024))
+        else:
+            memory = _('unknown')
+        self.logger.info(_('Child %(pid)d %(reason)s, recycling. Resident '
+                           'memory: %(memory)s') %
+                         {'pid': os.getpid(), 'reason': reason,
+                          'memory': memory})
+        os.write(self.recycle_pipe[1], '%d\n' % os.getpid())
+        os.kill(os.getppid(), signal.SIGUSR1)
+
+    def _drain(self, *args):
+        """
+        Stops accepting connections, leaving the running requests to
+        complete, when the parent is reloading or shutting down.
+        """
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        eventlet.spawn_n(self._stop_accepting)
+
+    def _stop_accepting(self):
+        self.logger.info(_('Child %d draining') % os.getpid())
+        HttpProtocol.draining = True
+        self.server_thread.kill()
+        HttpProtocol.close_idle()
+        if self.reuse_port:
+            self._serve_accept_queue()
+        # Closes this worker's reference only, other workers sharing the
+        # socket keep accepting on it
+        self.sock.close()
+
+    def _serve_accept_queue(self):
+        """
+        Serves the connections already queued on this worker's own
+        SO_REUSEPORT socket, which closing the socket would reset. The
+        kernel stops queueing connections for the worker once it is
+        closed.
+        """
+        if not self.wsgi_server.ready():
+            return
+        serv = self.wsgi_server.wait()
+        self.sock.setblocking(0)
+        while True:
+            try:
+                client_socket = self.sock.accept()
+            except socket.error, err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.logger.error(_('Unable to accept queued '
+                                        'connection: %s') % err)
+                break
+            client_socket[0].settimeout(getattr(serv, 'socket_timeout',
+                                                None))
+            self.pool.spawn_n(serv.process_request, client_socket)
+
     def _single_run(self, application, sock):
         """Start a WSGI server in a new green thread."""
         self.logger.info(_("Starting single process server"))
-        eventlet.wsgi.server(sock, application, custom_pool=self.pool,
-                             log=WritableLogger(self.logger))
+        self._serve(application, sock)
+
+    def _serve(self, application, sock):
+        if (CONF.admission_max_data_requests > 0 or
+                CONF.admission_max_metadata_requests > 0):
+            application = AdmissionController(application)
+        if CONF.http_keepalive:
+            application = KeepAliveMiddleware(application)
+        try:
+            eventlet.wsgi.server(sock, application, custom_pool=self.pool,
+                                 log=WritableLogger(self.logger),
+                                 protocol=HttpProtocol,
+                                 keepalive=CONF.http_keepalive,
+                                 server_event=getattr(self, 'wsgi_server',
+                                                      None))
+        except socket.error, err:
+            if err[0] != errno.EINVAL:
+                raise
 
 
 class Middleware(object):
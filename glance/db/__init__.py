@@ -57,7 +57,7 @@ IMAGE_ATTRS = BASE_MODEL_ATTRS | set(['name', 'status', 'size',
                                       'disk_format', 'container_format',
                                       'min_disk', 'min_ram', 'is_public',
                                       'location', 'checksum', 'owner',
-                                      'protected'])
+                                      'protected', 'version'])
 
 
 class ImageRepo(object):
@@ -65,6 +65,9 @@ class ImageRepo(object):
     def __init__(self, context, db_api):
         self.context = context
         self.db_api = db_api
+        # Version of each image loaded through this repo, so that saving
+        # it fails if another request has changed it in the meantime
+        self._versions = {}
 
     def get(self, image_id):
         try:
@@ -72,6 +75,7 @@ class ImageRepo(object):
             assert not db_api_image['deleted']
         except (exception.NotFound, exception.Forbidden, AssertionError):
             raise exception.NotFound(image_id=image_id)
+        self._versions[image_id] = db_api_image['version']
         tags = self.db_api.image_tag_get_all(self.context, image_id)
         image = self._format_image_from_db(db_api_image, tags)
         return ImageProxy(image, self.context, self.db_api)
@@ -84,6 +88,7 @@ class ImageRepo(object):
                 sort_key=sort_key, sort_dir=sort_dir)
         images = []
         for db_api_image in db_api_images:
+            self._versions[db_api_image['id']] = db_api_image['version']
             tags = self.db_api.image_tag_get_all(self.context,
                                                  db_api_image['id'])
             image = self._format_image_from_db(dict(db_api_image), tags)
@@ -153,6 +158,7 @@ class ImageRepo(object):
         # function since it is specific to image create
         image_values['updated_at'] = image.updated_at
         new_values = self.db_api.image_create(self.context, image_values)
+        self._versions[image.image_id] = new_values['version']
         self.db_api.image_tag_set_all(self.context,
                                       image.image_id, image.tags)
         image.created_at = new_values['created_at']
@@ -161,12 +167,13 @@ class ImageRepo(object):
     def save(self, image):
         image_values = self._format_image_to_db(image)
         try:
-            new_values = self.db_api.image_update(self.context,
-                                                  image.image_id,
-                                                  image_values,
-                                                  purge_props=True)
+            new_values = self.db_api.image_update(
+                    self.context, image.image_id, image_values,
+                    purge_props=True,
+                    version=self._versions.get(image.image_id))
         except (exception.NotFound, exception.Forbidden):
             raise exception.NotFound(image_id=image.image_id)
+        self._versions[image.image_id] = new_values['version']
         self.db_api.image_tag_set_all(self.context, image.image_id,
                                       image.tags)
         image.updated_at = new_values['updated_at']
@@ -174,8 +181,10 @@ class ImageRepo(object):
     def remove(self, image):
         image_values = self._format_image_to_db(image)
         try:
-            self.db_api.image_update(self.context, image.image_id,
-                                     image_values, purge_props=True)
+            self.db_api.image_update(
+                    self.context, image.image_id, image_values,
+                    purge_props=True,
+                    version=self._versions.get(image.image_id))
         except (exception.NotFound, exception.Forbidden):
             raise exception.NotFound(image_id=image.image_id)
         # NOTE(markwash): don't update tags?
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import bisect
 import copy
 import functools
 
@@ -31,6 +32,133 @@ DATA = {
 }
 
 
+class ImageIndex(object):
+    """
+    Secondary indexes over DATA['images'] so that list calls do not have to
+    look at every image.
+
+    Every top-level image attribute gets a hash index of value -> image ids,
+    non-deleted properties get one keyed on (name, value), and a sorted
+    list of (sort key, created_at, id) tuples is kept for each sort key that
+    has been asked for. The indexes must be told about every change to an
+    image through reindex().
+    """
+
+    def __init__(self, images):
+        self.images = images
+        self.fields = {}
+        self.properties = {}
+        self.sorted = {}
+        self.entries = {}
+        for image in images.values():
+            self.reindex(image)
+
+    @staticmethod
+    def _sort_entry(sort_key, image_id, values):
+        #NOTE: None sorts first without ever being compared to, say, a
+        # datetime, which python refuses to do
+        value = values.get(sort_key)
+        return ((value is not None, value), values.get('created_at'),
+                image_id)
+
+    def _remove(self, image_id):
+        fields, properties = self.entries.pop(image_id, ({}, ()))
+        for key, value in fields.items():
+            self.fields[key][value].discard(image_id)
+        for prop in properties:
+            self.properties[prop].discard(image_id)
+        for sort_key, entries in self.sorted.items():
+            entry = self._sort_entry(sort_key, image_id, fields)
+            i = bisect.bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+
+    def reindex(self, image):
+        """Bring the indexes up to date with the current state of image"""
+        image_id = image['id']
+        self._remove(image_id)
+
+        fields = {}
+        for key, value in image.items():
+            if key == 'properties':
+                continue
+            try:
+                self.fields.setdefault(key, {}).setdefault(
+                        value, set()).add(image_id)
+            except TypeError:
+                continue
+            fields[key] = value
+
+        properties = set()
+        for prop in image['properties']:
+            if prop['deleted']:
+                continue
+            pair = (prop['name'], prop['value'])
+            try:
+                self.properties.setdefault(pair, set()).add(image_id)
+            except TypeError:
+                continue
+            properties.add(pair)
+
+        self.entries[image_id] = (fields, properties)
+        for sort_key, entries in self.sorted.items():
+            bisect.insort(entries,
+                          self._sort_entry(sort_key, image_id, fields))
+
+    def lookup(self, key, value):
+        """Ids of images matching an equality filter
+
+        As with the sqlalchemy driver, a filter on an attribute the image
+        doesn't have a value for is checked against its properties instead.
+        The returned set may be one of the indexes themselves, so it must
+        not be modified.
+        """
+        field = self.fields.get(key)
+        try:
+            prop_ids = self.properties.get((key, value), set())
+            if field is None:
+                return prop_ids
+            if prop_ids:
+                prop_ids = prop_ids & field.get(None, set())
+            if value is None:
+                return prop_ids
+            field_ids = field.get(value, set())
+            return field_ids | prop_ids if prop_ids else field_ids
+        except TypeError:
+            return set()
+
+    def sorted_ids(self, sort_key):
+        """Sorted (sort key, created_at, id) tuples for every image"""
+        if sort_key not in self.sorted:
+            self.sorted[sort_key] = sorted(
+                    self._sort_entry(sort_key, image_id, fields)
+                    for image_id, (fields, _props) in self.entries.items())
+        return self.sorted[sort_key]
+
+    def sort_subset(self, sort_key, image_ids):
+        """Sorted (sort key, created_at, id) tuples for the given images"""
+        return sorted(self._sort_entry(sort_key, image_id,
+                                       self.entries[image_id][0])
+                      for image_id in image_ids)
+
+    def position(self, entries, sort_key, image_id):
+        """Where an image sits in a list of sorted entries"""
+        fields = self.entries[image_id][0]
+        entry = self._sort_entry(sort_key, image_id, fields)
+        return bisect.bisect_left(entries, entry)
+
+
+_INDEX = None
+
+
+def _get_index():
+    """Return the indexes for DATA, rebuilding them if DATA was replaced"""
+    global _INDEX
+    if _INDEX is None or _INDEX.images is not DATA['images']:
+        _INDEX = ImageIndex(DATA['images'])
+    return _INDEX
+
+
 def log_call(func):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
@@ -110,6 +238,7 @@ def _image_format(image_id, **values):
         'updated_at': dt,
         'deleted_at': None,
         'deleted': False,
+        'version': 1,
     }
 
     #NOTE(bcwaldon): store properties as a list to match sqlalchemy driver
@@ -123,8 +252,14 @@ def _image_format(image_id, **values):
     return image
 
 
-def _filter_images(images, filters, context):
-    filtered_images = []
+def _filter_images(filters, context):
+    """Turn filters into a set of candidate image ids and a predicate
+
+    The candidates come from the indexes and are None when there are no
+    equality filters to narrow things down with. The predicate checks
+    visibility and range filters on a single image.
+    """
+    index = _get_index()
     if 'properties' in filters:
         prop_filter = filters.pop('properties')
         filters.update(prop_filter)
@@ -132,73 +267,82 @@ def _filter_images(images, filters, context):
     if 'is_public' in filters and filters['is_public'] is None:
         filters.pop('is_public')
 
-    for image in images:
+    matches = []
+    ranges = []
+    for k, value in filters.iteritems():
+        if k.endswith('_min') or k.endswith('_max'):
+            try:
+                value = int(value)
+            except ValueError:
+                msg = _("Unable to filter on a range "
+                        "with a non-numeric value.")
+                raise exception.InvalidFilterRangeValue(msg)
+            ranges.append((k[0:-4], k.endswith('_min'), value))
+        else:
+            matches.append(index.lookup(k, value))
+
+    image_ids = None
+    if matches:
+        matches.sort(key=len)
+        image_ids = matches[0]
+        for match in matches[1:]:
+            image_ids = image_ids & match
+
+    def predicate(image):
         has_ownership = context.owner and image['owner'] == context.owner
         can_see = image['is_public'] or has_ownership or context.is_admin
         if not can_see:
-            continue
-
-        add = True
-        for k, value in filters.iteritems():
-            key = k
-            if k.endswith('_min') or k.endswith('_max'):
-                key = key[0:-4]
-                try:
-                    value = int(value)
-                except ValueError:
-                    msg = _("Unable to filter on a range "
-                            "with a non-numeric value.")
-                    raise exception.InvalidFilterRangeValue(msg)
-            if k.endswith('_min'):
-                add = image.get(key) >= value
-            elif k.endswith('_max'):
-                add = image.get(key) <= value
-            elif image.get(k) is not None:
-                add = image.get(key) == value
-            else:
-                properties = {}
-                for p in image['properties']:
-                    properties = {p['name']: p['value'],
-                                  'deleted': p['deleted']}
-                add = (properties.get(key) == value and
-                       properties.get('deleted') is False)
-            if not add:
-                break
-
-        if add:
-            filtered_images.append(image)
-
-    return filtered_images
-
-
-def _do_pagination(context, images, marker, limit, show_deleted):
-    start = 0
-    end = -1
-    if marker is None:
-        start = 0
-    else:
-        # Check that the image is accessible
-        _image_get(context, marker, force_show_deleted=show_deleted)
+            return False
 
-        for i, image in enumerate(images):
-            if image['id'] == marker:
-                start = i + 1
-                break
-        else:
-            raise exception.NotFound()
+        for key, is_min, value in ranges:
+            if is_min:
+                if not image.get(key) >= value:
+                    return False
+            elif not image.get(key) <= value:
+                return False
+        return True
 
-    end = start + limit if limit is not None else None
-    return images[start:end]
+    return image_ids, predicate
 
 
-def _sort_images(images, sort_key, sort_dir):
-    reverse = False
-    if images and not images[0].get(sort_key):
+def _sort_and_paginate(context, image_ids, predicate, sort_key, sort_dir,
+                       marker, limit, show_deleted):
+    """Walk the sorted index for sort_key, starting after the marker"""
+    index = _get_index()
+    if index.entries and sort_key not in index.fields:
         raise exception.InvalidSortKey()
-    keyfn = lambda x: (x[sort_key], x['created_at'], x['id'])
+
+    def matches(image_id):
+        return ((image_ids is None or image_id in image_ids) and
+                predicate(DATA['images'][image_id]))
+
+    entries = index.sorted_ids(sort_key)
+    if image_ids is not None and len(image_ids) * 10 < len(entries):
+        # Cheaper to sort the few candidates than to skip past the many
+        # images that aren't
+        entries = index.sort_subset(sort_key, image_ids)
     reverse = sort_dir == 'desc'
-    images.sort(key=keyfn, reverse=reverse)
 
+    if marker is None:
+        start = len(entries) - 1 if reverse else 0
+    else:
+        # Check that the image is accessible
+        _image_get(context, marker, force_show_deleted=show_deleted)
+        if not matches(marker):
+            raise exception.NotFound()
+        start = index.position(entries, sort_key, marker)
+        start = start - 1 if reverse else start + 1
+
+    step = -1 if reverse else 1
+    images = []
+    i = start
+    while 0 <= i < len(entries):
+        if limit is not None and len(images) >= limit:
+            break
+        image_id = entries[i][2]
+        if matches(image_id):
+            images.append(DATA['images'][image_id])
+        i += step
     return images
 
 
@@ -230,12 +374,9 @@ def image_get(context, image_id, session=None, force_show_deleted=False):
 def image_get_all(context, filters=None, marker=None, limit=None,
                   sort_key='created_at', sort_dir='desc'):
     filters = filters or {}
-    images = DATA['images'].values()
-    images = _filter_images(images, filters, context)
-    images = _sort_images(images, sort_key, sort_dir)
-    images = _do_pagination(context, images, marker, limit,
-                            filters.get('deleted'))
-    return images
+    image_ids, predicate = _filter_images(filters, context)
+    return _sort_and_paginate(context, image_ids, predicate, sort_key,
+                              sort_dir, marker, limit, filters.get('deleted'))
 
 
 @log_call
@@ -245,6 +386,7 @@ def image_property_create(context, values):
                                   values['name'],
                                   values['value'])
     image['properties'].append(prop)
+    _get_index().reindex(image)
     return prop
 
 
@@ -259,6 +401,7 @@ def image_property_delete(context, prop_ref, session=None):
         raise exception.NotFound()
     prop['deleted_at'] = timeutils.utcnow()
     prop['deleted'] = True
+    _get_index().reindex(DATA['images'][image_id])
     return prop
 
 
@@ -332,22 +475,31 @@ def image_create(context, image_values):
     image = _image_format(image_id, **image_values)
     DATA['images'][image_id] = image
     DATA['tags'][image_id] = image.pop('tags', [])
+    _get_index().reindex(image)
     return image
 
 
 @log_call
-def image_update(context, image_id, image_values, purge_props=False):
+def image_update(context, image_id, image_values, purge_props=False,
+                 version=None, from_state=None):
     global DATA
     try:
         image = DATA['images'][image_id]
     except KeyError:
         raise exception.NotFound(image_id=image_id)
 
+    if version is not None and image['version'] != version:
+        raise exception.ImageVersionConflict(image_id=image_id)
+    if from_state is not None and image['status'] != from_state:
+        raise exception.ImageStatusConflict(image_id=image_id,
+                                            status=from_state)
+
     # replace values for properties that already exist
     new_properties = image_values.pop('properties', {})
     for prop in image['properties']:
         if prop['name'] in new_properties:
             prop['value'] = new_properties.pop(prop['name'])
+            prop['deleted'] = False
         elif purge_props:
             # this matches weirdness in the sqlalchemy api
             prop['deleted'] = True
@@ -358,7 +510,9 @@ def image_update(context, image_id, image_values, purge_props=False):
 
     image['updated_at'] = timeutils.utcnow()
     image.update(image_values)
+    image['version'] += 1
     DATA['images'][image_id] = image
+    _get_index().reindex(image)
     return image
 
 
@@ -368,9 +522,10 @@ def image_destroy(context, image_id):
     try:
         DATA['images'][image_id]['deleted'] = True
         DATA['images'][image_id]['deleted_at'] = timeutils.utcnow()
-        return copy.deepcopy(DATA['images'][image_id])
     except KeyError:
         raise exception.NotFound()
+    _get_index().reindex(DATA['images'][image_id])
+    return copy.deepcopy(DATA['images'][image_id])
 
 
 @log_call
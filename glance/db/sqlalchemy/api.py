@@ -22,9 +22,14 @@
 Defines interface for DB access
 """
 
+import functools
+import itertools
 import logging
+import threading
 import time
 
+from eventlet import semaphore
+from eventlet import tpool
 import sqlalchemy
 import sqlalchemy.orm as sa_orm
 import sqlalchemy.sql as sa_sql
@@ -44,6 +49,13 @@ _RETRY_INTERVAL = None
 BASE = models.BASE
 sa_logger = None
 LOG = os_logging.getLogger(__name__)
+_REPLICAS = None
+_REPLICA_COUNTER = itertools.count()
+# Limits the DB API calls running in native threads
+_TPOOL_SEMAPHORE = None
+_THREAD_LOCAL = threading.local()
+# Maximum number of image ids in the IN clause of one property query
+_PROPERTY_QUERY_CHUNK = 500
 
 
 STATUSES = ['active', 'saving', 'queued', 'killed', 'pending_delete',
@@ -54,6 +66,32 @@ db_opts = [
     cfg.IntOpt('sql_max_retries', default=60),
     cfg.IntOpt('sql_retry_interval', default=1),
     cfg.BoolOpt('db_auto_create', default=False),
+    cfg.IntOpt('sql_max_pool_size', default=None,
+               help=_("Maximum number of connections kept open in the "
+                      "SQLAlchemy connection pool. Defaults to the "
+                      "SQLAlchemy default.")),
+    cfg.IntOpt('sql_max_overflow', default=None,
+               help=_("Number of connections that may be opened beyond "
+                      "sql_max_pool_size when the pool is exhausted. "
+                      "Defaults to the SQLAlchemy default.")),
+    cfg.IntOpt('sql_pool_timeout', default=None,
+               help=_("Seconds to wait for a connection from the pool "
+                      "before giving up. Defaults to the SQLAlchemy "
+                      "default.")),
+    cfg.BoolOpt('sql_use_tpool', default=False,
+                help=_("Run DB API calls in native threads, so that a "
+                       "database driver which blocks, such as MySQLdb, "
+                       "does not stall other requests on the worker.")),
+    cfg.IntOpt('sql_tpool_size', default=10,
+               help=_("Maximum number of DB API calls run in native "
+                      "threads at once when sql_use_tpool is enabled.")),
+    cfg.ListOpt('sql_slave_connection', default=[], secret=True,
+                help=_("SQLAlchemy connection strings of read replicas of "
+                       "the registry database, which serve image list, "
+                       "show, member and tag reads.")),
+    cfg.IntOpt('sql_slave_retry_interval', default=30,
+               help=_("Seconds a read replica is left unused after a "
+                      "connection to it fails.")),
 ]
 
 CONF = cfg.CONF
@@ -136,22 +174,8 @@ def get_engine():
         _RETRY_INTERVAL
 
     if not _ENGINE:
-        tries = _MAX_RETRIES
-        retry_interval = _RETRY_INTERVAL
-
-        connection_dict = sqlalchemy.engine.url.make_url(_CONNECTION)
-
-        engine_args = {
-            'pool_recycle': _IDLE_TIMEOUT,
-            'echo': False,
-            'convert_unicode': True}
-
         try:
-            _ENGINE = sqlalchemy.create_engine(_CONNECTION, **engine_args)
-
-            if 'mysql' in connection_dict.drivername:
-                sqlalchemy.event.listen(_ENGINE, 'checkout', ping_listener)
-
+            _ENGINE = _create_engine(_CONNECTION)
             _ENGINE.connect = wrap_db_error(_ENGINE.connect)
             _ENGINE.connect()
         except Exception, err:
@@ -179,6 +203,30 @@ def get_engine():
     return _ENGINE
 
 
+def _create_engine(connection):
+    connection_dict = sqlalchemy.engine.url.make_url(connection)
+
+    engine_args = {
+        'pool_recycle': CONF.sql_idle_timeout,
+        'echo': False,
+        'convert_unicode': True}
+
+    # The pools SQLAlchemy uses for SQLite take no size arguments
+    if 'sqlite' not in connection_dict.drivername:
+        for arg, value in (('pool_size', CONF.sql_max_pool_size),
+                           ('max_overflow', CONF.sql_max_overflow),
+                           ('pool_timeout', CONF.sql_pool_timeout)):
+            if value is not None:
+                engine_args[arg] = value
+
+    engine = sqlalchemy.create_engine(connection, **engine_args)
+
+    if 'mysql' in connection_dict.drivername:
+        sqlalchemy.event.listen(engine, 'checkout', ping_listener)
+
+    return engine
+
+
 def get_maker(autocommit=True, expire_on_commit=False):
     """Return a SQLAlchemy sessionmaker."""
     """May assign __MAKER if not already assigned"""
@@ -231,30 +279,174 @@ def wrap_db_error(f):
     return _wrap
 
 
+def dispatch(func):
+    """
+    Decorator running a DB API function in a native thread from eventlet's
+    thread pool when ``sql_use_tpool`` is set. The calling green thread
+    waits for the result while others keep running. Calls made from an
+    already dispatched function run inline.
+    """
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        if (not CONF.sql_use_tpool or
+                getattr(_THREAD_LOCAL, 'dispatched', False)):
+            return func(*args, **kwargs)
+
+        global _TPOOL_SEMAPHORE
+        if _TPOOL_SEMAPHORE is None:
+            _TPOOL_SEMAPHORE = semaphore.Semaphore(CONF.sql_tpool_size)
+        with _TPOOL_SEMAPHORE:
+            return tpool.execute(_run_dispatched, func, args, kwargs)
+
+    return wrapped
+
+
+def _run_dispatched(func, args, kwargs):
+    _THREAD_LOCAL.dispatched = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _THREAD_LOCAL.dispatched = False
+
+
+class Replica(object):
+    """A read replica of the registry database."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        url = sqlalchemy.engine.url.make_url(connection)
+        # For logging, without the credentials
+        self.name = '%s/%s' % (url.host or url.drivername, url.database)
+        self.maker = None
+        self.down_until = 0
+
+    def get_session(self):
+        if self.maker is None:
+            engine = _create_engine(self.connection)
+            self.maker = sa_orm.sessionmaker(bind=engine, autocommit=True,
+                                             expire_on_commit=False)
+        return self.maker()
+
+    def mark_down(self):
+        self.down_until = time.time() + CONF.sql_slave_retry_interval
+
+
+def get_replica():
+    """
+    Returns the next available read replica in turn, or None if none is
+    configured or all are down.
+    """
+    global _REPLICAS
+    if _REPLICAS is None:
+        _REPLICAS = [Replica(c) for c in CONF.sql_slave_connection]
+    now = time.time()
+    for i in range(len(_REPLICAS)):
+        replica = _REPLICAS[_REPLICA_COUNTER.next() % len(_REPLICAS)]
+        if replica.down_until <= now:
+            return replica
+    return None
+
+
+def _has_written(context):
+    return getattr(context, 'db_written', False)
+
+
+def primary_write(func):
+    """
+    Decorator for DB API functions that write, marking the request context
+    so that its later reads see the write on the primary database rather
+    than a possibly lagging replica.
+    """
+    @functools.wraps(func)
+    def wrapped(context, *args, **kwargs):
+        try:
+            context.db_written = True
+        except AttributeError:
+            pass
+        return func(context, *args, **kwargs)
+
+    return wrapped
+
+
+def replica_read(func):
+    """
+    Decorator running a read-only DB API function, which must take a
+    `session` keyword argument, against a read replica. The primary
+    database is used instead for calls given a session, as part of a
+    write transaction, calls in a request that has written, and when no
+    replica is available. Calls are retried on the primary when the
+    replica fails or, as it may lag behind, does not find the object.
+    """
+    @functools.wraps(func)
+    def wrapped(context, *args, **kwargs):
+        replica = None
+        if kwargs.get('session') is None and not _has_written(context):
+            replica = get_replica()
+        if replica is None:
+            return func(context, *args, **kwargs)
+
+        try:
+            kwargs['session'] = replica.get_session()
+            return func(context, *args, **kwargs)
+        except (sqlalchemy.exc.OperationalError,
+                sqlalchemy.exc.DisconnectionError), e:
+            LOG.warn(_("Read replica %(replica)s failed, using the primary "
+                       "database: %(e)s") % {'replica': replica.name,
+                                             'e': e})
+            replica.mark_down()
+        except exception.NotFound:
+            pass
+        del kwargs['session']
+        return func(context, *args, **kwargs)
+
+    return wrapped
+
+
+@dispatch
+@primary_write
 def image_create(context, values):
     """Create an image from the values dictionary."""
     return _image_update(context, values, None, False)
 
 
-def image_update(context, image_id, values, purge_props=False):
+@dispatch
+@primary_write
+def image_update(context, image_id, values, purge_props=False, version=None,
+                 from_state=None):
     """
     Set the given properties on an image and update it.
 
+    :param version: If given, the version of the image the update is based
+                    on; the update is refused if the image has changed since
+    :param from_state: If given, the status the image must be in for the
+                       update to be made, e.g. 'queued' when moving it to
+                       'saving'
     :raises NotFound if image does not exist.
+    :raises ImageVersionConflict if the image is no longer at `version`.
+    :raises ImageStatusConflict if the image is not in status `from_state`.
     """
-    return _image_update(context, values, image_id, purge_props)
+    if _can_update_in_place(context, values, purge_props):
+        return _image_update_in_place(context, image_id, values, version,
+                                      from_state)
+    return _image_update(context, values, image_id, purge_props,
+                         version=version, from_state=from_state)
 
 
+@dispatch
+@primary_write
 def image_destroy(context, image_id):
     """Destroy the image or raise if it does not exist."""
     session = get_session()
     with session.begin():
-        image_ref = image_get(context, image_id, session=session)
+        image_ref = _image_get(context, image_id, session=session)
 
         # Perform authorization check
         check_mutate_authorization(context, image_ref)
 
-        image_ref.delete(session=session)
+        try:
+            image_ref.delete(session=session)
+        except sa_orm.exc.StaleDataError:
+            raise exception.ImageVersionConflict(image_id=image_id)
 
         for prop_ref in image_ref.properties:
             image_property_delete(context, prop_ref, session=session)
@@ -266,8 +458,61 @@ def image_destroy(context, image_id):
         return image_ref
 
 
+@dispatch
+@replica_read
 def image_get(context, image_id, session=None, force_show_deleted=False):
-    """Get an image or raise if it does not exist."""
+    """
+    Get an image or raise if it does not exist.
+
+    The image is read with plain SQL expressions and returned as a dict,
+    with its properties as a list of dicts, rather than as an Image model
+    added to the session. Use _image_get for an image that is to be
+    changed.
+    """
+    session = session or get_session()
+    table = models.Image.__table__
+    query = sa_sql.select([table]).where(table.c.id == image_id)
+
+    # filter out deleted images if context disallows it
+    if not force_show_deleted and not _can_show_deleted(context):
+        query = query.where(table.c.deleted == False)
+
+    images = _images_from_select(session, query)
+    if not images:
+        raise exception.NotFound("No image found with ID %s" % image_id)
+    image = images[0]
+
+    # Make sure they can look at it
+    if not is_image_visible(context, image):
+        raise exception.Forbidden("Image not visible to you")
+
+    return image
+
+
+def _images_from_select(session, query):
+    """
+    Runs a select of rows of the images table and returns the images as
+    dicts, each with a 'properties' list of property dicts, as the Image
+    model has. Nothing is loaded into the session.
+    """
+    images = [dict(row) for row in session.execute(query)]
+    images_by_id = {}
+    for image in images:
+        image['properties'] = []
+        images_by_id[image['id']] = image
+
+    table = models.ImageProperty.__table__
+    image_ids = images_by_id.keys()
+    for i in xrange(0, len(image_ids), _PROPERTY_QUERY_CHUNK):
+        chunk = image_ids[i:i + _PROPERTY_QUERY_CHUNK]
+        query = sa_sql.select([table]).where(table.c.image_id.in_(chunk))
+        for row in session.execute(query):
+            images_by_id[row['image_id']]['properties'].append(dict(row))
+    return images
+
+
+def _image_get(context, image_id, session=None, force_show_deleted=False):
+    """Get an Image model to change, or raise if it does not exist."""
     session = session or get_session()
 
     try:
@@ -435,7 +680,7 @@ def paginate_query(query, model, limit, sort_keys, marker=None,
     if marker is not None:
         marker_values = []
         for sort_key in sort_keys:
-            v = getattr(marker, sort_key)
+            v = marker[sort_key]
             marker_values.append(v)
 
         # Build up an array of sort criteria as in the docstring
@@ -467,8 +712,10 @@ def paginate_query(query, model, limit, sort_keys, marker=None,
     return query
 
 
+@dispatch
+@replica_read
 def image_get_all(context, filters=None, marker=None, limit=None,
-                  sort_key='created_at', sort_dir='desc'):
+                  sort_key='created_at', sort_dir='desc', session=None):
     """
     Get all images that match zero or more filters.
 
@@ -479,12 +726,17 @@ def image_get_all(context, filters=None, marker=None, limit=None,
     :param limit: maximum number of images to return
     :param sort_key: image attribute by which results should be sorted
     :param sort_dir: direction in which results should be sorted (asc, desc)
+    :param session: session to query, by default one for the primary
+                    database
+
+    The images are returned as dicts, as by image_get. The filters and
+    ordering are built on a query of the Image model, but only its
+    SELECT statement is run.
     """
     filters = filters or {}
 
-    session = get_session()
-    query = session.query(models.Image)\
-                   .options(sa_orm.joinedload(models.Image.properties))
+    session = session or get_session()
+    query = session.query(models.Image)
 
     # NOTE(markwash) treat is_public=None as if it weren't filtered
     if 'is_public' in filters and filters['is_public'] is None:
@@ -547,14 +799,15 @@ def image_get_all(context, filters=None, marker=None, limit=None,
     marker_image = None
     if marker is not None:
         marker_image = image_get(context, marker,
-                                 force_show_deleted=showing_deleted)
+                                 force_show_deleted=showing_deleted,
+                                 session=session)
 
     query = paginate_query(query, models.Image, limit,
                            [sort_key, 'created_at', 'id'],
                            marker=marker_image,
                            sort_dir=sort_dir)
 
-    return query.all()
+    return _images_from_select(session, query.statement)
 
 
 def _drop_protected_attrs(model_class, values):
@@ -594,13 +847,97 @@ def _update_values(image_ref, values):
             setattr(image_ref, k, values[k])
 
 
-def _image_update(context, values, image_id, purge_props=False):
+def _can_update_in_place(context, values, purge_props):
+    """
+    Returns whether an image update only sets image attributes, so that
+    it can be made by _image_update_in_place.
+    """
+    if purge_props or values.get('properties'):
+        return False
+    # Leave the non-admin calls that are refused anyway to _image_update
+    if not context.is_admin and context.owner is None:
+        return False
+    columns = models.Image.__table__.c
+    return all(k in columns and k not in ('id', 'version')
+               for k in values if k != 'properties')
+
+
+def _image_update_in_place(context, image_id, values, version=None,
+                           from_state=None):
+    """
+    Updates the attributes of an image with a single UPDATE statement,
+    made conditional on the image being mutable in the context and, if
+    given, still being at `version` and in status `from_state`, rather than
+    loading the image and its properties first. Refused updates raise the
+    exceptions _image_update would.
+    """
+    values = dict(values)
+    values.pop('properties', None)
+
+    # Need to canonicalize ownership
+    if 'owner' in values and not values['owner']:
+        values['owner'] = None
+
+    _drop_protected_attrs(models.Image, values)
+    invalid = None
+    if 'status' in values:
+        try:
+            validate_image(values)
+        except exception.Invalid, e:
+            invalid = e
+
+    table = models.Image.__table__
+    values['updated_at'] = timeutils.utcnow()
+    values['version'] = table.c.version + 1
+
+    query = table.update().where(table.c.id == image_id)
+    if not _can_show_deleted(context):
+        query = query.where(table.c.deleted == False)
+    if not context.is_admin:
+        query = query.where(table.c.owner == context.owner)
+    if version is not None:
+        query = query.where(table.c.version == version)
+    if from_state is not None:
+        query = query.where(table.c.status == from_state)
+
+    session = get_session()
+    with session.begin():
+        if invalid is None:
+            result = session.execute(query.values(**values))
+            updated = result.rowcount == 1
+        else:
+            updated = False
+
+        if not updated:
+            # Raise what _image_update would have, in the same order
+            image_ref = _image_get(context, image_id, session=session)
+            check_mutate_authorization(context, image_ref)
+            _check_version_and_status(image_ref, version, from_state)
+            if invalid is not None:
+                raise invalid
+            raise exception.ImageVersionConflict(image_id=image_id)
+
+    return image_get(context, image_id)
+
+
+def _check_version_and_status(image_ref, version, from_state):
+    if version is not None and image_ref.version != version:
+        raise exception.ImageVersionConflict(image_id=image_ref.id)
+    if from_state is not None and image_ref.status != from_state:
+        raise exception.ImageStatusConflict(image_id=image_ref.id,
+                                            status=from_state)
+
+
+def _image_update(context, values, image_id, purge_props=False,
+                  version=None, from_state=None):
     """
     Used internally by image_create and image_update
 
     :param context: Request context
     :param values: A dict of attributes to set
     :param image_id: If None, create the image, otherwise, find and update it
+    :param version: If given, the version the existing image must be at
+    :param from_state: If given, the status the existing image must be in
     """
     session = get_session()
     with session.begin():
@@ -614,10 +951,12 @@ def _image_update(context, values, image_id, purge_props=False):
         properties = values.pop('properties', {})
 
         if image_id:
-            image_ref = image_get(context, image_id, session=session)
+            image_ref = _image_get(context, image_id, session=session)
 
             # Perform authorization check
             check_mutate_authorization(context, image_ref)
+
+            _check_version_and_status(image_ref, version, from_state)
         else:
             if values.get('size') is not None:
                 values['size'] = int(values['size'])
@@ -656,6 +995,9 @@ def _image_update(context, values, image_id, purge_props=False):
         except sqlalchemy.exc.IntegrityError:
             raise exception.Duplicate("Image ID %s already exists!"
                                       % values['id'])
+        except sa_orm.exc.StaleDataError:
+            # Changed since image_get loaded it
+            raise exception.ImageVersionConflict(image_id=image_id)
 
         _set_properties_for_image(context, image_ref, properties, purge_props,
                                   session)
@@ -668,33 +1010,66 @@ def _set_properties_for_image(context, image_ref, properties,
     """
     Create or update a set of image_properties for a given image
 
+    The difference between the existing and requested properties is worked
+    out up front and applied with at most one INSERT, one UPDATE and one
+    soft-delete UPDATE, each covering every affected row.
+
     :param context: Request context
     :param image_ref: An Image object
     :param properties: A dict of properties to set
     :param session: A SQLAlchemy session to use (if present)
     """
+    session = session or get_session()
+    table = models.ImageProperty.__table__
+
     orig_properties = {}
     for prop_ref in image_ref.properties:
         orig_properties[prop_ref.name] = prop_ref
 
+    to_create = []
+    to_update = []
     for name, value in properties.iteritems():
-        prop_values = {'image_id': image_ref.id,
-                       'name': name,
-                       'value': value}
-        if name in orig_properties:
-            prop_ref = orig_properties[name]
-            _image_property_update(context, prop_ref, prop_values,
-                                   session=session)
-        else:
-            image_property_create(context, prop_values, session=session)
-
+        prop_ref = orig_properties.get(name)
+        if prop_ref is None:
+            to_create.append({'image_id': image_ref.id,
+                              'name': name,
+                              'value': value})
+        elif prop_ref.value != value or prop_ref.deleted:
+            to_update.append({'_id': prop_ref.id, '_value': value})
+
+    to_delete = []
     if purge_props:
-        for key in orig_properties.keys():
-            if key not in properties:
-                prop_ref = orig_properties[key]
-                image_property_delete(context, prop_ref, session=session)
-
-
+        to_delete = [prop_ref.id for name, prop_ref in orig_properties.items()
+                     if name not in properties]
+
+    now = timeutils.utcnow()
+    with session.begin(subtransactions=True):
+        if to_create:
+            for values in to_create:
+                values.update(created_at=now, updated_at=now, deleted=False)
+            session.execute(table.insert(), to_create)
+
+        if to_update:
+            stmt = table.update()\
+                        .where(table.c.id == sa_sql.bindparam('_id'))\
+                        .values(value=sa_sql.bindparam('_value'),
+                                deleted=False,
+                                updated_at=now)
+            session.execute(stmt, to_update)
+
+        if to_delete:
+            stmt = table.update()\
+                        .where(table.c.id.in_(to_delete))\
+                        .values(deleted=True, deleted_at=now, updated_at=now)
+            session.execute(stmt)
+
+    if to_create or to_update or to_delete:
+        # The loaded ImageProperty objects no longer match the database
+        session.expire(image_ref, ['properties'])
+
+
+@dispatch
+@primary_write
 def image_property_create(context, values, session=None):
     """Create an ImageProperty object"""
     prop_ref = models.ImageProperty()
@@ -712,6 +1087,8 @@ def _image_property_update(context, prop_ref, values, session=None):
     return prop_ref
 
 
+@dispatch
+@primary_write
 def image_property_delete(context, prop_ref, session=None):
     """
     Used internally by image_property_create and image_property_update
@@ -720,6 +1097,8 @@ def image_property_delete(context, prop_ref, session=None):
     return prop_ref
 
 
+@dispatch
+@primary_write
 def image_member_create(context, values, session=None):
     """Create an ImageMember object"""
     memb_ref = models.ImageMember()
@@ -739,6 +1118,8 @@ def _image_member_format(member_ref):
     }
 
 
+@dispatch
+@primary_write
 def image_member_update(context, memb_id, values):
     """Update an ImageMember object"""
     session = get_session()
@@ -757,6 +1138,8 @@ def _image_member_update(context, memb_ref, values, session=None):
     return memb_ref
 
 
+@dispatch
+@primary_write
 def image_member_delete(context, memb_id, session=None):
     """Delete an ImageMember object"""
     session = session or get_session()
@@ -775,13 +1158,17 @@ def _image_member_get(context, memb_id, session):
     return query.one()
 
 
-def image_member_find(context, image_id=None, member=None):
+@dispatch
+@replica_read
+def image_member_find(context, image_id=None, member=None, session=None):
     """Find all members that meet the given criteria
 
     :param image_id: identifier of image entity
     :param member: tenant to which membership has been granted
+    :param session: session to query, by default one for the primary
+                    database
     """
-    session = get_session()
+    session = session or get_session()
     members = _image_member_find(context, session, image_id, member)
     return [_image_member_format(m) for m in members]
 
@@ -813,9 +1200,12 @@ def _can_show_deleted(context):
     return context.get('deleted', False)
 
 
+@dispatch
+@primary_write
 def image_tag_set_all(context, image_id, tags):
     session = get_session()
-    existing_tags = set(image_tag_get_all(context, image_id, session))
+    existing_tags = set(image_tag_get_all(context, image_id,
+                                          session=session))
     tags = set(tags)
 
     tags_to_create = tags - existing_tags
@@ -830,6 +1220,8 @@ def image_tag_set_all(context, image_id, tags):
         image_tag_delete(context, image_id, tag, session)
 
 
+@dispatch
+@primary_write
 def image_tag_create(context, image_id, value, session=None):
     """Create an image tag."""
     session = session or get_session()
@@ -838,6 +1230,8 @@ def image_tag_create(context, image_id, value, session=None):
     return tag_ref['value']
 
 
+@dispatch
+@primary_write
 def image_tag_delete(context, image_id, value, session=None):
     """Delete an image tag."""
     session = session or get_session()
@@ -853,6 +1247,8 @@ def image_tag_delete(context, image_id, value, session=None):
     tag_ref.delete(session=session)
 
 
+@dispatch
+@replica_read
 def image_tag_get_all(context, image_id, session=None):
     """Get a list of tags for a specific image."""
     session = session or get_session()
@@ -114,6 +114,12 @@ class Image(BASE, ModelBase):
     min_ram = Column(Integer(), nullable=False, default=0)
     owner = Column(String(255))
     protected = Column(Boolean, nullable=False, default=False)
+    # Incremented by every update, for optimistic concurrency control
+    version = Column(Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
+    __protected_attributes__ = ModelBase.__protected_attributes__ | set([
+        'version'])
 
 
 class ImageProperty(BASE, ModelBase):
@@ -34,6 +34,8 @@ image_cache_opts = [
     cfg.IntOpt('image_cache_max_size', default=10 * (1024 ** 3)),  # 10 GB
     cfg.IntOpt('image_cache_stall_time', default=86400),  # 24 hours
     cfg.StrOpt('image_cache_dir'),
+    cfg.IntOpt('image_cache_readahead', default=4096),  # KiB
+    cfg.IntOpt('image_cache_drop_threshold', default=0),  # MiB
 ]
 
 CONF = cfg.CONF
@@ -31,6 +31,38 @@ LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
 
+class ReadaheadFile(object):
+    """
+    Wraps a cache file opened for reading, declaring it as read
+    sequentially and asking the kernel to fetch `window` bytes ahead
+    of the current read position.
+    """
+
+    def __init__(self, fp, window):
+        self.fp = fp
+        self.window = window
+        self.advised = 0
+        utils.fadvise(fp.fileno(), 0, 0, utils.POSIX_FADV_SEQUENTIAL)
+
+    def read(self, size=-1):
+        if self.window:
+            position = self.fp.tell()
+            # Top the window up once half of it has been consumed
+            if self.advised < position + self.window // 2:
+                start = max(position, self.advised)
+                self.advised = position + self.window
+                utils.fadvise(self.fp.fileno(), start,
+                              self.advised - start,
+                              utils.POSIX_FADV_WILLNEED)
+        return self.fp.read(size)
+
+    def __iter__(self):
+        return utils.chunkiter(self)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
 class Driver(object):
 
     def configure(self):
@@ -85,10 +117,13 @@ class Driver(object):
                 'hits': INTEGER,
                 'last_modified': ISO_TIMESTAMP,
                 'last_accessed': ISO_TIMESTAMP,
-                'size': INTEGER
+                'size': INTEGER,
+                'resident': INTEGER or None
                 }, ...
             ]
 
+        ``resident`` is the number of bytes of the image file held in
+        the page cache, or None if this cannot be determined.
         """
         return NotImplementedError
 
@@ -209,6 +244,32 @@ class Driver(object):
         path = self.get_image_filepath(image_id)
         return os.path.getsize(path)
 
+    def _reader(self, cache_file):
+        """
+        Returns the cache file wrapped so that reads from it are
+        prefetched according to ``image_cache_readahead``.
+
+        :param cache_file: file object opened for reading
+        """
+        return ReadaheadFile(cache_file, CONF.image_cache_readahead * 1024)
+
+    def _release_written(self, cache_file):
+        """
+        Drops a newly written cache file from the page cache if it is at
+        least ``image_cache_drop_threshold`` MiB in size, so that filling
+        the cache with a single large image does not evict the smaller,
+        frequently read ones.
+
+        :param cache_file: file object opened for writing
+        """
+        threshold = CONF.image_cache_drop_threshold * 1024 * 1024
+        if not threshold or cache_file.tell() < threshold:
+            return
+        # Only clean pages can be dropped, so write the file back first
+        cache_file.flush()
+        utils.fdatasync(cache_file.fileno())
+        utils.fadvise(cache_file.fileno(), 0, 0, utils.POSIX_FADV_DONTNEED)
+
     def get_queued_images(self):
         """
         Returns a list of image IDs that are in the queue. The
@@ -29,6 +29,7 @@ from eventlet import sleep, timeout
 import sqlite3
 
 from glance.common import exception
+from glance.common import utils
 from glance.image_cache.drivers import base
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
@@ -163,7 +164,11 @@ class Driver(base.Driver):
                              FROM cached_images
                              ORDER BY image_id""")
             cur.row_factory = dict_factory
-            return [r for r in cur]
+            entries = [r for r in cur]
+        for entry in entries:
+            path = self.get_image_filepath(entry['image_id'])
+            entry['resident'] = utils.get_page_cache_residency(path)
+        return entries
 
     def is_cached(self, image_id):
         """
@@ -331,6 +336,7 @@ class Driver(base.Driver):
         try:
             with open(incomplete_path, 'wb') as cache_file:
                 yield cache_file
+                self._release_written(cache_file)
         except Exception as e:
             rollback(e)
             raise
@@ -355,7 +361,7 @@ class Driver(base.Driver):
         """
         path = self.get_image_filepath(image_id)
         with open(path, 'rb') as cache_file:
-            yield cache_file
+            yield self._reader(cache_file)
         now = time.time()
         with self.get_db() as db:
             db.execute("""UPDATE cached_images
@@ -64,6 +64,7 @@ import time
 import xattr
 
 from glance.common import exception
+from glance.common import utils
 from glance.image_cache.drivers import base
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
@@ -158,6 +159,7 @@ class Driver(base.Driver):
                 file_info[stat.ST_ATIME])
             entry['size'] = file_info[stat.ST_SIZE]
             entry['hits'] = self.get_hit_count(image_id)
+            entry['resident'] = utils.get_page_cache_residency(path)
 
             entries.append(entry)
         entries.sort()  # Order by ID
@@ -297,6 +299,7 @@ class Driver(base.Driver):
         try:
             with open(incomplete_path, 'wb') as cache_file:
                 yield cache_file
+                self._release_written(cache_file)
         except Exception as e:
             rollback(e)
             raise
@@ -321,7 +324,7 @@ class Driver(base.Driver):
         """
         path = self.get_image_filepath(image_id)
         with open(path, 'rb') as cache_file:
-            yield cache_file
+            yield self._reader(cache_file)
         path = self.get_image_filepath(image_id)
         inc_xattr(path, 'hits', 1)
 
@@ -16,18 +16,34 @@
 #    under the License.
 
 
+import errno
+import os
+import random
 import socket
 import uuid
 
+import eventlet
+import eventlet.queue
+
 from glance.common import exception
 import glance.domain
+import glance.notifier.notify_noop
 from glance.openstack.common import cfg
 from glance.openstack.common import importutils
+from glance.openstack.common import jsonutils
 import glance.openstack.common.log as logging
 from glance.openstack.common import timeutils
 
 notifier_opts = [
-    cfg.StrOpt('notifier_strategy', default='default')
+    cfg.StrOpt('notifier_strategy', default='default'),
+    cfg.BoolOpt('notifier_async', default=False),
+    cfg.IntOpt('notifier_queue_size', default=1000),
+    cfg.IntOpt('notifier_batch_size', default=50),
+    cfg.StrOpt('notifier_overflow_policy', default='drop'),
+    cfg.StrOpt('notifier_spill_dir'),
+    cfg.ListOpt('notifier_sample_rates', default=[]),
+    cfg.ListOpt('notifier_rollup_events', default=[]),
+    cfg.IntOpt('notifier_rollup_interval', default=60),
 ]
 
 CONF = cfg.CONF
@@ -43,9 +59,337 @@ _STRATEGY_ALIASES = {
     "default": "glance.notifier.notify_noop.NoopStrategy",
 }
 
+# Payload fields identifying a rollup bucket, and the fields summed within
+# it, for each event type that supports being rolled up
+_ROLLUP_FIELDS = {
+    'image.send': (('image_id', 'owner_id', 'receiver_tenant_id'),
+                   ('bytes_sent',)),
+}
+
+_DISPATCHERS = {}
+
+
+class AsyncDispatcher(object):
+    """
+    Publishes notifications from a background green thread so that a slow
+    or unreachable broker never blocks the request that emitted them.
+
+    Messages are held in a bounded in-memory queue and handed to the
+    strategy in batches. When the queue is full the message is either
+    dropped or, with the 'spill' overflow policy, appended to a file in
+    the spill directory and replayed once the queue has drained.
+
+    The spill directory may be shared by several worker processes. Each
+    takes the spill file to replay by renaming it to a name of its own,
+    and also replays the files left by workers that died mid-replay.
+    """
+
+    SPILL_FILE = 'notifications.spill'
+    REPLAY_SUFFIX = '.replay'
+
+    def __init__(self, strategy, queue_size=1000, batch_size=50,
+                 overflow_policy='drop', spill_dir=None):
+        self.strategy = strategy
+        self.batch_size = max(1, batch_size)
+        self.overflow_policy = overflow_policy
+        self.spill_dir = spill_dir
+        self.queue = eventlet.queue.LightQueue(max(1, queue_size))
+        self.stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'spilled': 0}
+        self._worker = None
+        # Spill file being replayed, and whether all of it has been read
+        self._replay = None
+        self._replay_done = False
+        if self.overflow_policy == 'spill' and self.spill_dir:
+            # Replay whatever an earlier process left behind
+            self._worker = eventlet.spawn(self._run)
+
+    def put(self, priority, msg):
+        """Queue a message for publishing without blocking the caller."""
+        try:
+            self.queue.put_nowait((priority, msg))
+        except eventlet.queue.Full:
+            self._overflow(priority, msg)
+        else:
+            self.stats['queued'] += 1
+        if self._worker is None:
+            self._worker = eventlet.spawn(self._run)
+
+    def wait(self):
+        """Block until every queued message has been handed off."""
+        while self._worker is not None:
+            self._worker.wait()
+
+    def _run(self):
+        try:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except eventlet.queue.Empty:
+                        break
+                replayed = not batch
+                if replayed:
+                    batch = self._read_spill()
+                if not batch:
+                    return
+                if not self._publish(batch):
+                    if self._spilling():
+                        # Keep the messages for when the broker is back,
+                        # rather than replaying them while it is down
+                        self._spill(batch)
+                        self._respill_replay()
+                        return
+                elif replayed and self._replay_done:
+                    self._finish_replay()
+                eventlet.sleep(0)
+        finally:
+            self._worker = None
+
+    def _publish(self, batch):
+        """Hands a batch to the strategy, returning whether it succeeded."""
+        try:
+            self.strategy.notify_batch(batch)
+        except Exception, err:
+            msg = _("Failed to publish %(count)d notifications: %(err)s")
+            LOG.error(msg % {'count': len(batch), 'err': err})
+            if not self._spilling():
+                self.stats['dropped'] += len(batch)
+            return False
+        self.stats['sent'] += len(batch)
+        return True
+
+    def _spilling(self):
+        return self.overflow_policy == 'spill' and bool(self.spill_dir)
+
+    def _spill_path(self):
+        return os.path.join(self.spill_dir, self.SPILL_FILE)
+
+    def _replay_path(self):
+        name = '%s.%d.%s%s' % (self.SPILL_FILE, os.getpid(),
+                               uuid.uuid4().hex, self.REPLAY_SUFFIX)
+        return os.path.join(self.spill_dir, name)
+
+    def _spill(self, entries):
+        """
+        Appends (priority, msg) entries to the spill file, returning
+        whether they were written. Entries that fail are counted as
+        dropped.
+        """
+        try:
+            lines = ''.join(jsonutils.dumps(list(entry)) + '\n'
+                            for entry in entries)
+            with open(self._spill_path(), 'a') as spill:
+                spill.write(lines)
+        except (TypeError, ValueError), err:
+            LOG.error(_("Unable to serialize notification to spill "
+                        "it: %s") % err)
+        except (IOError, OSError), err:
+            LOG.error(_("Unable to spill notification to disk: %s") %
+                      err)
+        else:
+            self.stats['spilled'] += len(entries)
+            return True
+        self.stats['dropped'] += len(entries)
+        return False
+
+    def _overflow(self, priority, msg):
+        if self._spilling() and self._spill([(priority, msg)]):
+            return
+        if not self._spilling():
+            self.stats['dropped'] += 1
+        LOG.warn(_("Notification queue full, dropping %(event_type)s "
+                   "notification %(message_id)s") % msg)
+
+    def _claim(self, path):
+        """
+        Renames a spill or replay file to a replay file of this process,
+        returning its new path, or None if another process claimed it.
+        """
+        replay_path = self._replay_path()
+        try:
+            os.rename(path, replay_path)
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                LOG.error(_("Unable to replay spilled notifications: %s") %
+                          err)
+            return None
+        return replay_path
+
+    def _abandoned_replays(self):
+        """Yields the replay files whose process is no longer running."""
+        try:
+            names = os.listdir(self.spill_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(self.REPLAY_SUFFIX):
+                continue
+            try:
+                pid = int(name.split('.')[2])
+            except (IndexError, ValueError):
+                continue
+            if pid != os.getpid():
+                try:
+                    os.kill(pid, 0)
+                    continue
+                except OSError, err:
+                    if err.errno != errno.ESRCH:
+                        continue
+            yield os.path.join(self.spill_dir, name)
+
+    def _read_spill(self):
+        """
+        Reads the next batch of spilled messages to replay, claiming a
+        spill file when none is being replayed. The replay file is only
+        removed by _finish_replay, once its last batch is published.
+        Lines that cannot be parsed, such as one truncated by a crashed
+        writer, are logged and skipped.
+        """
+        if not self.spill_dir:
+            return []
+        while True:
+            if self._replay is None and not self._open_replay():
+                return []
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    line = self._replay.readline()
+                except (IOError, OSError), err:
+                    LOG.error(_("Unable to read spilled notifications: "
+                                "%s") % err)
+                    line = ''
+                if not line:
+                    self._replay_done = True
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    priority, msg = jsonutils.loads(line)
+                except (TypeError, ValueError), err:
+                    self.stats['dropped'] += 1
+                    LOG.error(_("Skipping unreadable spilled notification "
+                                "in %(path)s: %(err)s") %
+                              {'path': self._replay.name, 'err': err})
+                    continue
+                batch.append((priority, msg))
+            if batch:
+                return batch
+            self._finish_replay()
+
+    def _open_replay(self):
+        replay_path = self._claim(self._spill_path())
+        if replay_path is None:
+            for path in self._abandoned_replays():
+                replay_path = self._claim(path)
+                if replay_path is not None:
+                    break
+            else:
+                return False
+        try:
+            self._replay = open(replay_path)
+        except (IOError, OSError), err:
+            LOG.error(_("Unable to replay spilled notifications: %s") % err)
+            return False
+        self._replay_done = False
+        return True
+
+    def _finish_replay(self):
+        """Removes the replay file once all of it has been published."""
+        self._replay.close()
+        try:
+            os.unlink(self._replay.name)
+        except OSError, err:
+            LOG.error(_("Unable to remove replayed notifications: %s") %
+                      err)
+        self._replay = None
+
+    def _respill_replay(self):
+        """
+        Moves the messages of the replay file not read yet back to the
+        spill file, after a failure to publish.
+        """
+        if self._replay is None:
+            return
+        try:
+            with open(self._spill_path(), 'a') as spill:
+                for line in self._replay:
+                    spill.write(line)
+        except (IOError, OSError), err:
+            # The replay file is left for _abandoned_replays to find
+            LOG.error(_("Unable to spill notifications to disk: %s") % err)
+            self._replay.close()
+            self._replay = None
+            return
+        self._finish_replay()
+
+
+def get_dispatcher(strategy_name, strategy_class):
+    """Return the process-wide dispatcher for the given strategy."""
+    if strategy_name not in _DISPATCHERS:
+        _DISPATCHERS[strategy_name] = AsyncDispatcher(
+                strategy_class(),
+                queue_size=CONF.notifier_queue_size,
+                batch_size=CONF.notifier_batch_size,
+                overflow_policy=CONF.notifier_overflow_policy,
+                spill_dir=CONF.notifier_spill_dir)
+    return _DISPATCHERS[strategy_name]
+
+
+class EventRollup(object):
+    """
+    Aggregates INFO notifications of a single event type over an interval
+    and emits one '<event_type>.summary' notification per bucket instead.
+    """
+
+    def __init__(self, notifier, event_type, key_fields, sum_fields,
+                 interval):
+        self.notifier = notifier
+        self.event_type = event_type
+        self.key_fields = key_fields
+        self.sum_fields = sum_fields
+        self.interval = interval
+        self.buckets = {}
+        self.period_start = None
+        self._timer = None
+
+    def add(self, payload):
+        key = tuple(payload.get(field) for field in self.key_fields)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = dict(zip(self.key_fields, key))
+            bucket.update(dict.fromkeys(self.sum_fields, 0))
+            bucket['count'] = 0
+            self.buckets[key] = bucket
+        for field in self.sum_fields:
+            bucket[field] += payload.get(field) or 0
+        bucket['count'] += 1
+
+        if self._timer is None:
+            self.period_start = timeutils.isotime()
+            self._timer = eventlet.spawn_after(self.interval, self.flush)
+
+    def flush(self):
+        """Emit a summary notification for every bucket and reset."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        buckets, self.buckets = self.buckets, {}
+        period_end = timeutils.isotime()
+        for bucket in buckets.values():
+            bucket['period_start'] = self.period_start
+            bucket['period_end'] = period_end
+            self.notifier.send('%s.summary' % self.event_type, 'INFO', bucket)
+
 
 class Notifier(object):
-    """Uses a notification strategy to send out messages about events."""
+    """
+    Uses a notification strategy to send out messages about events.
+
+    Payloads may be given as a callable returning the payload dict, in
+    which case it is only invoked if the notification is actually going to
+    be sent: never for the noop strategy, and only for sampled events.
+    """
 
     def __init__(self, strategy=None):
         _strategy = CONF.notifier_strategy
@@ -61,9 +405,43 @@ class Notifier(object):
             strategy_class = importutils.import_class(strategy)
         except ImportError:
             raise exception.InvalidNotifierStrategy(strategy=strategy)
+
+        if CONF.notifier_async:
+            self.dispatcher = get_dispatcher(strategy, strategy_class)
+            self.strategy = self.dispatcher.strategy
         else:
+            self.dispatcher = None
             self.strategy = strategy_class()
 
+        self.enabled = not isinstance(self.strategy,
+                                      glance.notifier.notify_noop.NoopStrategy)
+        self.sample_rates = self._parse_sample_rates(
+                CONF.notifier_sample_rates)
+        self.rollups = {}
+        for event_type in CONF.notifier_rollup_events:
+            try:
+                key_fields, sum_fields = _ROLLUP_FIELDS[event_type]
+            except KeyError:
+                LOG.warn(_("Rollup is not supported for %s events") %
+                         event_type)
+                continue
+            self.rollups[event_type] = EventRollup(
+                    self, event_type, key_fields, sum_fields,
+                    CONF.notifier_rollup_interval)
+
+    @staticmethod
+    def _parse_sample_rates(entries):
+        """Parse 'event_type:rate' entries into a dict."""
+        rates = {}
+        for entry in entries:
+            try:
+                event_type, rate = entry.rsplit(':', 1)
+                rates[event_type] = float(rate)
+            except ValueError:
+                LOG.warn(_("Ignoring invalid notifier sample rate: %s") %
+                         entry)
+        return rates
+
     @staticmethod
     def generate_message(event_type, priority, payload):
         return {
@@ -75,17 +453,40 @@ class Notifier(object):
             "timestamp": str(timeutils.utcnow()),
         }
 
+    def _notify(self, event_type, priority, payload):
+        if not self.enabled:
+            return
+
+        if priority == 'INFO':
+            rate = self.sample_rates.get(event_type)
+            if rate is not None and random.random() >= rate:
+                return
+
+        if callable(payload):
+            payload = payload()
+
+        rollup = self.rollups.get(event_type)
+        if rollup is not None and priority == 'INFO':
+            rollup.add(payload)
+        else:
+            self.send(event_type, priority, payload)
+
+    def send(self, event_type, priority, payload):
+        """Hand a fully built notification to the strategy."""
+        msg = self.generate_message(event_type, priority, payload)
+        if self.dispatcher is not None:
+            self.dispatcher.put(priority, msg)
+        else:
+            getattr(self.strategy, priority.lower())(msg)
+
     def warn(self, event_type, payload):
-        msg = self.generate_message(event_type, "WARN", payload)
-        self.strategy.warn(msg)
+        self._notify(event_type, "WARN", payload)
 
     def info(self, event_type, payload):
-        msg = self.generate_message(event_type, "INFO", payload)
-        self.strategy.info(msg)
+        self._notify(event_type, "INFO", payload)
 
     def error(self, event_type, payload):
-        msg = self.generate_message(event_type, "ERROR", payload)
-        self.strategy.error(msg)
+        self._notify(event_type, "ERROR", payload)
 
 
 def format_image_notification(image):
@@ -125,15 +526,21 @@ class ImageRepoProxy(glance.domain.ImageRepoProxy):
 
     def save(self, image):
         self.image_repo.save(image)
-        self.notifier.info('image.update', format_image_notification(image))
+        self.notifier.info('image.update',
+                           lambda: format_image_notification(image))
 
     def add(self, image):
         self.image_repo.add(image)
-        self.notifier.info('image.create', format_image_notification(image))
+        self.notifier.info('image.create',
+                           lambda: format_image_notification(image))
 
     def remove(self, image):
         self.image_repo.remove(image)
-        payload = format_image_notification(image)
-        payload['deleted'] = True
-        payload['deleted_at'] = timeutils.isotime()
+
+        def payload():
+            payload = format_image_notification(image)
+            payload['deleted'] = True
+            payload['deleted_at'] = timeutils.isotime()
+            return payload
+
         self.notifier.info('image.delete', payload)
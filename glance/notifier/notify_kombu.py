@@ -214,6 +214,22 @@ class RabbitStrategy(strategy.Strategy):
                 break
         self.log_failure(msg, priority)
 
+    def notify_batch(self, messages):
+        """Send several notifications over one connection attempt.
+
+        If the broker cannot be reached the whole batch is logged as failed
+        rather than paying the reconnect backoff once per message.
+        """
+        self.retry_attempts = 0
+        if not self.connection:
+            try:
+                self.reconnect()
+            except KombuMaxRetriesReached:
+                for priority, msg in messages:
+                    self.log_failure(msg, priority)
+                return
+        super(RabbitStrategy, self).notify_batch(messages)
+
     def warn(self, msg):
         self._notify(msg, "WARN")
 
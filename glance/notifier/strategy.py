@@ -27,3 +27,8 @@ class Strategy(object):
 
     def error(self, msg):
         raise NotImplementedError()
+
+    def notify_batch(self, messages):
+        """Send a sequence of (priority, msg) pairs."""
+        for priority, msg in messages:
+            getattr(self, priority.lower())(msg)
@@ -40,6 +40,10 @@ registry_client_opts = [
     cfg.BoolOpt('registry_client_insecure', default=False),
     cfg.IntOpt('registry_client_timeout', default=600),
     cfg.StrOpt('metadata_encryption_key', secret=True),
+    cfg.StrOpt('registry_client_mode', default='http',
+               help=_("How registry calls are made: 'http' to send them "
+                      "to the registry server, or 'local' to call the "
+                      "registry in-process, using the database directly.")),
 ]
 registry_client_ctx_opts = [
     cfg.StrOpt('admin_user', secret=True),
@@ -59,6 +63,7 @@ _CLIENT_CREDS = None
 _CLIENT_HOST = None
 _CLIENT_PORT = None
 _CLIENT_KWARGS = {}
+_CLIENT_MODE = None
 # AES key used to encrypt 'location' metadata
 _METADATA_ENCRYPTION_KEY = None
 
@@ -68,6 +73,13 @@ def configure_registry_client():
     Sets up a registry client for use in registry lookups
     """
     global _CLIENT_KWARGS, _CLIENT_HOST, _CLIENT_PORT, _METADATA_ENCRYPTION_KEY
+    global _CLIENT_MODE
+    if CONF.registry_client_mode not in ('http', 'local'):
+        msg = (_("Invalid registry_client_mode '%s', must be 'http' or "
+                 "'local'") % CONF.registry_client_mode)
+        LOG.error(msg)
+        raise exception.BadRegistryConnectionConfiguration(msg)
+
     try:
         host, port = CONF.registry_host, CONF.registry_port
     except cfg.ConfigFileValueError:
@@ -79,6 +91,7 @@ def configure_registry_client():
         LOG.error(msg)
         raise exception.BadRegistryConnectionConfiguration(msg)
 
+    _CLIENT_MODE = CONF.registry_client_mode
     _CLIENT_HOST = host
     _CLIENT_PORT = port
     _METADATA_ENCRYPTION_KEY = CONF.metadata_encryption_key
@@ -114,6 +127,8 @@ def configure_registry_admin_creds():
 def get_registry_client(cxt):
     global _CLIENT_CREDS, _CLIENT_KWARGS, _CLIENT_HOST, _CLIENT_PORT
     global _METADATA_ENCRYPTION_KEY
+    if _CLIENT_MODE == 'local':
+        return client.LocalRegistryClient(cxt, _METADATA_ENCRYPTION_KEY)
     kwargs = _CLIENT_KWARGS.copy()
     kwargs['auth_tok'] = cxt.auth_tok
     if _CLIENT_CREDS:
@@ -144,10 +159,12 @@ def add_image_metadata(context, image_meta):
 
 
 def update_image_metadata(context, image_id, image_meta,
-                          purge_props=False):
+                          purge_props=False, from_state=None,
+                          version=None):
     LOG.debug(_("Updating image metadata for image %s..."), image_id)
     c = get_registry_client(context)
-    return c.update_image(image_id, image_meta, purge_props)
+    return c.update_image(image_id, image_meta, purge_props,
+                          from_state=from_state, version=version)
 
 
 def delete_image_metadata(context, image_id):
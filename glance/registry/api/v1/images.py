@@ -339,6 +339,9 @@ class Controller(object):
         # Ensure the image has a status set
         image_data.setdefault('status', 'active')
 
+        # The version is only ever set by the registry
+        image_data.pop('version', None)
+
         # Set up the image owner
         if not req.context.is_admin or 'owner' not in image_data:
             image_data['owner'] = req.context.owner
@@ -383,16 +386,26 @@ class Controller(object):
         if not req.context.is_admin and 'owner' in image_data:
             del image_data['owner']
 
+        # The version is only ever set by the registry
+        image_data.pop('version', None)
+
         purge_props = req.headers.get("X-Glance-Registry-Purge-Props", "false")
+        # Only make the update if the image is still in the given status
+        from_state = req.headers.get("X-Glance-Registry-From-State")
+        # ... and, if given, still at the given version
+        version = req.headers.get("X-Glance-Registry-Version")
+        if version is not None:
+            try:
+                version = int(version)
+            except ValueError:
+                msg = _("Invalid image version: %s") % version
+                return exc.HTTPBadRequest(msg)
         try:
             LOG.debug(_("Updating image %(id)s with metadata: "
                         "%(image_data)r") % locals())
-            if purge_props == "true":
-                updated_image = self.db_api.image_update(req.context, id,
-                                                         image_data, True)
-            else:
-                updated_image = self.db_api.image_update(req.context, id,
-                                                         image_data)
+            updated_image = self.db_api.image_update(
+                req.context, id, image_data, purge_props == "true",
+                version=version, from_state=from_state)
             msg = _("Updating metadata for image %(id)s")
             LOG.info(msg % {'id': id})
             return dict(image=make_image_dict(updated_image))
@@ -401,6 +414,10 @@ class Controller(object):
                      "Got error: %(e)s") % locals())
             LOG.error(msg)
             return exc.HTTPBadRequest(msg)
+        except exception.ImageVersionConflict, e:
+            LOG.info(unicode(e))
+            raise exc.HTTPConflict(unicode(e), request=req,
+                                   content_type='text/plain')
         except exception.NotFound:
             msg = _("Image %(id)s not found")
             LOG.info(msg % {'id': id})
@@ -20,33 +20,30 @@ Simple client class to speak with any RESTful service that implements
 the Glance Registry API
 """
 
+import copy
+import datetime
+import httplib
 import json
+import urllib
+
+import webob.exc
 
 from glance.common.client import BaseClient
 from glance.common import crypt
+from glance.common import exception
+from glance.common import wsgi
 import glance.openstack.common.log as logging
 from glance.registry.api.v1 import images
+from glance.registry.api.v1 import members
 
 LOG = logging.getLogger(__name__)
 
 
-class RegistryClient(BaseClient):
-
-    """A client for the Registry image metadata service"""
+class MetadataEncryptionMixin(object):
 
-    DEFAULT_PORT = 9191
+    """Encrypts and decrypts the 'location' of images kept in the Registry"""
 
-    def __init__(self, host=None, port=None, metadata_encryption_key=None,
-                 **kwargs):
-        """
-        :param metadata_encryption_key: Key used to encrypt 'location' metadata
-        """
-        self.metadata_encryption_key = metadata_encryption_key
-        # NOTE (dprince): by default base client overwrites host and port
-        # settings when using keystone. configure_via_auth=False disables
-        # this behaviour to ensure we still send requests to the Registry API
-        BaseClient.__init__(self, host, port, configure_via_auth=False,
-                            **kwargs)
+    metadata_encryption_key = None
 
     def decrypt_metadata(self, image_metadata):
         if (self.metadata_encryption_key is not None and
@@ -66,6 +63,25 @@ class RegistryClient(BaseClient):
             image_metadata['location'] = location
         return image_metadata
 
+
+class RegistryClient(BaseClient, MetadataEncryptionMixin):
+
+    """A client for the Registry image metadata service"""
+
+    DEFAULT_PORT = 9191
+
+    def __init__(self, host=None, port=None, metadata_encryption_key=None,
+                 **kwargs):
+        """
+        :param metadata_encryption_key: Key used to encrypt 'location' metadata
+        """
+        self.metadata_encryption_key = metadata_encryption_key
+        # NOTE (dprince): by default base client overwrites host and port
+        # settings when using keystone. configure_via_auth=False disables
+        # this behaviour to ensure we still send requests to the Registry API
+        BaseClient.__init__(self, host, port, configure_via_auth=False,
+                            **kwargs)
+
     def get_images(self, **kwargs):
         """
         Returns a list of image id/name mappings from Registry
@@ -145,9 +161,15 @@ class RegistryClient(BaseClient):
         image = data['image']
         return self.decrypt_metadata(image)
 
-    def update_image(self, image_id, image_metadata, purge_props=False):
+    def update_image(self, image_id, image_metadata, purge_props=False,
+                     from_state=None, version=None):
         """
         Updates Registry's information about an image
+
+        :param from_state: If given, the update is only made if the image is
+                           still in this status
+        :param version: If given, the update is only made if the image is
+                        still at this version, as returned by the registry
         """
         if 'image' not in image_metadata:
             image_metadata = dict(image=image_metadata)
@@ -162,6 +184,10 @@ class RegistryClient(BaseClient):
 
         if purge_props:
             headers["X-Glance-Registry-Purge-Props"] = "true"
+        if from_state:
+            headers["X-Glance-Registry-From-State"] = from_state
+        if version is not None:
+            headers["X-Glance-Registry-Version"] = str(version)
 
         res = self.do_request("PUT", "/images/%s" % image_id, body=body,
                               headers=headers)
@@ -225,3 +251,212 @@ class RegistryClient(BaseClient):
         res = self.do_request("DELETE", "/images/%s/members/%s" %
                               (image_id, member_id))
         return self.get_status_code(res) == 204
+
+
+class LocalRegistryClient(MetadataEncryptionMixin):
+
+    """
+    A client for the Registry that calls its controllers in the calling
+    process, with the caller's request context, instead of over HTTP.
+    Results and exceptions are the same as those of RegistryClient.
+    """
+
+    # Mapping of the error statuses of the controllers to the exceptions
+    # raised for them by BaseClient
+    ERRORS = {
+        httplib.UNAUTHORIZED: exception.NotAuthenticated,
+        httplib.FORBIDDEN: exception.Forbidden,
+        httplib.NOT_FOUND: exception.NotFound,
+        httplib.CONFLICT: exception.Duplicate,
+        httplib.BAD_REQUEST: exception.Invalid,
+    }
+
+    _images = None
+    _members = None
+
+    def __init__(self, context, metadata_encryption_key=None):
+        """
+        :param context: Request context the Registry calls are made with
+        :param metadata_encryption_key: Key used to encrypt 'location' metadata
+        """
+        self.context = context
+        self.auth_tok = context.auth_tok
+        self.metadata_encryption_key = metadata_encryption_key
+        if LocalRegistryClient._images is None:
+            LocalRegistryClient._images = images.Controller()
+            LocalRegistryClient._members = members.Controller()
+
+    def _call(self, action, *args, **kwargs):
+        """
+        Calls a controller action as the Registry server would for a
+        request, returning its result or raising the exception
+        RegistryClient raises for its response.
+        """
+        params = kwargs.pop('params', {})
+        headers = kwargs.pop('headers', {})
+        if 'body' in kwargs:
+            # The controllers may change the request body
+            kwargs['body'] = copy.deepcopy(kwargs['body'])
+
+        query = urllib.urlencode(dict((k, v) for k, v in params.items()
+                                      if v is not None))
+        req = wsgi.Request.blank('/?%s' % query, headers=headers)
+        # The Registry server creates a context for each request, which
+        # the controllers may change
+        req.context = copy.copy(self.context)
+
+        try:
+            result = action(req, *args, **kwargs)
+        except webob.exc.HTTPException, e:
+            result = e
+        except Exception, e:
+            LOG.exception(_("Registry call %(action)s raised %(e)r") %
+                          {'action': action.__name__, 'e': e})
+            raise exception.ServerError()
+
+        if isinstance(result, webob.exc.HTTPException):
+            status = result.status_int
+            if status in self.ERRORS:
+                raise self.ERRORS[status](result.detail or
+                                          result.explanation)
+            elif status >= 300:
+                raise exception.UnexpectedStatus(status=status,
+                                                 body=result.detail)
+            return result
+        return _to_primitive(result)
+
+    def get_images(self, **kwargs):
+        """
+        Returns a list of image id/name mappings from Registry
+
+        :param filters: dict of keys & expected values to filter results
+        :param marker: image id after which to start page
+        :param limit: max number of images to return
+        :param sort_key: results will be ordered by this image attribute
+        :param sort_dir: direction in which to to order results (asc, desc)
+        """
+        params = _extract_params(kwargs)
+        image_list = self._call(self._images.index, params=params)['images']
+        return [self.decrypt_metadata(image) for image in image_list]
+
+    def get_images_detailed(self, **kwargs):
+        """
+        Returns a list of detailed image data mappings from Registry
+
+        :param filters: dict of keys & expected values to filter results
+        :param marker: image id after which to start page
+        :param limit: max number of images to return
+        :param sort_key: results will be ordered by this image attribute
+        :param sort_dir: direction in which to to order results (asc, desc)
+        """
+        params = _extract_params(kwargs)
+        image_list = self._call(self._images.detail, params=params)['images']
+        return [self.decrypt_metadata(image) for image in image_list]
+
+    def get_image(self, image_id):
+        """Returns a mapping of image metadata from Registry"""
+        data = self._call(self._images.show, image_id)['image']
+        return self.decrypt_metadata(data)
+
+    def add_image(self, image_metadata):
+        """
+        Tells registry about an image's metadata
+        """
+        if 'image' not in image_metadata:
+            image_metadata = dict(image=image_metadata)
+        body = copy.deepcopy(image_metadata)
+        self.encrypt_metadata(body['image'])
+
+        image = self._call(self._images.create, body=body)['image']
+        return self.decrypt_metadata(image)
+
+    def update_image(self, image_id, image_metadata, purge_props=False,
+                     from_state=None, version=None):
+        """
+        Updates Registry's information about an image
+
+        :param from_state: If given, the update is only made if the image is
+                           still in this status
+        :param version: If given, the update is only made if the image is
+                        still at this version, as returned by the registry
+        """
+        if 'image' not in image_metadata:
+            image_metadata = dict(image=image_metadata)
+        body = copy.deepcopy(image_metadata)
+        self.encrypt_metadata(body['image'])
+
+        headers = {}
+        if purge_props:
+            headers["X-Glance-Registry-Purge-Props"] = "true"
+        if from_state:
+            headers["X-Glance-Registry-From-State"] = from_state
+        if version is not None:
+            headers["X-Glance-Registry-Version"] = str(version)
+
+        image = self._call(self._images.update, image_id, body=body,
+                           headers=headers)['image']
+        return self.decrypt_metadata(image)
+
+    def delete_image(self, image_id):
+        """
+        Deletes Registry's information about an image
+        """
+        return self._call(self._images.delete, image_id)['image']
+
+    def get_image_members(self, image_id):
+        """Returns a list of membership associations from Registry"""
+        return self._call(self._members.index, image_id)['members']
+
+    def get_member_images(self, member_id):
+        """Returns a list of membership associations from Registry"""
+        return self._call(self._members.index_shared_images,
+                          member_id)['shared_images']
+
+    def replace_members(self, image_id, member_data):
+        """Replaces Registry's information about image membership"""
+        if isinstance(member_data, (list, tuple)):
+            member_data = dict(memberships=list(member_data))
+        elif (isinstance(member_data, dict) and
+              'memberships' not in member_data):
+            member_data = dict(memberships=[member_data])
+
+        res = self._call(self._members.update_all, image_id, body=member_data)
+        return res.status_int == 204
+
+    def add_member(self, image_id, member_id, can_share=None):
+        """Adds to Registry's information about image membership"""
+        body = None
+        if can_share is not None:
+            body = dict(member=dict(can_share=can_share))
+
+        res = self._call(self._members.update, image_id, member_id,
+                         body=body)
+        return res.status_int == 204
+
+    def delete_member(self, image_id, member_id):
+        """Deletes Registry's information about image membership"""
+        res = self._call(self._members.delete, image_id, member_id)
+        return res.status_int == 204
+
+
+def _extract_params(kwargs):
+    """Returns the filters and paging parameters of a list call."""
+    params = dict(kwargs.get('filters') or {})
+    for param in images.SUPPORTED_PARAMS:
+        if param in kwargs:
+            params[param] = kwargs[param]
+    return params
+
+
+def _to_primitive(data):
+    """
+    Converts the datetimes in controller results to strings, as they are
+    when serialized by the Registry server.
+    """
+    if isinstance(data, dict):
+        return dict((k, _to_primitive(v)) for k, v in data.iteritems())
+    elif isinstance(data, list):
+        return [_to_primitive(v) for v in data]
+    elif isinstance(data, datetime.datetime):
+        return data.isoformat()
+    return data
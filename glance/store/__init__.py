@@ -15,6 +15,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import os
 import sys
 import time
@@ -48,6 +49,24 @@ store_opts = [
                default='/var/lib/glance/scrubber'),
     cfg.BoolOpt('delayed_delete', default=False),
     cfg.IntOpt('scrub_time', default=0),
+    cfg.BoolOpt('delayed_import', default=False,
+                help=_("Queue copy-from imports for the glance-importer "
+                       "service instead of copying the image data in the "
+                       "API server.")),
+    cfg.StrOpt('importer_datadir',
+               default='/var/lib/glance/importer',
+               help=_("Directory holding the import queue, in which "
+                      "glance-importer also stages the data of the images "
+                      "it imports. It needs free space for the full size "
+                      "of up to importer_workers images.")),
+    cfg.BoolOpt('sparse_uploads', default=True,
+                help=_("Skip writing chunks of uploaded image data that "
+                       "consist entirely of zero bytes, in stores that "
+                       "support sparse images (filesystem and rbd).")),
+    cfg.IntOpt('store_cache_size', default=100,
+               help=_("Maximum number of configured store instances to "
+                      "keep for reuse across requests. Set to 0 to "
+                      "construct a new store object for every operation.")),
 ]
 
 CONF = cfg.CONF
@@ -126,6 +145,53 @@ class Indexable(object):
         return self.size
 
 
+class StoreCache(object):
+    """
+    Keeps configured store instances, evicting the least recently used
+    entry once ``store_cache_size`` instances are held.
+
+    Stores that do not depend on the request context are shared by every
+    caller; context-scoped stores (``Store.context_scoped``) are kept per
+    tenant, user and auth token.
+    """
+
+    def __init__(self):
+        self.stores = collections.OrderedDict()
+
+    def clear(self):
+        self.stores.clear()
+
+    def get(self, key):
+        try:
+            store = self.stores.pop(key)
+        except KeyError:
+            return None
+        self.stores[key] = store
+        return store
+
+    def set(self, key, store):
+        self.stores.pop(key, None)
+        self.stores[key] = store
+        while len(self.stores) > max(CONF.store_cache_size, 0):
+            self.stores.popitem(last=False)
+
+
+_STORE_CACHE = StoreCache()
+
+
+def _location_credentials(loc):
+    """Returns the credentials embedded in a location, if any."""
+    store_location = getattr(loc, 'store_location', None)
+    return (getattr(store_location, 'user', None),
+            getattr(store_location, 'key', None))
+
+
+def _context_credentials(context):
+    if context is None:
+        return None
+    return (context.tenant, context.user, context.auth_tok)
+
+
 def _get_store_class(store_entry):
     store_cls = None
     try:
@@ -143,6 +209,7 @@ def create_stores():
     Registers all store modules and all schemes
     from the given config. Duplicates are not re-registered.
     """
+    _STORE_CACHE.clear()
     store_count = 0
     store_classes = set()
     for store_entry in CONF.known_stores:
@@ -192,8 +259,19 @@ def get_store_from_scheme(context, scheme, loc=None):
     """
     if scheme not in location.SCHEME_TO_CLS_MAP:
         raise exception.UnknownScheme(scheme=scheme)
-    scheme_info = location.SCHEME_TO_CLS_MAP[scheme]
-    store = scheme_info['store_class'](context, loc)
+    store_cls = location.SCHEME_TO_CLS_MAP[scheme]['store_class']
+    if CONF.store_cache_size <= 0:
+        return store_cls(context, loc)
+
+    shared_key = (scheme, store_cls, _location_credentials(loc))
+    scoped_key = shared_key + (_context_credentials(context),)
+    store = _STORE_CACHE.get(shared_key) or _STORE_CACHE.get(scoped_key)
+    if store is None:
+        store = store_cls(context, loc)
+        if store.context_scoped:
+            _STORE_CACHE.set(scoped_key, store)
+        else:
+            _STORE_CACHE.set(shared_key, store)
     return store
 
 
@@ -29,6 +29,10 @@ class Store(object):
 
     CHUNKSIZE = (16 * 1024 * 1024)  # 16M
 
+    # Stores whose configuration depends on the request context (e.g. the
+    # caller's credentials) must not be shared between requests.
+    context_scoped = False
+
     def __init__(self, context=None, location=None):
         """
         Initialize the Store
@@ -123,6 +127,40 @@ class Store(object):
         :retval tuple of URL in backing store, bytes written, and checksum
         :raises `glance.common.exception.Duplicate` if the image already
                 existed
+
+        :note Stores that leave all-zero chunks unwritten add the number
+              of bytes skipped to `image_file.sparse_bytes`, if present.
+        """
+        raise NotImplementedError
+
+    def get_range(self, location, offset):
+        """
+        Takes a `glance.store.location.Location` object that indicates
+        where to find the image file, and returns a tuple of generator
+        yielding the image data from byte `offset` onwards, and the
+        number of bytes it will yield. Stores that cannot read from an
+        offset raise NotImplementedError.
+
+        :param location `glance.store.location.Location` object, supplied
+                        from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        """
+        raise NotImplementedError
+
+    def clone(self, image_id, location):
+        """
+        Stores a copy of the image found at `location`, which must belong
+        to this store, without transferring its data through Glance.
+        Stores that cannot do so raise NotImplementedError, in which case
+        the data should be copied with add() instead.
+
+        :param image_id: The opaque image identifier
+        :param location: `glance.store.location.Location` of the source
+
+        :retval tuple of URL in backing store, image size, and checksum
+                (None if the data was not read)
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
         """
         raise NotImplementedError
 
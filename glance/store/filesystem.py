@@ -34,10 +34,47 @@ import glance.store.location
 
 LOG = logging.getLogger(__name__)
 
-datadir_opt = cfg.StrOpt('filesystem_store_datadir')
+filesystem_opts = [
+    cfg.StrOpt('filesystem_store_datadir'),
+    cfg.MultiStrOpt('filesystem_store_datadirs',
+                    help=_("Directories in which to store images, each "
+                           "optionally followed by ':<priority>'. New "
+                           "images go to the highest priority directory "
+                           "with room for them, preferring the one with "
+                           "the most free space among equal priorities. "
+                           "Mutually exclusive with "
+                           "filesystem_store_datadir.")),
+    cfg.IntOpt('filesystem_store_subdir_levels', default=0,
+               help=_("Number of levels of subdirectories, named after "
+                      "two hex digits of a hash of the image ID, under "
+                      "which new image files are placed. 0 stores them "
+                      "directly in the data directory.")),
+    cfg.BoolOpt('filesystem_store_preallocate', default=False,
+                help=_("Allocate the disk space for an image of known size "
+                       "before writing it, reducing fragmentation. This "
+                       "also allocates the ranges that sparse_uploads "
+                       "leaves unwritten.")),
+    cfg.IntOpt('filesystem_store_write_chunk_size', default=1024,
+               help=_("Size, in KiB, of the aligned chunks in which image "
+                      "data is written.")),
+    cfg.StrOpt('filesystem_store_sync', default='none',
+               help=_("When to flush written image data to disk: 'none' "
+                      "leaves it to the operating system, 'end' syncs "
+                      "once the image is written and 'periodic' also "
+                      "syncs every filesystem_store_sync_interval MiB.")),
+    cfg.IntOpt('filesystem_store_sync_interval', default=64,
+               help=_("Amount of data, in MiB, written between syncs "
+                      "with filesystem_store_sync = periodic.")),
+    cfg.BoolOpt('filesystem_store_drop_cache', default=True,
+                help=_("Advise the kernel to drop image data from the "
+                       "page cache once it has been synced to disk.")),
+]
+
+SYNC_POLICIES = ('none', 'end', 'periodic')
 
 CONF = cfg.CONF
-CONF.register_opt(datadir_opt)
+CONF.register_opts(filesystem_opts)
+CONF.import_opt('sparse_uploads', 'glance.store')
 
 
 class StoreLocation(glance.store.location.StoreLocation):
@@ -84,12 +121,9 @@ class ChunkedFile(object):
     def __iter__(self):
         """Return an iterator over the image file"""
         try:
-            while True:
-                chunk = self.fp.read(ChunkedFile.CHUNKSIZE)
-                if chunk:
-                    yield chunk
-                else:
-                    break
+            for chunk in utils.sparse_chunkiter(self.fp,
+                                                ChunkedFile.CHUNKSIZE):
+                yield chunk
         finally:
             self.close()
 
@@ -112,31 +146,107 @@ class Store(glance.store.base.Store):
         this method. If the store was not able to successfully configure
         itself, it should raise `exception.BadStoreConfiguration`
         """
-        self.datadir = CONF.filesystem_store_datadir
-        if self.datadir is None:
+        if CONF.filesystem_store_datadir and CONF.filesystem_store_datadirs:
+            reason = (_("Specify at most one of %s or %s.") %
+                      ('filesystem_store_datadir',
+                       'filesystem_store_datadirs'))
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="filesystem",
+                                                  reason=reason)
+
+        if CONF.filesystem_store_datadirs:
+            self.datadirs = self._parse_datadirs(
+                CONF.filesystem_store_datadirs)
+        elif CONF.filesystem_store_datadir:
+            self.datadirs = [(CONF.filesystem_store_datadir, 0)]
+        else:
             reason = (_("Could not find %s in configuration options.") %
                       'filesystem_store_datadir')
             LOG.error(reason)
             raise exception.BadStoreConfiguration(store_name="filesystem",
                                                   reason=reason)
 
-        if not os.path.exists(self.datadir):
+        if CONF.filesystem_store_sync not in SYNC_POLICIES:
+            reason = (_("filesystem_store_sync must be one of %s") %
+                      ', '.join(SYNC_POLICIES))
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="filesystem",
+                                                  reason=reason)
+
+        self.datadir = self.datadirs[0][0]
+        for datadir, priority in self.datadirs:
+            self._create_datadir(datadir)
+
+    @staticmethod
+    def _parse_datadirs(entries):
+        """
+        Parses `<path>[:<priority>]` entries into a list of (path,
+        priority) pairs, highest priority first.
+        """
+        datadirs = []
+        for entry in entries:
+            path, sep, priority = entry.strip().rpartition(':')
+            if not sep or not priority.isdigit():
+                path, priority = entry.strip(), 0
+            if path in [datadir for datadir, _priority in datadirs]:
+                reason = _("Directory %s specified multiple times.") % path
+                LOG.error(reason)
+                raise exception.BadStoreConfiguration(
+                    store_name="filesystem", reason=reason)
+            datadirs.append((path, int(priority)))
+        datadirs.sort(key=lambda datadir: -datadir[1])
+        return datadirs
+
+    @staticmethod
+    def _create_datadir(datadir):
+        if not os.path.exists(datadir):
             msg = _("Directory to write image files does not exist "
-                    "(%s). Creating.") % self.datadir
+                    "(%s). Creating.") % datadir
             LOG.info(msg)
             try:
-                os.makedirs(self.datadir)
+                os.makedirs(datadir)
             except (IOError, OSError):
-                if os.path.exists(self.datadir):
+                if os.path.exists(datadir):
                     # NOTE(markwash): If the path now exists, some other
                     # process must have beat us in the race condition. But it
                     # doesn't hurt, so we can safely ignore the error.
                     return
-                reason = _("Unable to create datadir: %s") % self.datadir
+                reason = _("Unable to create datadir: %s") % datadir
                 LOG.error(reason)
                 raise exception.BadStoreConfiguration(store_name="filesystem",
                                                       reason=reason)
 
+    @staticmethod
+    def _get_free_space(datadir):
+        try:
+            stat = os.statvfs(datadir)
+        except OSError:
+            return 0
+        return stat.f_bavail * stat.f_frsize
+
+    def _select_datadir(self, image_size):
+        """
+        Chooses the directory for a new image: the one with the most free
+        space among the highest priority directories that can hold
+        `image_size` bytes, or the roomiest of all if none can.
+        """
+        if len(self.datadirs) == 1:
+            return self.datadir
+
+        candidates = [(datadir, priority, self._get_free_space(datadir))
+                      for datadir, priority in self.datadirs]
+        fitting = [c for c in candidates if c[2] >= (image_size or 0)]
+        if not fitting:
+            return max(candidates, key=lambda c: c[2])[0]
+        top = max(c[1] for c in fitting)
+        return max([c for c in fitting if c[1] == top],
+                   key=lambda c: c[2])[0]
+
+    @staticmethod
+    def _get_subdirs(image_id, levels):
+        digest = hashlib.md5(str(image_id)).hexdigest()
+        return [digest[2 * i:2 * i + 2] for i in range(levels)]
+
     @staticmethod
     def _resolve_location(location):
         filepath = location.store_location.path
@@ -215,26 +325,56 @@ class Store(glance.store.base.Store):
 
         :note By default, the backend writes the image data to a file
               `/<DATADIR>/<ID>`, where <DATADIR> is the value of
-              the filesystem_store_datadir configuration option and <ID>
-              is the supplied image ID.
+              the filesystem_store_datadir configuration option (or the
+              directory chosen from filesystem_store_datadirs) and <ID>
+              is the supplied image ID. With filesystem_store_subdir_levels
+              set, the file is placed in hashed subdirectories such as
+              `/<DATADIR>/ab/cd/<ID>`.
         """
 
-        filepath = os.path.join(self.datadir, str(image_id))
+        datadir = self._select_datadir(image_size)
+        levels = CONF.filesystem_store_subdir_levels
+        if levels > 0:
+            datadir = os.path.join(datadir,
+                                   *self._get_subdirs(image_id, levels))
+            utils.safe_mkdirs(datadir)
+        filepath = os.path.join(datadir, str(image_id))
 
         if os.path.exists(filepath):
             raise exception.Duplicate(_("Image file %s already exists!")
                                       % filepath)
 
+        chunk_size = CONF.filesystem_store_write_chunk_size * 1024
+        sync = CONF.filesystem_store_sync
+        sync_interval = CONF.filesystem_store_sync_interval * 1024 * 1024
         checksum = hashlib.md5()
         bytes_written = 0
+        bytes_skipped = 0
+        bytes_synced = 0
         try:
             with open(filepath, 'wb') as f:
-                for buf in utils.chunkreadable(image_file,
-                                               ChunkedFile.CHUNKSIZE):
+                if CONF.filesystem_store_preallocate and image_size > 0:
+                    utils.fallocate(f.fileno(), 0, image_size)
+                chunks = utils.chunkreadable(image_file, chunk_size)
+                for buf in utils.rechunk(chunks, chunk_size):
                     bytes_written += len(buf)
                     checksum.update(buf)
-                    f.write(buf)
-        except IOError as e:
+                    if CONF.sparse_uploads and utils.is_zero_block(buf):
+                        # Leave a hole, which reads back as zeros
+                        f.seek(len(buf), os.SEEK_CUR)
+                        bytes_skipped += len(buf)
+                    else:
+                        f.write(buf)
+                    if (sync == 'periodic' and
+                            bytes_written - bytes_synced >= sync_interval):
+                        self._sync(f, bytes_synced, bytes_written)
+                        bytes_synced = bytes_written
+                if bytes_skipped:
+                    # Extend the file over any trailing hole
+                    f.truncate(bytes_written)
+                if sync != 'none':
+                    self._sync(f, bytes_synced, bytes_written)
+        except (IOError, OSError) as e:
             if e.errno != errno.EACCES:
                 self._delete_partial(filepath, image_id)
             exceptions = {errno.EFBIG: exception.StorageFull(),
@@ -246,11 +386,26 @@ class Store(glance.store.base.Store):
             raise
 
         checksum_hex = checksum.hexdigest()
+        if hasattr(image_file, 'sparse_bytes'):
+            image_file.sparse_bytes += bytes_skipped
 
         LOG.debug(_("Wrote %(bytes_written)d bytes to %(filepath)s with "
-                    "checksum %(checksum_hex)s") % locals())
+                    "checksum %(checksum_hex)s, skipping %(bytes_skipped)d "
+                    "bytes of zeros") % locals())
         return ('file://%s' % filepath, bytes_written, checksum_hex)
 
+    @staticmethod
+    def _sync(f, start, end):
+        """
+        Flushes the byte range [start, end) of an image file being
+        written to disk, then drops it from the page cache if configured.
+        """
+        f.flush()
+        utils.fdatasync(f.fileno())
+        if CONF.filesystem_store_drop_cache:
+            utils.fadvise(f.fileno(), start, end - start,
+                          utils.POSIX_FADV_DONTNEED)
+
     @staticmethod
     def _delete_partial(filepath, id):
         try:
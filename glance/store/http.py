@@ -15,10 +15,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import httplib
+import time
 import urlparse
 
+import eventlet
+
 from glance.common import exception
+from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
 import glance.store.base
 import glance.store.location
@@ -27,6 +32,83 @@ LOG = logging.getLogger(__name__)
 
 
 MAX_REDIRECTS = 5
+MAX_CACHED_REDIRECTS = 256
+
+http_opts = [
+    cfg.IntOpt('http_store_parallel_connections', default=4,
+               help=_("Number of connections used to download an image in "
+                      "ranges from servers that support ranged requests. "
+                      "1 downloads over a single connection.")),
+    cfg.IntOpt('http_store_range_size', default=8 * 1024,
+               help=_("Size, in KiB, of each range requested by a parallel "
+                      "download.")),
+    cfg.IntOpt('http_store_reorder_buffer', default=64,
+               help=_("Maximum amount of image data, in MiB, that a "
+                      "parallel download fetches ahead of the data read "
+                      "so far.")),
+    cfg.IntOpt('http_store_redirect_cache_ttl', default=300,
+               help=_("Number of seconds for which the target of a "
+                      "redirect is remembered, so that later requests for "
+                      "the same URL go to it directly, and for which the "
+                      "size of the image is remembered. 0 disables the "
+                      "cache.")),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(http_opts)
+
+# Map image URLs to the Location they were last redirected to, and to the
+# size of the image learnt from an earlier response, along with the time at
+# which each entry expires
+_REDIRECTS = collections.OrderedDict()
+_SIZES = collections.OrderedDict()
+
+
+def _cache_put(cache, uri, value):
+    ttl = CONF.http_store_redirect_cache_ttl
+    if ttl <= 0:
+        return
+    cache.pop(uri, None)
+    cache[uri] = (value, time.time() + ttl)
+    while len(cache) > MAX_CACHED_REDIRECTS:
+        cache.popitem(last=False)
+
+
+def _cache_get(cache, uri):
+    value, expires = cache.get(uri, (None, 0))
+    if expires < time.time():
+        cache.pop(uri, None)
+        return None
+    return value
+
+
+def _cache_redirect(uri, location):
+    _cache_put(_REDIRECTS, uri, location)
+
+
+def _cached_redirect(uri):
+    return _cache_get(_REDIRECTS, uri)
+
+
+def _cache_size(uri, size):
+    if size is not None:
+        _cache_put(_SIZES, uri, size)
+
+
+def _cached_size(uri):
+    return _cache_get(_SIZES, uri)
+
+
+def _content_range_total(response):
+    """
+    Returns the full size of the resource given in the Content-Range
+    header of a partial response, or None if it is missing or unknown.
+    """
+    content_range = response.getheader('content-range', '')
+    try:
+        return int(content_range.rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return None
 
 
 class StoreLocation(glance.store.location.StoreLocation):
@@ -121,9 +203,7 @@ class Store(glance.store.base.Store):
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
         """
-        conn, resp, content_length = self._query(location, 'GET')
-
-        iterator = http_response_iterator(conn, resp, self.CHUNKSIZE)
+        iterator, content_length = self._get(location)
 
         class ResponseIndexable(glance.store.Indexable):
             def another(self):
@@ -134,33 +214,191 @@ class Store(glance.store.base.Store):
 
         return (ResponseIndexable(iterator, content_length), content_length)
 
+    def get_range(self, location, offset):
+        """
+        Takes a `glance.store.location.Location` object that indicates
+        where to find the image file, and returns a tuple of generator
+        yielding the image data from byte `offset` onwards, and the
+        number of bytes it will yield.
+
+        :param location `glance.store.location.Location` object, supplied
+                        from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        """
+        return self._get(location, offset)
+
+    def _get(self, location, offset=0, parallel=True):
+        """
+        Starts reading the image data from byte `offset` onwards. When
+        the server answers a ranged request for the first
+        ``http_store_range_size`` KiB with a partial response, the size of
+        the image is taken from it and the rest is downloaded in ranges
+        over several connections.
+
+        :retval tuple of generator and the number of bytes it will yield
+        :raises NotImplementedError if `offset` is not 0 and the server
+                does not support ranged requests
+        """
+        uri = location.get_store_uri()
+        parallel = parallel and CONF.http_store_parallel_connections > 1
+        range_size = CONF.http_store_range_size * 1024
+        if parallel:
+            headers = {'Range': 'bytes=%d-%d' % (offset,
+                                                 offset + range_size - 1)}
+        elif offset:
+            headers = {'Range': 'bytes=%d-' % offset}
+        else:
+            headers = {}
+        conn, resp, content_length, location = self._query(location, 'GET',
+                                                           headers)
+
+        if resp.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+            # There is no data at or after offset
+            conn.close()
+            return (iter([]), 0)
+        if resp.status != httplib.PARTIAL_CONTENT:
+            if offset:
+                # The server ignored the Range header
+                conn.close()
+                raise NotImplementedError
+            if resp.getheader('content-length') is not None:
+                _cache_size(uri, content_length)
+            return (http_response_iterator(conn, resp, self.CHUNKSIZE),
+                    content_length)
+
+        total = _content_range_total(resp)
+        _cache_size(uri, total)
+        if not parallel:
+            return (http_response_iterator(conn, resp, self.CHUNKSIZE),
+                    content_length)
+        if total is None:
+            conn.close()
+            return self._get(location, offset, parallel=False)
+        iterator = self._ranged_iterator(conn, resp, location,
+                                         offset + content_length, total)
+        return (iterator, total - offset)
+
+    def _ranged_iterator(self, conn, resp, location, start, total):
+        """
+        Yields the data of `resp`, which ends at byte `start` of the
+        image, followed by the rest of the image up to `total` bytes.
+        The remaining ranges are fetched over up to
+        ``http_store_parallel_connections`` further connections, at most
+        ``http_store_reorder_buffer`` MiB ahead of the data yielded, and
+        yielded in order.
+        """
+        range_size = CONF.http_store_range_size * 1024
+        parallel = CONF.http_store_parallel_connections
+        window = max(CONF.http_store_reorder_buffer * 1024 * 1024 //
+                     range_size, parallel)
+        pool = eventlet.greenpool.GreenPool(parallel)
+        pending = collections.deque()
+
+        def fill(start):
+            while start < total and len(pending) < window and pool.free():
+                end = min(start + range_size, total)
+                pending.append(pool.spawn(self._fetch_range, location,
+                                          start, end))
+                start = end
+            return start
+
+        try:
+            start = fill(start)
+            for chunk in http_response_iterator(conn, resp, self.CHUNKSIZE):
+                start = fill(start)
+                yield chunk
+            while pending:
+                chunk = pending.popleft().wait()
+                start = fill(start)
+                yield chunk
+        finally:
+            for thread in pending:
+                thread.kill()
+            conn.close()
+
+    def _fetch_range(self, location, start, end):
+        """Returns bytes `start` to `end` (exclusive) of the image."""
+        loc = location.store_location
+        conn = self._get_conn_class(loc)(loc.netloc)
+        try:
+            conn.request('GET', loc.path, "",
+                         {'Range': 'bytes=%d-%d' % (start, end - 1)})
+            resp = conn.getresponse()
+            if resp.status != httplib.PARTIAL_CONTENT:
+                reason = (_("HTTP URL returned a %s status code to a "
+                            "ranged request.") % resp.status)
+                raise exception.BadStoreUri(loc.path, reason)
+            data = resp.read(end - start)
+        finally:
+            conn.close()
+        if len(data) != end - start:
+            msg = (_("Expected %(expected)d bytes from HTTP URL, got "
+                     "%(got)d") % {'expected': end - start, 'got': len(data)})
+            raise IOError(msg)
+        return data
+
     def get_schemes(self):
         return ('http', 'https')
 
     def get_size(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
-        where to find the image file, and returns the size
+        where to find the image file, and returns the size. A HEAD request
+        is only sent if the size was not learnt from a recent response.
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
         """
+        uri = location.get_store_uri()
+        size = _cached_size(uri)
+        if size is not None:
+            return size
         try:
-            return self._query(location, 'HEAD')[2]
+            conn, resp, size = self._query(location, 'HEAD')[:3]
         except Exception:
             return 0
+        conn.close()
+        if resp.getheader('content-length') is not None:
+            _cache_size(uri, size)
+        return size
+
+    def _query(self, location, verb, headers=None):
+        """
+        Sends a request for the image, following redirects, and going
+        straight to the target of a recently followed redirect.
+
+        :retval tuple of connection, response, content length and the
+                location that answered
+        """
+        uri = location.get_store_uri()
+        target = _cached_redirect(uri)
+        if target is not None:
+            try:
+                return self._follow(target, verb, headers)
+            except (exception.GlanceException, EnvironmentError,
+                    httplib.HTTPException):
+                LOG.debug(_("Request to cached redirect target failed, "
+                            "resolving redirects again"))
+                _REDIRECTS.pop(uri, None)
+
+        result = self._follow(location, verb, headers)
+        if result[3] is not location:
+            _cache_redirect(uri, result[3])
+        return result
 
-    def _query(self, location, verb, depth=0):
+    def _follow(self, location, verb, headers=None, depth=0):
         if depth > MAX_REDIRECTS:
             raise exception.MaxRedirectsExceeded(redirects=MAX_REDIRECTS)
         loc = location.store_location
         conn_class = self._get_conn_class(loc)
         conn = conn_class(loc.netloc)
-        conn.request(verb, loc.path, "", {})
+        conn.request(verb, loc.path, "", headers or {})
         resp = conn.getresponse()
 
         # Check for bad status codes
-        if resp.status >= 400:
+        range_error = (resp.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE
+                       and 'Range' in (headers or {}))
+        if resp.status >= 400 and not range_error:
             reason = _("HTTP URL returned a %s status code.") % resp.status
             raise exception.BadStoreUri(loc.path, reason)
 
@@ -176,9 +414,9 @@ class Store(glance.store.base.Store):
                                      uri=location_header,
                                      image_id=location.image_id,
                                      store_specs=location.store_specs)
-            return self._query(new_loc, verb, depth + 1)
+            return self._follow(new_loc, verb, headers, depth + 1)
         content_length = int(resp.getheader('content-length', 0))
-        return (conn, resp, content_length)
+        return (conn, resp, content_length, location)
 
     def _get_conn_class(self, loc):
         """
@@ -0,0 +1,453 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Background import of copy-from images.
+
+When ``delayed_import`` is enabled, the API server writes one queue file
+per image to ``importer_datadir`` instead of copying the image data
+itself, and the glance-importer service works through the queue.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import time
+import urlparse
+
+import eventlet
+
+from glance.common import crypt
+from glance.common import exception
+from glance.common import utils
+from glance import context
+from glance import notifier
+from glance.openstack.common import cfg
+import glance.openstack.common.log as logging
+from glance import registry
+from glance import store
+from glance.store import location
+
+LOG = logging.getLogger(__name__)
+
+importer_opts = [
+    cfg.IntOpt('importer_workers', default=4,
+               help=_("Maximum number of images to import concurrently.")),
+    cfg.IntOpt('importer_rate_limit', default=0,
+               help=_("Maximum rate, in KiB/s, at which image data is read "
+                      "from any single source host. 0 means unlimited.")),
+    cfg.IntOpt('importer_max_retries', default=5,
+               help=_("Number of times a failed import is retried before "
+                      "the image is killed.")),
+    cfg.IntOpt('importer_retry_backoff', default=30,
+               help=_("Seconds to wait before the first retry of a failed "
+                      "import. The wait doubles with each further "
+                      "attempt.")),
+    cfg.IntOpt('importer_progress_interval', default=64,
+               help=_("Number of MiB copied between updates of the "
+                      "image's import_bytes_copied property.")),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(importer_opts)
+
+STAGING_DIR = 'staging'
+LOCK_DIR = 'locks'
+PROGRESS_PROPERTY = 'import_bytes_copied'
+
+# Errors that another attempt will not fix
+PERMANENT_ERRORS = (exception.BadStoreUri,
+                    exception.Forbidden,
+                    exception.Invalid,
+                    exception.NotFound,
+                    exception.UnknownScheme)
+
+
+def schedule_import(image_id, source, scheme, size=None, checksum=None):
+    """
+    Queues the import of an image from an external source.
+
+    :param image_id: The opaque image identifier
+    :param source: URI to copy the image data from
+    :param scheme: Scheme of the store to import the image into
+    :param size: Image size supplied by the client, if any
+    :param checksum: Image checksum supplied by the client, if any
+    """
+    datadir = CONF.importer_datadir
+    utils.safe_mkdirs(datadir)
+
+    if CONF.metadata_encryption_key is not None:
+        source = crypt.urlsafe_encrypt(CONF.metadata_encryption_key,
+                                       source, 64)
+    task = {'source': source, 'store': scheme, 'size': size,
+            'checksum': checksum, 'attempts': 0, 'not_before': 0}
+    write_queue_file(os.path.join(datadir, str(image_id)), task)
+
+
+def read_queue_file(file_path):
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def write_queue_file(file_path, task):
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(task, f)
+    os.chmod(tmp_path, 0600)
+    os.rename(tmp_path, file_path)
+
+
+class RateLimiter(object):
+    """
+    Limits the rate at which image data is read from each source host,
+    shared by all imports running in the process.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: Bytes per second allowed per host, 0 for no limit
+        """
+        self.rate = rate
+        self.next_free = {}
+
+    def consume(self, host, length):
+        """Accounts for `length` bytes read from `host`, sleeping if the
+        host's allowance is used up."""
+        if not self.rate:
+            return
+        now = time.time()
+        start = max(now, self.next_free.get(host, now))
+        self.next_free[host] = start + float(length) / self.rate
+        if start > now:
+            eventlet.sleep(start - now)
+
+
+class Importer(object):
+
+    def __init__(self):
+        self.datadir = CONF.importer_datadir
+        self.staging_dir = os.path.join(self.datadir, STAGING_DIR)
+        self.lock_dir = os.path.join(self.datadir, LOCK_DIR)
+
+        LOG.info(_("Initializing importer with conf: %s") %
+                 {'datadir': self.datadir,
+                  'workers': CONF.importer_workers,
+                  'rate_limit': CONF.importer_rate_limit,
+                  'max_retries': CONF.importer_max_retries})
+
+        registry.configure_registry_client()
+        registry.configure_registry_admin_creds()
+        ctx = context.RequestContext()
+        self.registry = registry.get_registry_client(ctx)
+        # Request context with credentials for the stores, as used by the
+        # scrubber for delayed deletes
+        self.context = context.RequestContext(auth_tok=self.registry.auth_tok,
+                                              user=CONF.admin_user,
+                                              tenant=CONF.admin_tenant_name)
+        self.notifier = notifier.Notifier()
+        self.pool = eventlet.greenpool.GreenPool(CONF.importer_workers)
+        self.limiter = RateLimiter(CONF.importer_rate_limit * 1024)
+        self.active = set()
+
+        utils.safe_mkdirs(self.staging_dir)
+        utils.safe_mkdirs(self.lock_dir)
+
+    def run(self, pool=None, event=None):
+        """
+        Starts every queued import that is due, oldest first, running at
+        most ``importer_workers`` of them at a time. Imports claimed by
+        another importer sharing ``importer_datadir`` are skipped. Unless
+        run by the daemon, waits for the started imports to finish.
+        """
+        now = time.time()
+        queued = []
+        for image_id in os.listdir(self.datadir):
+            file_path = os.path.join(self.datadir, image_id)
+            if (image_id in self.active or image_id.endswith('.tmp') or
+                    not os.path.isfile(file_path)):
+                continue
+            queued.append((os.stat(file_path).st_mtime, image_id))
+
+        for _mtime, image_id in sorted(queued):
+            lock_fd = self._claim(image_id)
+            if lock_fd is None:
+                continue
+            try:
+                task = read_queue_file(os.path.join(self.datadir, image_id))
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Completed by another importer since it was listed
+                task = None
+            if task is None or task['not_before'] > now:
+                self._release(image_id, lock_fd)
+                continue
+            self.active.add(image_id)
+            self.pool.spawn_n(self._import, image_id, task, lock_fd)
+
+        if event is None:
+            self.pool.waitall()
+
+    def _claim(self, image_id):
+        """
+        Takes an exclusive lock on the import of `image_id`, held until
+        the import is released, so that importers sharing the queue do
+        not process the same image.
+
+        :retval File descriptor holding the lock, or None if another
+                importer holds it
+        """
+        lock_path = os.path.join(self.lock_dir, image_id)
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # The lock file is removed once its import is complete, and
+            # may have been replaced since it was opened
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except (IOError, OSError), e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.ENOENT):
+                os.close(fd)
+                raise
+        os.close(fd)
+        return None
+
+    def _release(self, image_id, lock_fd):
+        if not os.path.exists(os.path.join(self.datadir, image_id)):
+            utils.safe_remove(os.path.join(self.lock_dir, image_id))
+        os.close(lock_fd)
+
+    def _import(self, image_id, task, lock_fd):
+        try:
+            self._process(image_id, task)
+        except PERMANENT_ERRORS, e:
+            LOG.error(_("Import of image %(image_id)s failed: %(e)s") %
+                      locals())
+            self._kill(image_id, task)
+        except Exception, e:
+            self._retry(image_id, task, e)
+        finally:
+            self._release(image_id, lock_fd)
+            self.active.discard(image_id)
+
+    def _process(self, image_id, task):
+        source = task['source']
+        if CONF.metadata_encryption_key is not None:
+            source = crypt.urlsafe_decrypt(CONF.metadata_encryption_key,
+                                           source)
+        try:
+            image_meta = self.registry.get_image(image_id)
+        except exception.NotFound:
+            image_meta = {'status': 'deleted'}
+        if image_meta['status'] not in ('queued', 'saving'):
+            LOG.info(_("Not importing image %(image_id)s in status "
+                       "%(status)s") % {'image_id': image_id,
+                                        'status': image_meta['status']})
+            # An earlier attempt may have activated the image, only to fail
+            # on reading the registry's response
+            if (task.get('stored') and image_meta.get('location') !=
+                    self._stored_location(task)):
+                self._delete_stored(image_id, task)
+            self._remove(image_id)
+            return
+
+        stored = task.get('stored')
+        if stored:
+            # Stored by an earlier attempt that failed to activate the image
+            location_uri = self._stored_location(task)
+            size, checksum = stored['size'], stored['checksum']
+        else:
+            location_uri, size, checksum = self._copy(image_id, image_meta,
+                                                      source, task)
+            self._record_stored(image_id, task, location_uri, size, checksum)
+
+        self._activate(image_id, location_uri, size, checksum)
+
+    def _copy(self, image_id, image_meta, source, task):
+        """
+        Copies the image data into the destination store, checking it
+        against the size and checksum supplied by the client.
+
+        :retval tuple of location, size and checksum of the stored data
+        """
+        LOG.debug(_("Setting image %s to status 'saving'"), image_id)
+        self.registry.update_image(image_id, {'status': 'saving'})
+        self.notifier.info("image.prepare", image_meta)
+        dest = store.get_store_from_scheme(self.context, task['store'])
+
+        loc = location.get_location_from_uri(source)
+        location_uri = None
+        if loc.store_name in dest.get_schemes():
+            try:
+                location_uri, size, checksum = dest.clone(image_id, loc)
+            except NotImplementedError:
+                pass
+        if location_uri is None:
+            staged_path = self._stage(image_id, source, loc, task)
+            with open(staged_path, 'rb') as staged_file:
+                reader = utils.CooperativeReader(staged_file)
+                location_uri, size, checksum = dest.add(
+                    image_id, reader, os.path.getsize(staged_path))
+
+        for attr, actual in (('size', size), ('checksum', checksum)):
+            supplied = task.get(attr)
+            if supplied and actual is not None and supplied != actual:
+                store.safe_delete_from_backend(location_uri, self.context,
+                                               image_id)
+                msg = (_("Supplied %(attr)s (%(supplied)s) and %(attr)s "
+                         "generated from imported image (%(actual)s) did "
+                         "not match.") % locals())
+                raise exception.Invalid(msg)
+        return location_uri, size, checksum
+
+    def _record_stored(self, image_id, task, location_uri, size, checksum):
+        """
+        Records the stored data in the queue file, so that a retry after
+        a failed activation does not copy the image again.
+        """
+        if CONF.metadata_encryption_key is not None:
+            location_uri = crypt.urlsafe_encrypt(
+                CONF.metadata_encryption_key, location_uri, 64)
+        task['stored'] = {'location': location_uri, 'size': size,
+                          'checksum': checksum}
+        write_queue_file(os.path.join(self.datadir, str(image_id)), task)
+
+    def _stored_location(self, task):
+        location_uri = task['stored']['location']
+        if CONF.metadata_encryption_key is not None:
+            location_uri = crypt.urlsafe_decrypt(CONF.metadata_encryption_key,
+                                                 location_uri)
+        return location_uri
+
+    def _delete_stored(self, image_id, task):
+        """Deletes the data stored by an import that will not complete."""
+        if task.get('stored'):
+            store.safe_delete_from_backend(self._stored_location(task),
+                                           self.context, image_id)
+
+    def _activate(self, image_id, location_uri, size, checksum):
+        """
+        Activates the image, provided it is still 'saving'. If it was
+        deleted or killed meanwhile, the stored data is deleted instead.
+        """
+        image_meta = {'location': location_uri, 'status': 'active',
+                      'size': size,
+                      'properties': {PROGRESS_PROPERTY: str(size)}}
+        if checksum is not None:
+            image_meta['checksum'] = checksum
+        try:
+            image_meta = self.registry.update_image(image_id, image_meta,
+                                                    from_state='saving')
+        except (exception.Duplicate, exception.NotFound), e:
+            LOG.info(_("Image %(image_id)s left 'saving' during its "
+                       "import, deleting the imported data: %(e)s") %
+                     locals())
+            store.safe_delete_from_backend(location_uri, self.context,
+                                           image_id)
+            self._remove(image_id)
+            return
+        LOG.info(_("Imported image %(image_id)s (%(size)d bytes)") %
+                 locals())
+        self.notifier.info('image.upload', image_meta)
+        self.notifier.info('image.activate', image_meta)
+        self._remove(image_id)
+
+    def _stage(self, image_id, source, loc, task):
+        """
+        Copies the image data from `source` to the staging directory,
+        resuming a previous partial copy with a ranged read where the
+        source store supports it. The staging directory needs room for the
+        full size of each image being imported.
+
+        :retval Path of the staged image file
+        """
+        staged_path = os.path.join(self.staging_dir, str(image_id))
+        if task.get('staged') and os.path.exists(staged_path):
+            return staged_path
+
+        src = store.get_store_from_uri(self.context, source, loc)
+        offset = 0
+        if os.path.exists(staged_path):
+            offset = os.path.getsize(staged_path)
+
+        data = None
+        if offset:
+            try:
+                data, _size = src.get_range(loc, offset)
+                LOG.info(_("Resuming import of image %(image_id)s at byte "
+                           "%(offset)d") % locals())
+            except NotImplementedError:
+                LOG.info(_("Source of image %s does not support ranged "
+                           "reads, restarting import") % image_id)
+                offset = 0
+        if data is None:
+            data, _size = src.get(loc)
+
+        host = urlparse.urlparse(source).hostname
+        interval = CONF.importer_progress_interval * 1024 * 1024
+        copied = reported = offset
+        with open(staged_path, 'ab' if offset else 'wb') as staged_file:
+            for chunk in data:
+                self.limiter.consume(host, len(chunk))
+                staged_file.write(chunk)
+                copied += len(chunk)
+                if interval and copied - reported >= interval:
+                    self._report_progress(image_id, copied)
+                    reported = copied
+        self._report_progress(image_id, copied)
+
+        task['staged'] = True
+        write_queue_file(os.path.join(self.datadir, str(image_id)), task)
+        return staged_path
+
+    def _report_progress(self, image_id, copied):
+        try:
+            self.registry.update_image(
+                image_id, {'properties': {PROGRESS_PROPERTY: str(copied)}})
+        except Exception, e:
+            LOG.warn(_("Unable to report import progress of image "
+                       "%(image_id)s: %(e)s") % locals())
+
+    def _retry(self, image_id, task, e):
+        task['attempts'] = task.get('attempts', 0) + 1
+        if task['attempts'] > CONF.importer_max_retries:
+            LOG.error(_("Import of image %(image_id)s failed after "
+                        "%(attempts)d attempts: %(e)s") %
+                      {'image_id': image_id, 'attempts': task['attempts'],
+                       'e': e})
+            self._kill(image_id, task)
+            return
+
+        delay = CONF.importer_retry_backoff * 2 ** (task['attempts'] - 1)
+        task['not_before'] = time.time() + delay
+        LOG.warn(_("Import of image %(image_id)s failed (%(e)s), retrying "
+                   "in %(delay)d seconds") % locals())
+        write_queue_file(os.path.join(self.datadir, str(image_id)), task)
+
+    def _kill(self, image_id, task):
+        self._delete_stored(image_id, task)
+        try:
+            self.registry.update_image(image_id, {'status': 'killed'})
+        except Exception, e:
+            LOG.error(_("Unable to kill image %(image_id)s: %(e)s") %
+                      locals())
+        self._remove(image_id)
+
+    def _remove(self, image_id):
+        utils.safe_remove(os.path.join(self.staging_dir, str(image_id)))
+        utils.safe_remove(os.path.join(self.datadir, str(image_id)))
@@ -20,11 +20,18 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import collections
+import contextlib
 import hashlib
 import math
+import sys
 import urllib
 
+import eventlet
+from eventlet import tpool
+
 from glance.common import exception
+from glance.common import utils
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
 import glance.store
@@ -50,10 +57,166 @@ rbd_opts = [
     cfg.StrOpt('rbd_store_pool', default=DEFAULT_POOL),
     cfg.StrOpt('rbd_store_user', default=DEFAULT_USER),
     cfg.StrOpt('rbd_store_ceph_conf', default=DEFAULT_CONFFILE),
+    cfg.BoolOpt('rbd_store_persistent_connections', default=True,
+                help=_("Keep the RADOS cluster connection and pool I/O "
+                       "contexts open between operations instead of "
+                       "connecting for every request.")),
+    cfg.IntOpt('rbd_store_io_queue_depth', default=4,
+               help=_("Number of chunk reads (read-ahead) or writes "
+                      "(write-behind) kept in flight in native threads "
+                      "during an RBD transfer. Set to 0 to perform the "
+                      "librbd calls inline, blocking the eventlet hub.")),
+    cfg.BoolOpt('rbd_store_clone_copy_from', default=True,
+                help=_("Create images copied from an RBD snapshot in the "
+                       "same Ceph cluster as copy-on-write clones instead "
+                       "of copying their data through Glance.")),
+    cfg.BoolOpt('rbd_store_flatten_clones', default=False,
+                help=_("Flatten cloned images in the background so that "
+                       "they no longer depend on their source image.")),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(rbd_opts)
+CONF.import_opt('sparse_uploads', 'glance.store')
+
+
+# Connected cluster handles and their open I/O contexts, keyed by
+# (conf_file, user) and (conf_file, user, pool) respectively.
+_CLUSTERS = {}
+_IOCTXS = {}
+
+
+def _disconnect(cluster_key):
+    for key in [k for k in _IOCTXS if k[:2] == cluster_key]:
+        try:
+            _IOCTXS.pop(key).close()
+        except Exception:
+            pass
+    conn = _CLUSTERS.pop(cluster_key, None)
+    if conn is not None:
+        try:
+            conn.shutdown()
+        except Exception:
+            pass
+
+
+@contextlib.contextmanager
+def _open_ioctx(conf_file, user, pool):
+    """
+    Yields a (cluster, ioctx) pair for `pool`.
+
+    With ``rbd_store_persistent_connections`` enabled, both handles are
+    kept open for later operations; a RADOS error drops them so that the
+    next operation reconnects.
+    """
+    if not CONF.rbd_store_persistent_connections:
+        with rados.Rados(conffile=conf_file, rados_id=user) as conn:
+            with conn.open_ioctx(pool) as ioctx:
+                yield conn, ioctx
+        return
+
+    cluster_key = (conf_file, user)
+    ioctx_key = cluster_key + (pool,)
+    try:
+        conn = _CLUSTERS.get(cluster_key)
+        if conn is None:
+            conn = rados.Rados(conffile=conf_file, rados_id=user)
+            conn.connect()
+            _CLUSTERS[cluster_key] = conn
+        ioctx = _IOCTXS.get(ioctx_key)
+        if ioctx is None:
+            ioctx = conn.open_ioctx(pool)
+            _IOCTXS[ioctx_key] = ioctx
+    except rados.Error:
+        _disconnect(cluster_key)
+        raise
+
+    try:
+        yield conn, ioctx
+    except rados.Error:
+        _disconnect(cluster_key)
+        raise
+
+
+class ImageIO(object):
+    """
+    Performs reads and writes on an open RBD image.
+
+    librbd calls do not yield to eventlet, so each one is executed in a
+    native thread with up to `queue_depth` requests in flight at once,
+    leaving the hub free to serve other green threads meanwhile.
+    """
+
+    def __init__(self, image, queue_depth):
+        self.image = image
+        self.queue_depth = queue_depth
+        self.pending = collections.deque()
+
+    def _submit(self, func, *args):
+        if self.queue_depth <= 0:
+            result = func(*args)
+            self.pending.append(lambda: result)
+        else:
+            gt = eventlet.spawn(tpool.execute, func, *args)
+            self.pending.append(gt.wait)
+
+    def _call(self, func, *args):
+        if self.queue_depth <= 0:
+            return func(*args)
+        return tpool.execute(func, *args)
+
+    def read_chunks(self, size, chunk_size):
+        """
+        Yields the first `size` bytes of the image, in order. The missing
+        tail of a read that returns fewer bytes than requested is read
+        again before the chunk is yielded.
+        """
+        offset = 0
+        requested = collections.deque()
+        try:
+            while offset < size or self.pending:
+                while (offset < size and
+                       len(self.pending) < max(self.queue_depth, 1)):
+                    length = min(chunk_size, size - offset)
+                    self._submit(self.image.read, offset, length)
+                    requested.append((offset, length))
+                    offset += length
+                data = self.pending.popleft()()
+                start, length = requested.popleft()
+                while len(data) < length:
+                    tail = self._call(self.image.read, start + len(data),
+                                      length - len(data))
+                    if not tail:
+                        msg = (_("Expected %(length)d bytes from RBD image "
+                                 "at offset %(start)d, got %(got)d") %
+                               {'length': length, 'start': start,
+                                'got': len(data)})
+                        raise IOError(msg)
+                    data += tail
+                yield data
+        finally:
+            # The image must not be closed with reads still in progress
+            self.wait(raise_errors=False)
+
+    def write(self, data, offset):
+        """
+        Queues `data` to be written at `offset`, first waiting for the
+        oldest outstanding write when the queue is full.
+        """
+        while len(self.pending) >= max(self.queue_depth, 1):
+            self.pending.popleft()()
+        self._submit(self.image.write, data, offset)
+
+    def wait(self, raise_errors=True):
+        """Waits for every outstanding request to complete."""
+        error = None
+        while self.pending:
+            try:
+                self.pending.popleft()()
+            except Exception, e:
+                error = error or e
+        if error is not None and raise_errors:
+            raise error
 
 
 class StoreLocation(glance.store.location.StoreLocation):
@@ -129,22 +292,19 @@ class ImageIterator(object):
         self.user = store.user
         self.conf_file = store.conf_file
         self.chunk_size = store.chunk_size
+        self.queue_depth = store.queue_depth
 
     def __iter__(self):
         try:
-            with rados.Rados(conffile=self.conf_file,
-                             rados_id=self.user) as conn:
-                with conn.open_ioctx(self.pool) as ioctx:
-                    with rbd.Image(ioctx, self.name) as image:
-                        img_info = image.stat()
-                        size = img_info['size']
-                        bytes_left = size
-                        while bytes_left > 0:
-                            length = min(self.chunk_size, bytes_left)
-                            data = image.read(size - bytes_left, length)
-                            bytes_left -= len(data)
-                            yield data
-                        raise StopIteration()
+            with _open_ioctx(self.conf_file, self.user,
+                             self.pool) as (conn, ioctx):
+                with rbd.Image(ioctx, self.name) as image:
+                    img_info = image.stat()
+                    image_io = ImageIO(image, self.queue_depth)
+                    for data in image_io.read_chunks(img_info['size'],
+                                                     self.chunk_size):
+                        yield data
+                    raise StopIteration()
         except rbd.ImageNotFound:
             raise exception.NotFound(
                 _('RBD image %s does not exist') % self.name)
@@ -173,6 +333,7 @@ class Store(glance.store.base.Store):
             self.pool = str(CONF.rbd_store_pool)
             self.user = str(CONF.rbd_store_user)
             self.conf_file = str(CONF.rbd_store_ceph_conf)
+            self.queue_depth = CONF.rbd_store_io_queue_depth
         except cfg.ConfigFileValueError, e:
             reason = _("Error in store configuration: %s") % e
             LOG.error(reason)
@@ -192,6 +353,26 @@ class Store(glance.store.base.Store):
         loc = location.store_location
         return (ImageIterator(str(loc.image), self), None)
 
+    def get_size(self, location):
+        """
+        Takes a `glance.store.location.Location` object that indicates
+        where to find the image file, and returns the size
+
+        :param location `glance.store.location.Location` object, supplied
+                        from glance.store.location.get_location_from_uri()
+        :raises `glance.exception.NotFound` if image does not exist
+        """
+        loc = location.store_location
+        with _open_ioctx(self.conf_file, self.user,
+                         loc.pool or self.pool) as (conn, ioctx):
+            try:
+                with rbd.Image(ioctx, str(loc.image),
+                               snapshot=loc.snapshot) as image:
+                    return image.size()
+            except rbd.ImageNotFound:
+                raise exception.NotFound(
+                    _('RBD image %s does not exist') % loc.image)
+
     def _create_image(self, fsid, ioctx, name, size, order):
         """
         Create an rbd image. If librbd supports it,
@@ -230,34 +411,150 @@ class Store(glance.store.base.Store):
         """
         checksum = hashlib.md5()
         image_name = str(image_id)
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
+        with _open_ioctx(self.conf_file, self.user,
+                         self.pool) as (conn, ioctx):
             fsid = None
             if hasattr(conn, 'get_fsid'):
                 fsid = conn.get_fsid()
-            with conn.open_ioctx(self.pool) as ioctx:
-                order = int(math.log(self.chunk_size, 2))
-                LOG.debug('creating image %s with order %d',
-                          image_name, order)
-                try:
-                    location = self._create_image(fsid, ioctx, image_name,
-                                                  image_size, order)
-                except rbd.ImageExists:
-                    raise exception.Duplicate(
-                        _('RBD image %s already exists') % image_id)
+            order = int(math.log(self.chunk_size, 2))
+            LOG.debug('creating image %s with order %d', image_name, order)
+            try:
+                location = self._create_image(fsid, ioctx, image_name,
+                                              image_size, order)
+            except rbd.ImageExists:
+                raise exception.Duplicate(
+                    _('RBD image %s already exists') % image_id)
+            try:
                 with rbd.Image(ioctx, image_name) as image:
+                    image_io = ImageIO(image, self.queue_depth)
                     bytes_left = image_size
-                    while bytes_left > 0:
-                        length = min(self.chunk_size, bytes_left)
-                        data = image_file.read(length)
-                        image.write(data, image_size - bytes_left)
-                        bytes_left -= length
-                        checksum.update(data)
+                    bytes_skipped = 0
+                    try:
+                        while bytes_left > 0:
+                            length = min(self.chunk_size, bytes_left)
+                            data = image_file.read(length)
+                            # A new image reads as zeros wherever it has
+                            # not been written to
+                            if (CONF.sparse_uploads and
+                                    utils.is_zero_block(data)):
+                                bytes_skipped += len(data)
+                            else:
+                                image_io.write(data, image_size - bytes_left)
+                            bytes_left -= length
+                            checksum.update(data)
+                    except Exception:
+                        # Let outstanding writes finish before the image is
+                        # closed, but report the original failure
+                        exc_info = sys.exc_info()
+                        image_io.wait(raise_errors=False)
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    image_io.wait()
                     if location.snapshot:
                         image.create_snap(location.snapshot)
                         image.protect_snap(location.snapshot)
+            except Exception:
+                # Remove the partial image, so the upload can be retried
+                exc_info = sys.exc_info()
+                self._delete_image(ioctx, image_name, location.snapshot)
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        LOG.debug(_('wrote image %(image_name)s, skipping %(bytes_skipped)d '
+                    'bytes of zeros') % locals())
+        if hasattr(image_file, 'sparse_bytes'):
+            image_file.sparse_bytes += bytes_skipped
 
         return (location.get_uri(), image_size, checksum.hexdigest())
 
+    def clone(self, image_id, location):
+        """
+        Creates the image with the supplied identifier as a copy-on-write
+        clone of the snapshot at `location`, without reading its data.
+
+        :param image_id: The opaque image identifier
+        :param location: `glance.store.location.Location` of the source
+
+        :retval tuple of URL in backing store, image size, and checksum
+                (always None, as the data is never read)
+        :raises NotImplementedError if the source is not a protected
+                snapshot in this cluster, or cloning is not supported
+        """
+        loc = location.store_location
+        if not (CONF.rbd_store_clone_copy_from and
+                hasattr(rbd, 'RBD_FEATURE_LAYERING') and
+                isinstance(loc, StoreLocation) and
+                loc.fsid and loc.pool and loc.snapshot):
+            raise NotImplementedError()
+
+        image_name = str(image_id)
+        with _open_ioctx(self.conf_file, self.user,
+                         self.pool) as (conn, ioctx):
+            if not hasattr(conn, 'get_fsid') or conn.get_fsid() != loc.fsid:
+                raise NotImplementedError()
+            with _open_ioctx(self.conf_file, self.user,
+                             loc.pool) as (conn, parent_ioctx):
+                order = int(math.log(self.chunk_size, 2))
+                LOG.debug(_('cloning image %(image_name)s from '
+                            '%(pool)s/%(parent)s@%(snapshot)s'),
+                          {'image_name': image_name, 'pool': loc.pool,
+                           'parent': loc.image, 'snapshot': loc.snapshot})
+                try:
+                    rbd.RBD().clone(parent_ioctx, loc.image, loc.snapshot,
+                                    ioctx, image_name,
+                                    features=rbd.RBD_FEATURE_LAYERING,
+                                    order=order)
+                except rbd.ImageExists:
+                    raise exception.Duplicate(
+                        _('RBD image %s already exists') % image_id)
+                except rbd.ImageNotFound:
+                    raise exception.NotFound(
+                        _('RBD image %s does not exist') % loc.image)
+
+            try:
+                with rbd.Image(ioctx, image_name) as image:
+                    size = image.size()
+                    image.create_snap(DEFAULT_SNAPNAME)
+                    image.protect_snap(DEFAULT_SNAPNAME)
+            except Exception:
+                exc_info = sys.exc_info()
+                self._delete_image(ioctx, image_name, DEFAULT_SNAPNAME)
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+        if CONF.rbd_store_flatten_clones:
+            eventlet.spawn_n(self._flatten, image_name)
+
+        location = StoreLocation({'fsid': loc.fsid,
+                                  'pool': self.pool,
+                                  'image': image_name,
+                                  'snapshot': DEFAULT_SNAPNAME})
+        return (location.get_uri(), size, None)
+
+    def _delete_image(self, ioctx, image_name, snapshot_name=None):
+        """
+        Removes an image that add or clone failed to finish, along with
+        its snapshot if one was created. Errors are logged rather than
+        raised, so that the caller can report the original failure.
+        """
+        try:
+            with rbd.Image(ioctx, image_name) as image:
+                snaps = [snap['name'] for snap in image.list_snaps()]
+                if snapshot_name in snaps:
+                    if image.is_protected_snap(snapshot_name):
+                        image.unprotect_snap(snapshot_name)
+                    image.remove_snap(snapshot_name)
+            rbd.RBD().remove(ioctx, image_name)
+        except Exception:
+            LOG.exception(_('Failed to remove RBD image %s') % image_name)
+
+    def _flatten(self, image_name):
+        """Copies the parent's data into a cloned image."""
+        try:
+            with _open_ioctx(self.conf_file, self.user,
+                             self.pool) as (conn, ioctx):
+                with rbd.Image(ioctx, image_name) as image:
+                    tpool.execute(image.flatten)
+        except Exception:
+            LOG.exception(_('Failed to flatten RBD image %s') % image_name)
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -270,25 +567,25 @@ class Store(glance.store.base.Store):
         """
         loc = location.store_location
 
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
-            with conn.open_ioctx(self.pool) as ioctx:
-                if loc.snapshot:
-                    with rbd.Image(ioctx, loc.image) as image:
-                        try:
-                            image.unprotect_snap(loc.snapshot)
-                        except rbd.ImageBusy:
-                            log_msg = _("snapshot %s@%s could not be "
-                                        "unprotected because it is in use")
-                            LOG.debug(log_msg % (loc.image, loc.snapshot))
-                            raise exception.InUseByStore()
-                        image.remove_snap(loc.snapshot)
-                try:
-                    rbd.RBD().remove(ioctx, str(loc.image))
-                except rbd.ImageNotFound:
-                    raise exception.NotFound(
-                        _('RBD image %s does not exist') % loc.image)
-                except rbd.ImageBusy:
-                    log_msg = _("image %s could not be removed"
-                                "because it is in use")
-                    LOG.debug(log_msg % loc.image)
-                    raise exception.InUseByStore()
+        with _open_ioctx(self.conf_file, self.user,
+                         self.pool) as (conn, ioctx):
+            if loc.snapshot:
+                with rbd.Image(ioctx, loc.image) as image:
+                    try:
+                        image.unprotect_snap(loc.snapshot)
+                    except rbd.ImageBusy:
+                        log_msg = _("snapshot %s@%s could not be "
+                                    "unprotected because it is in use")
+                        LOG.debug(log_msg % (loc.image, loc.snapshot))
+                        raise exception.InUseByStore()
+                    image.remove_snap(loc.snapshot)
+            try:
+                rbd.RBD().remove(ioctx, str(loc.image))
+            except rbd.ImageNotFound:
+                raise exception.NotFound(
+                    _('RBD image %s does not exist') % loc.image)
+            except rbd.ImageBusy:
+                log_msg = _("image %s could not be removed"
+                            "because it is in use")
+                LOG.debug(log_msg % loc.image)
+                raise exception.InUseByStore()
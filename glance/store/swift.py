@@ -204,6 +204,34 @@ class StoreLocation(glance.store.location.StoreLocation):
             return ''.join([auth_scheme, self.auth_or_store_url])
 
 
+# Storage URL and token obtained for each set of swift credentials, so that
+# new connections can skip the round trip to the auth service.
+_AUTH_CACHE = {}
+
+
+def _auth_caching_connection(auth_key, *args, **kwargs):
+    """
+    Returns a swiftclient Connection that starts from the token previously
+    obtained for `auth_key` and records any token it (re-)authenticates
+    for. An expired token results in a 401, upon which swiftclient
+    re-authenticates and retries the request.
+    """
+    url, token = _AUTH_CACHE.get(auth_key, (None, None))
+    connection = swiftclient.Connection(*args, preauthurl=url,
+                                        preauthtoken=token, **kwargs)
+    get_auth = connection.get_auth
+
+    def _get_auth():
+        _AUTH_CACHE.pop(auth_key, None)
+        url, token = get_auth()
+        if url and token:
+            _AUTH_CACHE[auth_key] = (url, token)
+        return url, token
+
+    connection.get_auth = _get_auth
+    return connection
+
+
 def Store(context=None, loc=None):
     if (CONF.swift_store_multi_tenant and
             (loc is None or loc.store_location.user is None)):
@@ -255,6 +283,30 @@ class BaseStore(glance.store.base.Store):
         length = int(resp_headers.get('content-length', 0))
         return (ResponseIndexable(resp_body, length), length)
 
+    def get_range(self, location, offset, connection=None):
+        location = location.store_location
+        if not connection:
+            connection = self.get_connection(location)
+
+        try:
+            resp_headers, resp_body = connection.get_object(
+                    container=location.container, obj=location.obj,
+                    resp_chunk_size=self.CHUNKSIZE,
+                    headers={'Range': 'bytes=%d-' % offset})
+        except TypeError:
+            # swiftclient too old to pass request headers
+            raise NotImplementedError
+        except swiftclient.ClientException, e:
+            if e.http_status == httplib.NOT_FOUND:
+                msg = _("Swift could not find image at URI.")
+                raise exception.NotFound(msg)
+            else:
+                raise
+
+        if 'content-range' not in resp_headers:
+            raise NotImplementedError
+        return (resp_body, int(resp_headers.get('content-length', 0)))
+
     def get_size(self, location, connection=None):
         location = location.store_location
         if not connection:
@@ -512,14 +564,18 @@ class SingleTenantStore(BaseStore):
         os_options['endpoint_type'] = self.endpoint_type
         os_options['service_type'] = self.service_type
 
-        return swiftclient.Connection(
-                auth_url, user, location.key,
+        auth_key = (auth_url, tenant_name, user, location.key,
+                    self.auth_version, self.region, self.endpoint_type,
+                    self.service_type, self.snet)
+        return _auth_caching_connection(
+                auth_key, auth_url, user, location.key,
                 tenant_name=tenant_name, snet=self.snet,
                 auth_version=self.auth_version, os_options=os_options)
 
 
 class MultiTenantStore(BaseStore):
     EXAMPLE_URL = "swift://<SWIFT_URL>/<CONTAINER>/<FILE>"
+    context_scoped = True
 
     def configure_add(self):
         self.container = CONF.swift_store_container
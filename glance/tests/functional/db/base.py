@@ -199,6 +199,75 @@ class DriverTests(object):
         self.assertEqual(properties['foo']['value'], 'bar')
         self.assertEqual(properties['foo']['deleted'], True)
 
+    def test_image_update_many_properties(self):
+        properties = dict(('key%d' % i, 'value%d' % i) for i in range(10))
+        self.db_api.image_update(self.adm_context, UUID1,
+                                 {'properties': dict(properties)})
+
+        properties['key0'] = 'changed'
+        del properties['key1']
+        properties['foo'] = 'bar'
+        image = self.db_api.image_update(self.adm_context, UUID1,
+                                         {'properties': dict(properties)},
+                                         purge_props=True)
+        actual = dict((p['name'], p['value']) for p in image['properties']
+                      if not p['deleted'])
+        self.assertEqual(properties, actual)
+
+        # A purged property can be set again
+        properties['key1'] = 'back'
+        image = self.db_api.image_update(self.adm_context, UUID1,
+                                         {'properties': dict(properties)})
+        actual = dict((p['name'], p['value']) for p in image['properties']
+                      if not p['deleted'])
+        self.assertEqual(properties, actual)
+
+    def test_image_update_version(self):
+        image = self.db_api.image_get(self.adm_context, UUID1)
+        version = image['version']
+        image = self.db_api.image_update(self.adm_context, UUID1,
+                                         {'status': 'saving'},
+                                         version=version)
+        self.assertEqual('saving', image['status'])
+        self.assertEqual(version + 1, image['version'])
+        image = self.db_api.image_update(self.adm_context, UUID1,
+                                         {'properties': {'ping': 'pong'}},
+                                         version=version + 1)
+        self.assertEqual(version + 2, image['version'])
+
+    def test_image_update_version_conflict(self):
+        image = self.db_api.image_get(self.adm_context, UUID1)
+        self.db_api.image_update(self.adm_context, UUID1, {'name': 'new'})
+        for values in ({'status': 'saving'},
+                       {'status': 'saving', 'properties': {'ping': 'pong'}}):
+            self.assertRaises(exception.ImageVersionConflict,
+                              self.db_api.image_update, self.adm_context,
+                              UUID1, values, version=image['version'])
+        image = self.db_api.image_get(self.adm_context, UUID1)
+        self.assertEqual('new', image['name'])
+        self.assertEqual('active', image['status'])
+
+    def test_image_version(self):
+        image = self.db_api.image_create(self.adm_context,
+                                         {'status': 'queued'})
+        self.assertEqual(1, image['version'])
+        image = self.db_api.image_update(self.adm_context, image['id'],
+                                         {'name': 'ping'})
+        self.assertEqual(2, image['version'])
+
+    def test_image_update_from_state(self):
+        image = self.db_api.image_update(self.adm_context, UUID1,
+                                         {'status': 'saving'},
+                                         from_state='active')
+        self.assertEqual('saving', image['status'])
+        for values in ({'status': 'active'},
+                       {'status': 'active', 'properties': {'ping': 'pong'}}):
+            self.assertRaises(exception.ImageStatusConflict,
+                              self.db_api.image_update, self.adm_context,
+                              UUID1, values, from_state='queued')
+        image = self.db_api.image_get(self.adm_context, UUID1)
+        self.assertEqual('saving', image['status'])
+
     def test_image_property_delete(self):
         fixture = {'name': 'ping', 'value': 'pong', 'image_id': UUID1}
         prop = self.db_api.image_property_create(self.context, fixture)
@@ -403,6 +472,41 @@ class DriverTests(object):
         page = self.db_api.image_get_all(self.context, limit=2, marker=UUID2)
         self.assertEquals([UUID1], [i['id'] for i in page])
 
+    def test_image_get_all_with_filter_after_update(self):
+        self.db_api.image_update(self.adm_context, UUID2,
+                                 {'name': 'renamed',
+                                  'properties': {'foo': 'bar'}})
+        images = self.db_api.image_get_all(self.context,
+                                           filters={'name': 'renamed'})
+        self.assertEquals([UUID2], [i['id'] for i in images])
+
+        filters = {'properties': {'foo': 'bar'}}
+        images = self.db_api.image_get_all(self.context,
+                                           filters=copy.deepcopy(filters))
+        self.assertEquals(set([UUID1, UUID2]),
+                          set([i['id'] for i in images]))
+
+        self.db_api.image_update(self.adm_context, UUID2,
+                                 {'properties': {}}, purge_props=True)
+        images = self.db_api.image_get_all(self.context,
+                                           filters=copy.deepcopy(filters))
+        self.assertEquals([UUID1], [i['id'] for i in images])
+
+    def test_image_get_all_sort_key_paginate(self):
+        for image_id, name in [(UUID1, 'b'), (UUID2, 'c'), (UUID3, 'a')]:
+            self.db_api.image_update(self.adm_context, image_id,
+                                     {'name': name})
+
+        page = self.db_api.image_get_all(self.context, sort_key='name',
+                                         sort_dir='asc', limit=2)
+        self.assertEquals([UUID3, UUID1], [i['id'] for i in page])
+        page = self.db_api.image_get_all(self.context, sort_key='name',
+                                         sort_dir='asc', marker=UUID1)
+        self.assertEquals([UUID2], [i['id'] for i in page])
+        page = self.db_api.image_get_all(self.context, sort_key='name',
+                                         sort_dir='desc', marker=UUID1)
+        self.assertEquals([UUID3], [i['id'] for i in page])
+
     def test_image_get_all_invalid_sort_key(self):
         self.assertRaises(exception.InvalidSortKey, self.db_api.image_get_all,
                           self.context, sort_key='blah')
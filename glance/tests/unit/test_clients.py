@@ -17,6 +17,8 @@
 
 import datetime
 
+import fixtures
+
 from glance.common import config
 from glance.common import exception
 from glance import context
@@ -24,6 +26,7 @@ from glance.db.sqlalchemy import api as db_api
 from glance.db.sqlalchemy import models as db_models
 from glance.openstack.common import timeutils
 from glance.openstack.common import uuidutils
+from glance import registry
 from glance.registry import client as rclient
 from glance.tests.unit import base
 
@@ -969,6 +972,26 @@ class TestRegistryClient(base.IsolatedUnitTest):
         for k, v in fixture.items():
             self.assertEquals(v, data[k])
 
+    def test_update_image_from_state(self):
+        """Tests images in another state are not updated"""
+        self.assertRaises(exception.Duplicate,
+                          self.client.update_image,
+                          UUID2, {'status': 'active'}, from_state='saving')
+        data = self.client.update_image(UUID2, {'status': 'saving'},
+                                        from_state='active')
+        self.assertEquals('saving', data['status'])
+
+    def test_update_image_version(self):
+        """Tests images changed since they were read are not updated"""
+        version = self.client.get_image(UUID2)['version']
+        self.client.update_image(UUID2, {'name': 'ping'})
+        self.assertRaises(exception.Duplicate,
+                          self.client.update_image,
+                          UUID2, {'name': 'pong'}, version=version)
+        data = self.client.update_image(UUID2, {'name': 'pong'},
+                                        version=version + 1)
+        self.assertEquals('pong', data['name'])
+
     def test_update_image_not_existing(self):
         """Tests non existing image update doesn't work"""
         fixture = {
@@ -1037,3 +1060,51 @@ class TestRegistryClient(base.IsolatedUnitTest):
         """Tests deleting image members"""
         self.client.add_member(UUID2, 'pattieblack')
         self.assertTrue(self.client.delete_member(UUID2, 'pattieblack'))
+
+
+class TestLocalRegistryClient(TestRegistryClient):
+
+    """
+    Runs the registry client tests against the in-process client, which
+    must behave as the HTTP client does
+    """
+
+    def setUp(self):
+        super(TestLocalRegistryClient, self).setUp()
+        self.client = rclient.LocalRegistryClient(self.context)
+
+    def test_metadata_encryption(self):
+        key = '1234567890123456'
+        self.client = rclient.LocalRegistryClient(self.context, key)
+        image = self.client.add_image({'id': _gen_uuid(),
+                                       'name': 'encrypted',
+                                       'disk_format': 'raw',
+                                       'container_format': 'bare',
+                                       'location': 'file:///tmp/image'})
+        self.assertEqual('file:///tmp/image', image['location'])
+        stored = db_api.image_get(self.context, image['id'])
+        self.assertNotEqual('file:///tmp/image', stored['location'])
+        image = self.client.get_image(image['id'])
+        self.assertEqual('file:///tmp/image', image['location'])
+
+    def test_context_not_changed(self):
+        self.client.get_images(filters={'is_public': True})
+        self.assertTrue(self.context.is_admin)
+
+    def test_read_only_context(self):
+        self.client = rclient.LocalRegistryClient(
+            context.RequestContext(is_admin=True, read_only=True))
+        self.assertRaises(exception.Forbidden, self.client.delete_image,
+                          UUID2)
+
+    def test_get_registry_client(self):
+        self.useFixture(fixtures.MonkeyPatch('glance.registry._CLIENT_MODE',
+                                             None))
+        self.config(registry_client_mode='local')
+        registry.configure_registry_client()
+        client = registry.get_registry_client(self.context)
+        self.assertTrue(isinstance(client, rclient.LocalRegistryClient))
+
+        self.config(registry_client_mode='carrier-pigeon')
+        self.assertRaises(exception.BadRegistryConnectionConfiguration,
+                          registry.configure_registry_client)
@@ -176,6 +176,22 @@ class TestImageRepo(test_utils.BaseTestCase):
         self.assertEqual(image.tags, set(['king', 'kong']))
         self.assertEqual(image.updated_at, current_update_time)
 
+    def test_save_image_changed_elsewhere(self):
+        image = self.image_repo.get(UUID1)
+        self.db.image_update(self.context, UUID1, {'name': 'bar'})
+        image.name = 'foo'
+        self.assertRaises(exception.ImageVersionConflict,
+                          self.image_repo.save, image)
+        self.assertEqual('bar', self.db.image_get(self.context, UUID1)['name'])
+
+    def test_save_image_twice(self):
+        image = self.image_repo.get(UUID1)
+        image.name = 'foo'
+        self.image_repo.save(image)
+        image.name = 'bar'
+        self.image_repo.save(image)
+        self.assertEqual('bar', self.image_repo.get(UUID1).name)
+
     def test_remove_image(self):
         image = self.image_repo.get(UUID1)
         previous_update_time = image.updated_at
@@ -26,6 +26,7 @@ import StringIO
 import mox
 
 from glance.common import exception
+from glance.common import utils
 from glance.openstack.common import uuidutils
 from glance.store.filesystem import Store, ChunkedFile
 from glance.store.location import get_location_from_uri
@@ -115,6 +116,34 @@ class TestStore(base.IsolatedUnitTest):
         self.assertEquals(expected_file_contents, new_image_contents)
         self.assertEquals(expected_file_size, new_image_file_size)
 
+    def test_add_sparse(self):
+        """Test that all-zero chunks are left as holes in the file"""
+        self.config(filesystem_store_write_chunk_size=4)
+        image_id = uuidutils.generate_uuid()
+        contents = ('\0' * 4096 * 64) + ('*' * 4096) + ('\0' * 4096 * 64)
+        image_file = utils.CooperativeReader(StringIO.StringIO(contents))
+
+        location, size, checksum = self.store.add(image_id, image_file,
+                                                  len(contents))
+
+        self.assertEquals(len(contents), size)
+        self.assertEquals(hashlib.md5(contents).hexdigest(), checksum)
+        self.assertEquals(4096 * 128, image_file.sparse_bytes)
+        filepath = os.path.join(self.test_dir, image_id)
+        self.assertEquals(len(contents), os.path.getsize(filepath))
+        self.assertEquals(contents, open(filepath, 'rb').read())
+
+    def test_add_sparse_disabled(self):
+        self.config(sparse_uploads=False, filesystem_store_write_chunk_size=4)
+        contents = '\0' * 4096 * 4
+        image_file = utils.CooperativeReader(StringIO.StringIO(contents))
+
+        location, size, checksum = self.store.add(
+            uuidutils.generate_uuid(), image_file, len(contents))
+
+        self.assertEquals(len(contents), size)
+        self.assertEquals(0, image_file.sparse_bytes)
+
     def test_add_already_existing(self):
         """
         Tests that adding an image with an existing identifier
@@ -239,3 +268,122 @@ class TestStore(base.IsolatedUnitTest):
         self.assertRaises(exception.NotFound,
                           self.store.delete,
                           loc)
+
+    def _add(self, image_id, contents='*' * 10):
+        return self.store.add(image_id, StringIO.StringIO(contents),
+                              len(contents))
+
+    def test_add_write_tuning(self):
+        """Test preallocation, periodic sync and page cache dropping"""
+        calls = []
+
+        def fake_fallocate(fd, offset, length):
+            calls.append(('fallocate', offset, length))
+            return True
+
+        def fake_fdatasync(fd):
+            calls.append(('fdatasync',))
+
+        def fake_fadvise(fd, offset, length, advice):
+            calls.append(('fadvise', offset, length, advice))
+            return True
+
+        self.stubs.Set(utils, 'fallocate', fake_fallocate)
+        self.stubs.Set(utils, 'fdatasync', fake_fdatasync)
+        self.stubs.Set(utils, 'fadvise', fake_fadvise)
+        self.config(filesystem_store_preallocate=True,
+                    filesystem_store_write_chunk_size=512,
+                    filesystem_store_sync='periodic',
+                    filesystem_store_sync_interval=1)
+        self.store = Store()
+
+        contents = '*' * (1024 * 1024 * 2 + 100)
+        image_id = uuidutils.generate_uuid()
+        location, size, checksum = self._add(image_id, contents)
+
+        self.assertEquals(hashlib.md5(contents).hexdigest(), checksum)
+        mb = 1024 * 1024
+        self.assertEquals([('fallocate', 0, len(contents)),
+                           ('fdatasync',),
+                           ('fadvise', 0, mb, utils.POSIX_FADV_DONTNEED),
+                           ('fdatasync',),
+                           ('fadvise', mb, mb, utils.POSIX_FADV_DONTNEED),
+                           ('fdatasync',),
+                           ('fadvise', 2 * mb, 100,
+                            utils.POSIX_FADV_DONTNEED)],
+                          calls)
+        filepath = os.path.join(self.test_dir, image_id)
+        self.assertEquals(contents, open(filepath, 'rb').read())
+
+    def test_add_sync_at_end(self):
+        calls = []
+        self.stubs.Set(utils, 'fdatasync',
+                       lambda fd: calls.append('fdatasync'))
+        self.config(filesystem_store_sync='end')
+        self.store = Store()
+        self._add(uuidutils.generate_uuid(), '*' * (1024 * 1024 * 3))
+        self.assertEquals(['fdatasync'], calls)
+
+    def test_invalid_sync_policy(self):
+        self.config(filesystem_store_sync='sometimes')
+        self.store = Store()
+        self.assertRaises(exception.StoreAddDisabled, self._add, 'image')
+
+    def test_add_with_subdir_levels(self):
+        """Test that image files are placed in hashed subdirectories"""
+        self.config(filesystem_store_subdir_levels=2)
+        image_id = uuidutils.generate_uuid()
+        digest = hashlib.md5(image_id).hexdigest()
+        location, size, checksum = self._add(image_id)
+
+        expected_path = os.path.join(self.test_dir, digest[0:2],
+                                     digest[2:4], image_id)
+        self.assertEquals('file://%s' % expected_path, location)
+        image_file, image_size = self.store.get(get_location_from_uri(
+            location))
+        self.assertEquals('*' * 10, ''.join(image_file))
+
+    def test_get_flat_location_with_subdir_levels(self):
+        """Test that images stored without subdirectories remain readable"""
+        image_id = uuidutils.generate_uuid()
+        location, size, checksum = self._add(image_id)
+        self.config(filesystem_store_subdir_levels=2)
+        self.store = Store()
+        image_file, image_size = self.store.get(get_location_from_uri(
+            location))
+        self.assertEquals('*' * 10, ''.join(image_file))
+
+    def _configure_datadirs(self, *entries):
+        self.config(filesystem_store_datadir=None,
+                    filesystem_store_datadirs=list(entries))
+        self.store = Store()
+
+    def _stub_free_space(self, free_space):
+        self.stubs.Set(Store, '_get_free_space',
+                       staticmethod(lambda datadir: free_space[datadir]))
+
+    def test_add_to_highest_priority_datadir(self):
+        dirs = [os.path.join(self.test_dir, name) for name in ('a', 'b')]
+        self._configure_datadirs('%s:100' % dirs[0], '%s:200' % dirs[1])
+        self._stub_free_space({dirs[0]: 1000, dirs[1]: 100})
+        location, size, checksum = self._add('image')
+        self.assertEquals('file://%s/image' % dirs[1], location)
+
+    def test_add_to_datadir_with_most_free_space(self):
+        dirs = [os.path.join(self.test_dir, name) for name in ('a', 'b')]
+        self._configure_datadirs(dirs[0], dirs[1])
+        self._stub_free_space({dirs[0]: 100, dirs[1]: 1000})
+        location, size, checksum = self._add('image')
+        self.assertEquals('file://%s/image' % dirs[1], location)
+
+    def test_add_skips_full_datadir(self):
+        dirs = [os.path.join(self.test_dir, name) for name in ('a', 'b')]
+        self._configure_datadirs('%s:100' % dirs[0], '%s:200' % dirs[1])
+        self._stub_free_space({dirs[0]: 1000, dirs[1]: 5})
+        location, size, checksum = self._add('image')
+        self.assertEquals('file://%s/image' % dirs[0], location)
+
+    def test_datadir_and_datadirs_both_set(self):
+        self.config(filesystem_store_datadirs=[self.test_dir])
+        self.store = Store()
+        self.assertRaises(exception.StoreAddDisabled, self._add, 'image')
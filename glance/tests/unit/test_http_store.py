@@ -23,6 +23,7 @@ from glance.db.sqlalchemy import api as db_api
 from glance.registry import configure_registry_client
 from glance.store import (delete_from_backend,
                           safe_delete_from_backend)
+import glance.store.http
 from glance.store.http import Store, MAX_REDIRECTS
 from glance.store.location import get_location_from_uri
 from glance.tests.unit import base
@@ -34,6 +35,9 @@ from glance.tests import utils, stubs as test_stubs
 # FakeHTTPConnection below.
 FAKE_RESPONSE_STACK = []
 
+# Hosts connected to by FakeHTTPConnection, in order
+FAKE_CONNECTIONS = []
+
 
 def stub_out_http_backend(stubs):
     """
@@ -48,8 +52,8 @@ def stub_out_http_backend(stubs):
 
     class FakeHTTPConnection(object):
 
-        def __init__(self, *args, **kwargs):
-            pass
+        def __init__(self, netloc, *args, **kwargs):
+            FAKE_CONNECTIONS.append(netloc)
 
         def getresponse(self):
             if len(FAKE_RESPONSE_STACK):
@@ -68,6 +72,46 @@ def stub_out_http_backend(stubs):
     stubs.Set(Store, '_get_conn_class', fake_get_conn_class)
 
 
+def stub_out_ranged_http_backend(stubs, data):
+    """
+    Stubs out the HTTP connection with one serving `data`, and answering
+    requests with a Range header with partial responses.
+
+    :param stubs: Set of stubout stubs
+    :param data: Contents of every URL
+    """
+
+    class FakeRangedHTTPConnection(object):
+
+        requests = []
+
+        def __init__(self, netloc, *args, **kwargs):
+            pass
+
+        def request(self, verb, path, body, headers):
+            self.range = headers.get('Range')
+            self.requests.append(self.range)
+
+        def getresponse(self):
+            if not self.range:
+                return utils.FakeHTTPResponse(data=data)
+            start, end = self.range[len('bytes='):].split('-')
+            start = int(start)
+            end = min(int(end or len(data) - 1), len(data) - 1)
+            headers = {'content-length': end + 1 - start,
+                       'content-range': 'bytes %d-%d/%d' % (start, end,
+                                                            len(data))}
+            return utils.FakeHTTPResponse(status=206, headers=headers,
+                                          data=data[start:end + 1])
+
+        def close(self):
+            pass
+
+    stubs.Set(Store, '_get_conn_class',
+              lambda *args, **kwargs: FakeRangedHTTPConnection)
+    return FakeRangedHTTPConnection.requests
+
+
 def stub_out_registry_image_update(stubs):
     """
     Stubs an image update on the registry.
@@ -87,6 +131,9 @@ class TestHttpStore(base.StoreClearingUnitTest):
     def setUp(self):
         global FAKE_RESPONSE_STACK
         FAKE_RESPONSE_STACK = []
+        del FAKE_CONNECTIONS[:]
+        glance.store.http._REDIRECTS.clear()
+        glance.store.http._SIZES.clear()
         self.config(default_store='http',
                     known_stores=['glance.store.http.Store'])
         super(TestHttpStore, self).setUp()
@@ -160,6 +207,117 @@ class TestHttpStore(base.StoreClearingUnitTest):
         loc = get_location_from_uri(uri)
         self.assertRaises(exception.BadStoreUri, self.store.get, loc)
 
+    def test_http_get_range(self):
+        headers = {'content-length': 16, 'content-range': 'bytes 15-30/31'}
+        partial_resp = utils.FakeHTTPResponse(status=206, headers=headers,
+                                              data="short and stout\n")
+        FAKE_RESPONSE_STACK.append(partial_resp)
+
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get_range(loc, 15)
+        self.assertEqual(image_size, 16)
+        self.assertEqual("short and stout\n", ''.join(image_file))
+
+    def test_http_get_range_ignored(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.assertRaises(NotImplementedError, self.store.get_range, loc, 15)
+
+    def test_http_get_parallel(self):
+        data = ''.join(chr(65 + i % 26) for i in range(5000))
+        requests = stub_out_ranged_http_backend(self.stubs, data)
+        self.config(http_store_range_size=1,
+                    http_store_parallel_connections=3)
+
+        loc = get_location_from_uri("http://netloc/path/to/file.tar.gz")
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(5000, image_size)
+        self.assertEqual(data, ''.join(image_file))
+        self.assertEqual(['bytes=0-1023', 'bytes=1024-2047',
+                          'bytes=2048-3071', 'bytes=3072-4095',
+                          'bytes=4096-4999'], sorted(requests))
+
+    def test_http_get_range_parallel(self):
+        data = ''.join(chr(65 + i % 26) for i in range(5000))
+        stub_out_ranged_http_backend(self.stubs, data)
+        self.config(http_store_range_size=1)
+
+        loc = get_location_from_uri("http://netloc/path/to/file.tar.gz")
+        (image_file, image_size) = self.store.get_range(loc, 1500)
+        self.assertEqual(3500, image_size)
+        self.assertEqual(data[1500:], ''.join(image_file))
+
+    def test_http_get_single_connection(self):
+        data = 'x' * 5000
+        requests = stub_out_ranged_http_backend(self.stubs, data)
+        self.config(http_store_range_size=1,
+                    http_store_parallel_connections=1)
+
+        loc = get_location_from_uri("http://netloc/path/to/file.tar.gz")
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(data, ''.join(image_file))
+        self.assertEqual([None], requests)
+
+    def test_http_get_redirect_cached(self):
+        redirect_headers = {"location": "http://example.com/teapot.img"}
+        FAKE_RESPONSE_STACK.append(
+            utils.FakeHTTPResponse(status=302, headers=redirect_headers))
+
+        loc = get_location_from_uri("http://netloc/path/to/file.tar.gz")
+        self.store.get(loc)
+        self.store.get(loc)
+        self.assertEqual(['netloc', 'example.com', 'example.com'],
+                         FAKE_CONNECTIONS)
+
+    def test_http_get_redirect_cache_disabled(self):
+        self.config(http_store_redirect_cache_ttl=0)
+        redirect_headers = {"location": "http://example.com/teapot.img"}
+        FAKE_RESPONSE_STACK.append(
+            utils.FakeHTTPResponse(status=302, headers=redirect_headers))
+
+        loc = get_location_from_uri("http://netloc/path/to/file.tar.gz")
+        self.store.get(loc)
+        self.store.get(loc)
+        self.assertEqual(['netloc', 'example.com', 'netloc'],
+                         FAKE_CONNECTIONS)
+
+    def test_http_get_cached_redirect_gone(self):
+        redirect_headers = {"location": "http://example.com/teapot.img"}
+        FAKE_RESPONSE_STACK.append(
+            utils.FakeHTTPResponse(status=302, headers=redirect_headers))
+
+        loc = get_location_from_uri("http://netloc/path/to/file.tar.gz")
+        self.store.get(loc)
+        FAKE_RESPONSE_STACK.append(
+            utils.FakeHTTPResponse(status=404, data="404 Not Found"))
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(31, image_size)
+        self.assertEqual(['netloc', 'example.com', 'example.com', 'netloc'],
+                         FAKE_CONNECTIONS)
+
+    def test_http_get_size(self):
+        loc = get_location_from_uri("http://netloc/path/to/file.tar.gz")
+        self.assertEqual(31, self.store.get_size(loc))
+        # The size is remembered
+        self.assertEqual(31, self.store.get_size(loc))
+        self.assertEqual(1, len(FAKE_CONNECTIONS))
+
+    def test_http_get_size_after_get(self):
+        data = 'x' * 5000
+        stub_out_ranged_http_backend(self.stubs, data)
+        self.config(http_store_parallel_connections=2,
+                    http_store_range_size=1)
+        loc = get_location_from_uri("http://netloc/path/to/file.tar.gz")
+        image_file, image_size = self.store.get(loc)
+        self.assertEqual(data, "".join(image_file))
+
+        def no_request(*args, **kwargs):
+            self.fail('Unexpected request')
+
+        self.stubs.Set(Store, '_query', no_request)
+        self.assertEqual(len(data), self.store.get_size(loc))
+
     def test_https_get(self):
         uri = "https://netloc/path/to/file.tar.gz"
         expected_returns = ['I ', 'am', ' a', ' t', 'ea', 'po', 't,', ' s',
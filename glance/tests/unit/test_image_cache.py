@@ -294,6 +294,48 @@ class ImageCacheTestCase(object):
         self.assertFalse(os.path.exists(incomplete_file_path))
         self.assertTrue(os.path.exists(invalid_file_path))
 
+    @skip_if_disabled
+    def test_open_for_read_advises_readahead(self):
+        self.config(image_cache_readahead=4)
+        self._setup_fixture_file()
+        advice = []
+        self.stubs.Set(utils, 'fadvise',
+                       lambda fd, offset, length, flag:
+                       advice.append((offset, length, flag)))
+
+        with self.cache.open_for_read(1) as cache_file:
+            chunks = list(utils.chunkiter(cache_file, 1024))
+
+        self.assertEqual([FIXTURE_DATA], chunks)
+        self.assertEqual([(0, 0, utils.POSIX_FADV_SEQUENTIAL),
+                          (0, 4096, utils.POSIX_FADV_WILLNEED)], advice)
+
+    @skip_if_disabled
+    def test_open_for_write_drops_large_files(self):
+        advice = []
+        self.stubs.Set(utils, 'fadvise',
+                       lambda fd, offset, length, flag:
+                       advice.append((offset, length, flag)))
+
+        with self.cache.driver.open_for_write('1') as cache_file:
+            cache_file.write('a')
+        self.assertEqual([], advice)
+
+        self.config(image_cache_drop_threshold=1)
+        with self.cache.driver.open_for_write('2') as cache_file:
+            cache_file.write('a' * 1024 * 1024)
+        self.assertEqual([(0, 0, utils.POSIX_FADV_DONTNEED)], advice)
+        self.assertTrue(self.cache.is_cached('2'))
+
+    @skip_if_disabled
+    def test_get_cached_images_reports_residency(self):
+        self._setup_fixture_file()
+        self.stubs.Set(utils, 'get_page_cache_residency',
+                       lambda path: os.path.getsize(path) // 2)
+        images = self.cache.get_cached_images()
+        self.assertEqual(1, len(images))
+        self.assertEqual(FIXTURE_LENGTH // 2, images[0]['resident'])
+
     def test_caching_iterator(self):
         """
         Test to see if the caching iterator interacts properly with the driver
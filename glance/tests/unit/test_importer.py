@@ -0,0 +1,288 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests the background importer for copy-from images"""
+
+import hashlib
+import os
+import stat
+import time
+
+import eventlet
+import fixtures
+import stubout
+
+from glance.common import exception
+from glance import registry
+from glance.store import filesystem
+from glance.store import importer
+from glance.tests.unit import base
+
+IMAGE_ID = 'c80a1a6c-bd1f-41c5-90ee-81afedb1d58d'
+SOURCE_DATA = ''.join(chr(65 + i % 26) * 10 for i in range(100))
+
+
+class FakeRegistry(object):
+
+    auth_tok = None
+
+    def __init__(self):
+        self.images = {}
+
+    def get_image(self, image_id):
+        if image_id not in self.images:
+            raise exception.NotFound()
+        return dict(self.images[image_id])
+
+    def update_image(self, image_id, image_meta, purge_props=False,
+                     from_state=None):
+        image = self.images[image_id]
+        if from_state is not None and image['status'] != from_state:
+            raise exception.Duplicate()
+        image_meta = dict(image_meta)
+        image['properties'].update(image_meta.pop('properties', {}))
+        image.update(image_meta)
+        return dict(image)
+
+
+class TestImporter(base.StoreClearingUnitTest):
+
+    def setUp(self):
+        super(TestImporter, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.test_dir = self.useFixture(fixtures.TempDir()).path
+        self.datadir = os.path.join(self.test_dir, 'importer')
+        self.config(importer_datadir=self.datadir,
+                    filesystem_store_datadir=os.path.join(self.test_dir,
+                                                          'images'),
+                    default_store='file')
+
+        self.source_path = os.path.join(self.test_dir, 'source')
+        with open(self.source_path, 'wb') as f:
+            f.write(SOURCE_DATA)
+        self.source = 'file://' + self.source_path
+
+        self.registry = FakeRegistry()
+        self.registry.images[IMAGE_ID] = {'id': IMAGE_ID,
+                                          'status': 'queued',
+                                          'properties': {}}
+        self.stubs.Set(registry, 'configure_registry_client', lambda: None)
+        self.stubs.Set(registry, 'configure_registry_admin_creds',
+                       lambda: None)
+        self.stubs.Set(registry, 'get_registry_client',
+                       lambda ctx: self.registry)
+        self.importer = importer.Importer()
+
+    def _queue_path(self):
+        return os.path.join(self.datadir, IMAGE_ID)
+
+    def _staged_path(self):
+        return os.path.join(self.datadir, importer.STAGING_DIR, IMAGE_ID)
+
+    def test_schedule_import(self):
+        importer.schedule_import(IMAGE_ID, self.source, 'file', size=1000)
+        mode = os.stat(self._queue_path()).st_mode
+        self.assertEqual(0600, stat.S_IMODE(mode))
+        task = importer.read_queue_file(self._queue_path())
+        self.assertEqual(self.source, task['source'])
+        self.assertEqual('file', task['store'])
+        self.assertEqual(1000, task['size'])
+        self.assertEqual(0, task['attempts'])
+
+    def test_import(self):
+        checksum = hashlib.md5(SOURCE_DATA).hexdigest()
+        importer.schedule_import(IMAGE_ID, self.source, 'file',
+                                 size=len(SOURCE_DATA), checksum=checksum)
+        self.importer.run()
+
+        image = self.registry.images[IMAGE_ID]
+        self.assertEqual('active', image['status'])
+        self.assertEqual(len(SOURCE_DATA), image['size'])
+        self.assertEqual(checksum, image['checksum'])
+        self.assertEqual(str(len(SOURCE_DATA)),
+                         image['properties']['import_bytes_copied'])
+        with open(image['location'][len('file://'):]) as f:
+            self.assertEqual(SOURCE_DATA, f.read())
+        self.assertFalse(os.path.exists(self._queue_path()))
+        self.assertFalse(os.path.exists(self._staged_path()))
+
+    def _stored_images(self):
+        return os.listdir(os.path.join(self.test_dir, 'images'))
+
+    def test_import_retries_activation_only(self):
+        adds = []
+        orig_add = filesystem.Store.add
+
+        def fake_add(store, *args):
+            adds.append(args[0])
+            return orig_add(store, *args)
+
+        orig_update = self.registry.update_image
+        failures = [IOError('registry unavailable')]
+
+        def flaky_update(image_id, image_meta, *args, **kwargs):
+            if image_meta.get('status') == 'active' and failures:
+                raise failures.pop()
+            return orig_update(image_id, image_meta, *args, **kwargs)
+
+        self.stubs.Set(filesystem.Store, 'add', fake_add)
+        self.stubs.Set(self.registry, 'update_image', flaky_update)
+        importer.schedule_import(IMAGE_ID, self.source, 'file')
+        self.importer.run()
+        task = importer.read_queue_file(self._queue_path())
+        self.assertEqual(1, task['attempts'])
+        self.assertTrue(task['stored']['location'].startswith('file://'))
+
+        task['not_before'] = 0
+        importer.write_queue_file(self._queue_path(), task)
+        self.importer.run()
+        image = self.registry.images[IMAGE_ID]
+        self.assertEqual('active', image['status'])
+        self.assertEqual(task['stored']['location'], image['location'])
+        self.assertEqual([IMAGE_ID], adds)
+        self.assertEqual([IMAGE_ID], self._stored_images())
+        self.assertFalse(os.path.exists(self._queue_path()))
+
+    def test_import_of_image_deleted_meanwhile(self):
+        orig_add = filesystem.Store.add
+
+        def fake_add(store, *args):
+            result = orig_add(store, *args)
+            self.registry.images[IMAGE_ID]['status'] = 'deleted'
+            return result
+
+        self.stubs.Set(filesystem.Store, 'add', fake_add)
+        importer.schedule_import(IMAGE_ID, self.source, 'file')
+        self.importer.run()
+        self.assertEqual('deleted', self.registry.images[IMAGE_ID]['status'])
+        self.assertEqual([], self._stored_images())
+        self.assertFalse(os.path.exists(self._queue_path()))
+
+    def test_import_claimed_by_another_importer(self):
+        importer.schedule_import(IMAGE_ID, self.source, 'file')
+        other = importer.Importer()
+        lock_fd = other._claim(IMAGE_ID)
+        self.assertNotEqual(None, lock_fd)
+        self.importer.run()
+        self.assertEqual('queued', self.registry.images[IMAGE_ID]['status'])
+        self.assertTrue(os.path.exists(self._queue_path()))
+
+        other._release(IMAGE_ID, lock_fd)
+        self.importer.run()
+        self.assertEqual('active', self.registry.images[IMAGE_ID]['status'])
+        self.assertEqual([], os.listdir(os.path.join(self.datadir,
+                                                     importer.LOCK_DIR)))
+
+    def test_import_resumes_with_ranged_read(self):
+        offsets = []
+
+        def fake_get_range(store, location, offset):
+            offsets.append(offset)
+            return [SOURCE_DATA[offset:]], len(SOURCE_DATA) - offset
+
+        self.stubs.Set(filesystem.Store, 'get_range', fake_get_range)
+        importer.schedule_import(IMAGE_ID, self.source, 'file')
+        with open(self._staged_path(), 'wb') as f:
+            f.write(SOURCE_DATA[:400])
+        self.importer.run()
+
+        image = self.registry.images[IMAGE_ID]
+        self.assertEqual([400], offsets)
+        self.assertEqual('active', image['status'])
+        self.assertEqual(hashlib.md5(SOURCE_DATA).hexdigest(),
+                         image['checksum'])
+
+    def test_import_restarts_without_ranged_read(self):
+        importer.schedule_import(IMAGE_ID, self.source, 'file')
+        with open(self._staged_path(), 'wb') as f:
+            f.write('garbage')
+        self.importer.run()
+
+        image = self.registry.images[IMAGE_ID]
+        self.assertEqual('active', image['status'])
+        self.assertEqual(hashlib.md5(SOURCE_DATA).hexdigest(),
+                         image['checksum'])
+
+    def test_import_retries_with_backoff(self):
+        def fake_get(store, location):
+            raise IOError('connection reset')
+
+        self.stubs.Set(filesystem.Store, 'get', fake_get)
+        self.config(importer_retry_backoff=10)
+        importer.schedule_import(IMAGE_ID, self.source, 'file')
+
+        for attempts, delay in ((1, 10), (2, 20)):
+            start = time.time()
+            self.importer.run()
+            task = importer.read_queue_file(self._queue_path())
+            self.assertEqual(attempts, task['attempts'])
+            self.assertTrue(task['not_before'] >= start + delay)
+            # Not due yet
+            self.importer.run()
+            task['not_before'] = 0
+            importer.write_queue_file(self._queue_path(), task)
+
+        self.config(importer_max_retries=2)
+        self.importer.run()
+        self.assertEqual('killed', self.registry.images[IMAGE_ID]['status'])
+        self.assertFalse(os.path.exists(self._queue_path()))
+
+    def test_import_checksum_mismatch(self):
+        importer.schedule_import(IMAGE_ID, self.source, 'file',
+                                 checksum='0' * 32)
+        self.importer.run()
+        self.assertEqual('killed', self.registry.images[IMAGE_ID]['status'])
+        self.assertFalse(os.path.exists(self._queue_path()))
+        self.assertEqual([], os.listdir(os.path.join(self.test_dir,
+                                                     'images')))
+
+    def test_import_missing_source(self):
+        importer.schedule_import(IMAGE_ID, self.source + '.missing', 'file')
+        self.importer.run()
+        self.assertEqual('killed', self.registry.images[IMAGE_ID]['status'])
+        self.assertFalse(os.path.exists(self._queue_path()))
+
+    def test_import_of_deleted_image_is_dropped(self):
+        self.registry.images[IMAGE_ID]['status'] = 'deleted'
+        importer.schedule_import(IMAGE_ID, self.source, 'file')
+        self.importer.run()
+        self.assertEqual('deleted', self.registry.images[IMAGE_ID]['status'])
+        self.assertFalse(os.path.exists(self._queue_path()))
+
+
+class TestRateLimiter(base.StoreClearingUnitTest):
+
+    def test_consume(self):
+        sleeps = []
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(eventlet, 'sleep', sleeps.append)
+        now = time.time()
+        self.stubs.Set(time, 'time', lambda: now)
+
+        limiter = importer.RateLimiter(1000)
+        limiter.consume('a', 500)
+        limiter.consume('a', 500)
+        limiter.consume('b', 500)
+        limiter.consume('a', 500)
+        self.assertEqual([0.5, 1.0], sleeps)
+
+    def test_unlimited(self):
+        limiter = importer.RateLimiter(0)
+        limiter.consume('a', 10 ** 9)
+        self.assertEqual({}, limiter.next_free)
@@ -16,6 +16,10 @@
 #    under the License.
 
 import datetime
+import json
+import os
+
+import fixtures
 import kombu.entity
 import mox
 try:
@@ -28,6 +32,7 @@ import stubout
 from glance.common import exception
 from glance import notifier
 import glance.notifier.notify_kombu
+import glance.notifier.strategy
 from glance.openstack.common import importutils
 import glance.openstack.common.log as logging
 import glance.tests.unit.utils as unit_test_utils
@@ -421,6 +426,275 @@ class TestRabbitContentType(utils.BaseTestCase):
         self.assertEquals(self.called['content_type'], 'application/json')
 
 
+class RecordingStrategy(glance.notifier.strategy.Strategy):
+    """Strategy that remembers every batch it is asked to send."""
+
+    def __init__(self):
+        self.batches = []
+
+    def notify_batch(self, messages):
+        self.batches.append(list(messages))
+
+
+class FailingStrategy(glance.notifier.strategy.Strategy):
+
+    def notify_batch(self, messages):
+        raise Exception('broker unavailable')
+
+
+class TestAsyncDispatcher(utils.BaseTestCase):
+
+    def _message(self, event_type='test_event'):
+        return notifier.Notifier.generate_message(event_type, 'INFO', {})
+
+    def test_put_does_not_publish_inline(self):
+        strategy = RecordingStrategy()
+        dispatcher = notifier.AsyncDispatcher(strategy)
+        dispatcher.put('INFO', self._message())
+        self.assertEqual(strategy.batches, [])
+        dispatcher.wait()
+        self.assertEqual(len(strategy.batches), 1)
+        self.assertEqual(dispatcher.stats['queued'], 1)
+        self.assertEqual(dispatcher.stats['sent'], 1)
+
+    def test_batches_respect_batch_size(self):
+        strategy = RecordingStrategy()
+        dispatcher = notifier.AsyncDispatcher(strategy, batch_size=2)
+        for i in range(5):
+            dispatcher.put('INFO', self._message())
+        dispatcher.wait()
+        self.assertEqual([len(b) for b in strategy.batches], [2, 2, 1])
+        self.assertEqual(dispatcher.stats['sent'], 5)
+
+    def test_full_queue_drops(self):
+        strategy = RecordingStrategy()
+        dispatcher = notifier.AsyncDispatcher(strategy, queue_size=2)
+        for i in range(3):
+            dispatcher.put('INFO', self._message())
+        dispatcher.wait()
+        self.assertEqual(dispatcher.stats['queued'], 2)
+        self.assertEqual(dispatcher.stats['dropped'], 1)
+        self.assertEqual(dispatcher.stats['sent'], 2)
+
+    def test_full_queue_spills_and_replays(self):
+        spill_dir = self.useFixture(fixtures.TempDir()).path
+        strategy = RecordingStrategy()
+        dispatcher = notifier.AsyncDispatcher(strategy, queue_size=1,
+                                              overflow_policy='spill',
+                                              spill_dir=spill_dir)
+        dispatcher.put('INFO', self._message('first'))
+        dispatcher.put('WARN', self._message('second'))
+        self.assertEqual(dispatcher.stats['spilled'], 1)
+        dispatcher.wait()
+        self.assertEqual(dispatcher.stats['dropped'], 0)
+        self.assertEqual(dispatcher.stats['sent'], 2)
+        replayed = strategy.batches[-1]
+        self.assertEqual(replayed[0][0], 'WARN')
+        self.assertEqual(replayed[0][1]['event_type'], 'second')
+        self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_spill_serializes_datetimes(self):
+        spill_dir = self.useFixture(fixtures.TempDir()).path
+        strategy = RecordingStrategy()
+        dispatcher = notifier.AsyncDispatcher(strategy, queue_size=1,
+                                              overflow_policy='spill',
+                                              spill_dir=spill_dir)
+        dispatcher.put('INFO', self._message('first'))
+        msg = self._message('second')
+        msg['payload'] = {'created_at': datetime.datetime(2013, 1, 1)}
+        dispatcher.put('INFO', msg)
+        unserializable = self._message('third')
+        unserializable['payload'] = {'value': object()}
+        dispatcher.put('INFO', unserializable)
+        dispatcher.wait()
+        self.assertEqual(dispatcher.stats['spilled'], 1)
+        self.assertEqual(dispatcher.stats['dropped'], 1)
+        replayed = strategy.batches[-1]
+        self.assertEqual(replayed[0][1]['payload']['created_at'],
+                         '2013-01-01T00:00:00.000000')
+
+    def test_abandoned_replay_files_replayed(self):
+        spill_dir = self.useFixture(fixtures.TempDir()).path
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        # Left by a worker that died while replaying
+        name = 'notifications.spill.%d.abc.replay' % pid
+        with open(os.path.join(spill_dir, name), 'w') as replay:
+            replay.write(json.dumps(['INFO', self._message('lost')]) + '\n')
+        # Being replayed by a running worker
+        name = 'notifications.spill.%d.def.replay' % os.getppid()
+        with open(os.path.join(spill_dir, name), 'w') as replay:
+            replay.write(json.dumps(['INFO', self._message('busy')]) + '\n')
+
+        strategy = RecordingStrategy()
+        dispatcher = notifier.AsyncDispatcher(strategy,
+                                              overflow_policy='spill',
+                                              spill_dir=spill_dir)
+        dispatcher.wait()
+        self.assertEqual([['lost']], [[m['event_type'] for _p, m in b]
+                                      for b in strategy.batches])
+        self.assertEqual([name], os.listdir(spill_dir))
+
+    def test_publish_failure_counts_as_dropped(self):
+        dispatcher = notifier.AsyncDispatcher(FailingStrategy())
+        dispatcher.put('INFO', self._message())
+        dispatcher.wait()
+        self.assertEqual(dispatcher.stats['sent'], 0)
+        self.assertEqual(dispatcher.stats['dropped'], 1)
+
+    def _write_spill(self, spill_dir, lines):
+        with open(os.path.join(spill_dir, 'notifications.spill'), 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+    def _read_spill(self, spill_dir):
+        with open(os.path.join(spill_dir, 'notifications.spill')) as f:
+            return [json.loads(line)[1]['event_type'] for line in f]
+
+    def test_publish_failure_respills(self):
+        spill_dir = self.useFixture(fixtures.TempDir()).path
+        dispatcher = notifier.AsyncDispatcher(FailingStrategy(),
+                                              overflow_policy='spill',
+                                              spill_dir=spill_dir)
+        dispatcher.put('INFO', self._message('first'))
+        dispatcher.wait()
+        self.assertEqual(dispatcher.stats['dropped'], 0)
+        self.assertEqual(dispatcher.stats['spilled'], 1)
+        self.assertEqual(['first'], self._read_spill(spill_dir))
+
+    def test_replay_failure_keeps_unpublished_messages(self):
+        spill_dir = self.useFixture(fixtures.TempDir()).path
+        self._write_spill(spill_dir,
+                          [json.dumps(['INFO', self._message(str(i))])
+                           for i in range(5)])
+        strategy = RecordingStrategy()
+        notify_batch = strategy.notify_batch
+
+        def fail_second_batch(messages):
+            if strategy.batches:
+                raise Exception('broker unavailable')
+            notify_batch(messages)
+
+        strategy.notify_batch = fail_second_batch
+        dispatcher = notifier.AsyncDispatcher(strategy, batch_size=2,
+                                              overflow_policy='spill',
+                                              spill_dir=spill_dir)
+        dispatcher.wait()
+        self.assertEqual([['0', '1']], [[m['event_type'] for _p, m in b]
+                                        for b in strategy.batches])
+        self.assertEqual(['notifications.spill'], os.listdir(spill_dir))
+        self.assertEqual(['2', '3', '4'], sorted(self._read_spill(spill_dir)))
+
+    def test_replay_respects_batch_size(self):
+        spill_dir = self.useFixture(fixtures.TempDir()).path
+        self._write_spill(spill_dir,
+                          [json.dumps(['INFO', self._message()])
+                           for i in range(5)])
+        strategy = RecordingStrategy()
+        dispatcher = notifier.AsyncDispatcher(strategy, batch_size=2,
+                                              overflow_policy='spill',
+                                              spill_dir=spill_dir)
+        dispatcher.wait()
+        self.assertEqual([len(b) for b in strategy.batches], [2, 2, 1])
+        self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_unreadable_spill_lines_skipped(self):
+        spill_dir = self.useFixture(fixtures.TempDir()).path
+        line = json.dumps(['INFO', self._message('good')])
+        self._write_spill(spill_dir, [line, '"INFO"', line[:10], line])
+        strategy = RecordingStrategy()
+        dispatcher = notifier.AsyncDispatcher(strategy,
+                                              overflow_policy='spill',
+                                              spill_dir=spill_dir)
+        dispatcher.wait()
+        self.assertEqual([['good', 'good']], [[m['event_type'] for _p, m in b]
+                                              for b in strategy.batches])
+        self.assertEqual(dispatcher.stats['dropped'], 2)
+        self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_notifier_uses_shared_dispatcher(self):
+        self.addCleanup(notifier._DISPATCHERS.clear)
+        self.config(notifier_strategy='logging', notifier_async=True)
+        first = notifier.Notifier()
+        second = notifier.Notifier()
+        self.assertTrue(first.dispatcher is second.dispatcher)
+        first.info('test_event', 'test_message')
+        first.dispatcher.wait()
+        self.assertEqual(first.dispatcher.stats['sent'], 1)
+
+
+class TestNotificationFiltering(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestNotificationFiltering, self).setUp()
+        self.sent = []
+        self.config(notifier_strategy='logging')
+
+    def _notifier(self):
+        _notifier = notifier.Notifier()
+        self.stubs.Set(_notifier, 'send', self._send)
+        return _notifier
+
+    def _send(self, event_type, priority, payload):
+        self.sent.append((event_type, priority, payload))
+
+    def _fail(self):
+        self.fail('Payload should not have been built')
+
+    def test_noop_never_builds_payload(self):
+        self.config(notifier_strategy='noop')
+        _notifier = notifier.Notifier()
+        self.assertFalse(_notifier.enabled)
+        _notifier.info('test_event', self._fail)
+
+    def test_callable_payload_is_built(self):
+        self._notifier().info('test_event', lambda: {'a': 'b'})
+        self.assertEqual(self.sent, [('test_event', 'INFO', {'a': 'b'})])
+
+    def test_sampled_out_event_not_built(self):
+        self.config(notifier_sample_rates=['image.send:0'])
+        _notifier = self._notifier()
+        _notifier.info('image.send', self._fail)
+        _notifier.info('image.update', {})
+        self.assertEqual([e[0] for e in self.sent], ['image.update'])
+
+    def test_sampling_does_not_apply_to_errors(self):
+        self.config(notifier_sample_rates=['image.send:0'])
+        self._notifier().error('image.send', {})
+        self.assertEqual(len(self.sent), 1)
+
+    def test_invalid_sample_rate_ignored(self):
+        self.config(notifier_sample_rates=['image.send'])
+        self.assertEqual(self._notifier().sample_rates, {})
+
+    def test_rollup_image_send(self):
+        self.config(notifier_rollup_events=['image.send'])
+        _notifier = self._notifier()
+        for image_id, size in [('a', 10), ('a', 20), ('b', 5)]:
+            _notifier.info('image.send', {'image_id': image_id,
+                                          'owner_id': TENANT1,
+                                          'receiver_tenant_id': TENANT1,
+                                          'bytes_sent': size})
+        self.assertEqual(self.sent, [])
+
+        _notifier.rollups['image.send'].flush()
+        summaries = dict((e[2]['image_id'], e[2]) for e in self.sent)
+        self.assertEqual(set(e[0] for e in self.sent),
+                         set(['image.send.summary']))
+        self.assertEqual(summaries['a']['bytes_sent'], 30)
+        self.assertEqual(summaries['a']['count'], 2)
+        self.assertEqual(summaries['b']['bytes_sent'], 5)
+        self.assertEqual(summaries['b']['count'], 1)
+        self.assertEqual(summaries['b']['receiver_tenant_id'], TENANT1)
+
+    def test_rollup_passes_errors_through(self):
+        self.config(notifier_rollup_events=['image.send'])
+        _notifier = self._notifier()
+        _notifier.error('image.send', {'image_id': UUID1, 'bytes_sent': 1})
+        self.assertEqual(self.sent[0][0], 'image.send')
+
+
 class TestImageNotifications(utils.BaseTestCase):
     """Test Image Notifications work"""
 
@@ -136,6 +136,107 @@ class TestPolicyEnforcerNoFile(base.IsolatedUnitTest):
         enforcer.enforce(admin_context, 'manage_image_cache', {})
 
 
+class TestPolicyEnforcerCompiledRules(base.IsolatedUnitTest):
+
+    def _enforcer(self, rules):
+        self.set_policy_rules(rules)
+        return glance.api.policy.Enforcer()
+
+    def _context(self, roles=None, tenant=None, user=None):
+        return glance.context.RequestContext(roles=roles or [],
+                                             tenant=tenant, user=user)
+
+    def test_boolean_expressions(self):
+        enforcer = self._enforcer({
+            'is_admin': 'role:admin',
+            'get_image': 'rule:is_admin or (role:member and not role:banned)',
+        })
+        self.assertTrue(enforcer.check(self._context(['Admin']),
+                                       'get_image', {}))
+        self.assertTrue(enforcer.check(self._context(['member']),
+                                       'get_image', {}))
+        self.assertFalse(enforcer.check(self._context(['member', 'banned']),
+                                        'get_image', {}))
+        self.assertFalse(enforcer.check(self._context(), 'get_image', {}))
+
+    def test_generic_check_with_target(self):
+        enforcer = self._enforcer({'get_image': 'tenant:%(owner)s'})
+        context = self._context(tenant='t1')
+        self.assertTrue(enforcer.check(context, 'get_image',
+                                       {'owner': 't1'}))
+        self.assertFalse(enforcer.check(context, 'get_image',
+                                        {'owner': 't2'}))
+        # A target missing the referenced key fails closed
+        self.assertFalse(enforcer.check(context, 'get_image', {}))
+
+    def test_unknown_rule_uses_default(self):
+        enforcer = self._enforcer({'default': 'role:admin'})
+        self.assertTrue(enforcer.check(self._context(['admin']),
+                                       'get_image', {}))
+        self.assertFalse(enforcer.check(self._context(), 'get_image', {}))
+
+    def test_unknown_rule_without_default_fails_closed(self):
+        enforcer = self._enforcer({'add_image': ''})
+        self.assertFalse(enforcer.check(self._context(), 'get_image', {}))
+
+    def test_decisions_cached_within_request(self):
+        enforcer = self._enforcer({'get_image': 'role:admin'})
+        context = self._context(['admin'])
+        enforcer.check(context, 'get_image', {})
+
+        calls = []
+
+        def fake_evaluate(*args):
+            calls.append(args)
+            return False
+
+        self.stubs.Set(enforcer, '_evaluate', fake_evaluate)
+        self.assertTrue(enforcer.check(context, 'get_image', {}))
+        self.assertFalse(enforcer.check(self._context(['admin']),
+                                        'get_image', {}))
+        self.assertEqual(len(calls), 1)
+
+    def test_decisions_shared_across_requests_with_ttl(self):
+        self.config(policy_cache_ttl=60)
+        enforcer = self._enforcer({'get_image': 'role:admin'})
+        enforcer.check(self._context(['admin']), 'get_image', {})
+
+        self.stubs.Set(enforcer, '_evaluate', lambda *args: False)
+        self.assertTrue(enforcer.check(self._context(['admin']),
+                                       'get_image', {}))
+        self.assertFalse(enforcer.check(self._context(['member']),
+                                        'get_image', {}))
+
+    def test_policy_file_reload_clears_cache(self):
+        self.config(policy_cache_ttl=60)
+        enforcer = self._enforcer({'get_image': '@'})
+        context = self._context()
+        self.assertTrue(enforcer.check(context, 'get_image', {}))
+
+        self.set_policy_rules({'get_image': '!'})
+        enforcer.policy_file_mtime = None
+        self.assertFalse(enforcer.check(context, 'get_image', {}))
+
+    def test_policy_file_check_throttled(self):
+        self.config(policy_file_check_interval=3600)
+        enforcer = self._enforcer({'get_image': '@'})
+        context = self._context()
+        self.assertTrue(enforcer.check(context, 'get_image', {}))
+
+        self.set_policy_rules({'get_image': '!'})
+        enforcer.policy_file_mtime = None
+        self.assertTrue(enforcer.check(context, 'get_image', {}))
+
+        enforcer.last_checked -= 3600
+        self.assertFalse(enforcer.check(context, 'get_image', {}))
+
+    def test_uncacheable_rule_always_evaluated(self):
+        enforcer = self._enforcer({'get_image': 'http://example.com/%(id)s'})
+        self.assertEqual(enforcer.cacheable_rules, set())
+        self.assertEqual(enforcer._decision_key('get_image', {}, {
+            'roles': [], 'tenant': None, 'user': None}), None)
+
+
 class TestImagePolicy(test_utils.BaseTestCase):
     def setUp(self):
         self.image_stub = ImageStub(UUID1)
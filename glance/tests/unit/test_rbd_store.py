@@ -0,0 +1,330 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests the RBD backend store"""
+
+import hashlib
+import StringIO
+import threading
+import time
+
+import fixtures
+
+from glance.common import exception
+from glance.common import utils
+from glance.store.location import Location
+import glance.store.rbd
+from glance.store.rbd import ImageIO
+from glance.tests import utils as test_utils
+
+
+class FakeImage(object):
+    """An in-memory stand-in for an open rbd.Image."""
+
+    def __init__(self, data='', fail_at=None):
+        self.data = bytearray(data)
+        self.fail_at = fail_at
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _enter(self, offset):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        # Later chunks complete first, to exercise reordering
+        time.sleep(0.01 / (1 + offset))
+        with self.lock:
+            self.in_flight -= 1
+        if offset == self.fail_at:
+            raise IOError('I/O error at %d' % offset)
+
+    def read(self, offset, length):
+        self._enter(offset)
+        return str(self.data[offset:offset + length])
+
+    def write(self, data, offset):
+        self._enter(offset)
+        with self.lock:
+            end = offset + len(data)
+            if len(self.data) < end:
+                self.data.extend('\0' * (end - len(self.data)))
+            self.data[offset:end] = data
+        return len(data)
+
+
+class TestImageIO(test_utils.BaseTestCase):
+
+    def test_read_chunks_in_order(self):
+        image = FakeImage(''.join(chr(65 + i) * 4 for i in range(10)))
+        chunks = list(ImageIO(image, 4).read_chunks(40, 4))
+        self.assertEqual(10, len(chunks))
+        self.assertEqual(str(image.data), ''.join(chunks))
+        self.assertTrue(image.max_in_flight > 1)
+        self.assertTrue(image.max_in_flight <= 4)
+
+    def test_read_partial_last_chunk(self):
+        image = FakeImage('x' * 10)
+        self.assertEqual(['xxxx', 'xxxx', 'xx'],
+                         list(ImageIO(image, 2).read_chunks(10, 4)))
+
+    def test_read_short(self):
+        image = FakeImage(''.join(chr(65 + i) * 4 for i in range(10)))
+        read = image.read
+        short_reads = set([0, 8])
+
+        def short_read(offset, length):
+            if offset in short_reads:
+                short_reads.discard(offset)
+                length -= 1
+            return read(offset, length)
+
+        image.read = short_read
+        chunks = list(ImageIO(image, 4).read_chunks(40, 4))
+        self.assertEqual(str(image.data), ''.join(chunks))
+        self.assertEqual([4] * 10, [len(chunk) for chunk in chunks])
+
+    def test_read_past_end(self):
+        image = FakeImage('x' * 10)
+        chunks = ImageIO(image, 2).read_chunks(16, 4)
+        self.assertEqual('xxxx', chunks.next())
+        self.assertEqual('xxxx', chunks.next())
+        self.assertRaises(IOError, list, chunks)
+
+    def test_read_inline(self):
+        image = FakeImage('x' * 10)
+        chunks = list(ImageIO(image, 0).read_chunks(10, 4))
+        self.assertEqual('x' * 10, ''.join(chunks))
+        self.assertEqual(1, image.max_in_flight)
+
+    def test_read_error(self):
+        image = FakeImage('x' * 16, fail_at=8)
+        chunks = ImageIO(image, 4).read_chunks(16, 4)
+        self.assertEqual('xxxx', chunks.next())
+        self.assertEqual('xxxx', chunks.next())
+        self.assertRaises(IOError, chunks.next)
+        self.assertEqual(0, image.in_flight)
+
+    def test_abandoned_read_waits_for_pending(self):
+        image = FakeImage('x' * 40)
+        chunks = ImageIO(image, 4).read_chunks(40, 4)
+        chunks.next()
+        chunks.close()
+        self.assertEqual(0, image.in_flight)
+
+    def test_write_behind(self):
+        image = FakeImage()
+        image_io = ImageIO(image, 3)
+        for i in range(10):
+            image_io.write(chr(65 + i) * 4, i * 4)
+        image_io.wait()
+        self.assertEqual(''.join(chr(65 + i) * 4 for i in range(10)),
+                         str(image.data))
+        self.assertTrue(image.max_in_flight <= 3)
+
+    def test_write_error(self):
+        image = FakeImage(fail_at=4)
+        image_io = ImageIO(image, 4)
+        image_io.write('xxxx', 0)
+        image_io.write('xxxx', 4)
+        self.assertRaises(IOError, image_io.wait)
+
+
+class FakeRados(object):
+    """Stands in for the rados module and a single connected cluster."""
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, fsid):
+        self.fsid = fsid
+
+    def Rados(self, conffile, rados_id):
+        return self
+
+    def connect(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def get_fsid(self):
+        return self.fsid
+
+    def open_ioctx(self, pool):
+        return pool
+
+
+class FakeRBD(object):
+    """Stands in for the rbd module, recording clones and snapshots."""
+
+    RBD_FEATURE_LAYERING = 1
+
+    class ImageExists(Exception):
+        pass
+
+    class ImageNotFound(Exception):
+        pass
+
+    def __init__(self):
+        self.images = {('images', 'parent'): 1024}
+        self.snaps = {}
+        self.protected = set()
+        self.writes = []
+        self.fail_protect = False
+
+    def RBD(self):
+        return self
+
+    def clone(self, p_ioctx, p_name, p_snap, c_ioctx, c_name,
+              features=None, order=None):
+        if (p_ioctx, p_name) not in self.images:
+            raise self.ImageNotFound()
+        if (c_ioctx, c_name) in self.images:
+            raise self.ImageExists()
+        self.images[(c_ioctx, c_name)] = self.images[(p_ioctx, p_name)]
+
+    def create(self, ioctx, name, size, order, old_format=True,
+               features=None):
+        if (ioctx, name) in self.images:
+            raise self.ImageExists()
+        self.images[(ioctx, name)] = size
+
+    def remove(self, ioctx, name):
+        del self.images[(ioctx, name)]
+
+    def Image(self, ioctx, name, snapshot=None):
+        fake_rbd = self
+
+        class Image(object):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def size(self):
+                return fake_rbd.images[(ioctx, name)]
+
+            def write(self, data, offset):
+                fake_rbd.writes.append((offset, data))
+
+            def create_snap(self, snap):
+                fake_rbd.snaps[(ioctx, name)] = snap
+
+            def list_snaps(self):
+                if (ioctx, name) in fake_rbd.snaps:
+                    return [{'name': fake_rbd.snaps[(ioctx, name)]}]
+                return []
+
+            def protect_snap(self, snap):
+                if fake_rbd.fail_protect:
+                    raise Exception('protect failed')
+                fake_rbd.protected.add((ioctx, name, snap))
+
+            def is_protected_snap(self, snap):
+                return (ioctx, name, snap) in fake_rbd.protected
+
+            def unprotect_snap(self, snap):
+                fake_rbd.protected.remove((ioctx, name, snap))
+
+            def remove_snap(self, snap):
+                del fake_rbd.snaps[(ioctx, name)]
+
+        return Image()
+
+
+class TestStore(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestStore, self).setUp()
+        self.config(rbd_store_pool='images')
+        self.rbd = FakeRBD()
+        for attr, value in (('rados', FakeRados('fsid')),
+                            ('rbd', self.rbd),
+                            ('_CLUSTERS', {}),
+                            ('_IOCTXS', {})):
+            self.useFixture(fixtures.MonkeyPatch(
+                'glance.store.rbd.%s' % attr, value))
+        self.store = glance.store.rbd.Store()
+
+    def _location(self, uri):
+        return Location('rbd', glance.store.rbd.StoreLocation, uri=uri)
+
+    def test_add_sparse(self):
+        self.config(rbd_store_chunk_size=1, rbd_store_io_queue_depth=0)
+        chunk = 1024 * 1024
+        contents = '\0' * chunk + '*' * chunk + '\0' * chunk
+        image_file = utils.CooperativeReader(StringIO.StringIO(contents))
+        store = glance.store.rbd.Store()
+
+        uri, size, checksum = store.add('image', image_file, len(contents))
+
+        self.assertEqual('rbd://fsid/images/image/snap', uri)
+        self.assertEqual(hashlib.md5(contents).hexdigest(), checksum)
+        self.assertEqual([(chunk, '*' * chunk)], self.rbd.writes)
+        self.assertEqual(2 * chunk, image_file.sparse_bytes)
+
+    def test_clone(self):
+        location = self._location('rbd://fsid/images/parent/snap')
+        uri, size, checksum = self.store.clone('child', location)
+        self.assertEqual('rbd://fsid/images/child/snap', uri)
+        self.assertEqual(1024, size)
+        self.assertEqual(None, checksum)
+        self.assertEqual('snap', self.rbd.snaps[('images', 'child')])
+
+    def test_clone_removed_on_failure(self):
+        self.rbd.fail_protect = True
+        location = self._location('rbd://fsid/images/parent/snap')
+        self.assertRaises(Exception, self.store.clone, 'child', location)
+        self.assertFalse(('images', 'child') in self.rbd.images)
+        self.assertEqual({}, self.rbd.snaps)
+
+        # Nothing is left behind to make a retry fail with Duplicate
+        self.rbd.fail_protect = False
+        uri, size, checksum = self.store.clone('child', location)
+        self.assertEqual('rbd://fsid/images/child/snap', uri)
+
+    def test_add_removed_on_failure(self):
+        class FailingFile(object):
+            def read(self, length):
+                raise IOError('read failed')
+
+        self.assertRaises(IOError, self.store.add, 'image', FailingFile(),
+                          1024)
+        self.assertFalse(('images', 'image') in self.rbd.images)
+
+    def test_clone_other_cluster(self):
+        location = self._location('rbd://other/images/parent/snap')
+        self.assertRaises(NotImplementedError,
+                          self.store.clone, 'child', location)
+
+    def test_clone_without_snapshot(self):
+        location = self._location('rbd://parent')
+        self.assertRaises(NotImplementedError,
+                          self.store.clone, 'child', location)
+
+    def test_clone_disabled(self):
+        self.config(rbd_store_clone_copy_from=False)
+        location = self._location('rbd://fsid/images/parent/snap')
+        self.assertRaises(NotImplementedError,
+                          self.store.clone, 'child', location)
+
+    def test_clone_missing_parent(self):
+        location = self._location('rbd://fsid/images/missing/snap')
+        self.assertRaises(exception.NotFound,
+                          self.store.clone, 'child', location)
@@ -15,6 +15,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 import StringIO
 import tempfile
 
@@ -103,3 +104,67 @@ class TestUtils(test_utils.BaseTestCase):
                 byte = reader.read(1)
 
         self.assertRaises(exception.ImageSizeLimitExceeded, _consume_all_read)
+
+    def test_is_zero_block(self):
+        self.assertTrue(utils.is_zero_block('\0' * 4096))
+        self.assertFalse(utils.is_zero_block('\0' * 4095 + '\1'))
+        self.assertFalse(utils.is_zero_block('0000'))
+        self.assertFalse(utils.is_zero_block(''))
+
+    def test_sparse_chunkiter(self):
+        """Ensure sparse files read back identically, holes included"""
+        hole = '\0' * (1024 * 1024)
+        data = 'data' * 1024
+        contents = hole + data + hole + data + hole
+        with tempfile.TemporaryFile() as fp:
+            for offset in (len(hole), 2 * len(hole) + len(data)):
+                fp.seek(offset)
+                fp.write(data)
+            fp.truncate(len(contents))
+            fp.seek(0)
+
+            chunks = list(utils.sparse_chunkiter(fp, 65536))
+
+        self.assertEqual(contents, ''.join(chunks))
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 65536)
+
+    def test_zeros_share_one_buffer(self):
+        self.addCleanup(setattr, utils, '_ZERO_CHUNK', utils._ZERO_CHUNK)
+        utils._ZERO_CHUNK = ''
+        for length in (16, 64, 8, 64):
+            self.assertEqual('\0' * length, utils._zeros(length))
+        self.assertTrue(utils._zeros(64) is utils._zeros(64))
+        self.assertEqual(64, len(utils._ZERO_CHUNK))
+
+    def test_sparse_chunkiter_of_stringio(self):
+        data = StringIO.StringIO('\0' * 100 + 'data')
+        self.assertEqual(['\0' * 64, '\0' * 36 + 'data'],
+                         list(utils.sparse_chunkiter(data, 64)))
+
+    def test_rechunk(self):
+        chunks = ['ab', 'cdefg', '', 'h', 'ijklmnopq', 'r']
+        self.assertEqual(['abcd', 'efgh', 'ijkl', 'mnop', 'qr'],
+                         list(utils.rechunk(iter(chunks), 4)))
+        self.assertEqual(['abcd', 'efgh'],
+                         list(utils.rechunk(iter(['abcd', 'efgh']), 4)))
+
+    def test_fallocate_and_fadvise(self):
+        with tempfile.TemporaryFile() as fp:
+            fd = fp.fileno()
+            # Either succeeds or reports that it is unsupported
+            utils.fallocate(fd, 0, 4096)
+            self.assertEqual(0, os.fstat(fd).st_size)
+            utils.fadvise(fd, 0, 0, utils.POSIX_FADV_DONTNEED)
+            utils.fdatasync(fd)
+
+    def test_get_page_cache_residency(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            self.assertEqual(0, utils.get_page_cache_residency(fp.name))
+            fp.write('*' * 8192)
+            fp.flush()
+            resident = utils.get_page_cache_residency(fp.name)
+            self.assertTrue(resident is None or 0 <= resident <= 8192)
+
+    def test_get_rss(self):
+        rss = utils.get_rss()
+        self.assertTrue(rss is None or rss > 0)
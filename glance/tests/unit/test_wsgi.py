@@ -15,8 +15,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import fcntl
+import logging
+import multiprocessing
+import os
+import signal
+import StringIO
+
+import eventlet
+import eventlet.event
+import eventlet.wsgi
+import stubout
 import webob
 
+from glance.common import config
 from glance.common import exception
 from glance.common import utils
 from glance.common import wsgi
@@ -197,6 +209,434 @@ class JSONRequestDeserializerTest(test_utils.BaseTestCase):
         self.assertEqual(actual, expected)
 
 
+class KeepAliveMiddlewareTest(test_utils.BaseTestCase):
+
+    def _call(self, body, content_length, method='GET'):
+        def app(environ, start_response):
+            start_response('200 OK',
+                           [('Content-Length', str(content_length))])
+            return iter(body)
+
+        environ = {'REQUEST_METHOD': method}
+        result = wsgi.KeepAliveMiddleware(app)(environ, lambda *args: None)
+        self.assertEqual(''.join(body), ''.join(result))
+        return environ
+
+    def test_complete_body(self):
+        environ = self._call(['abc', 'def'], 6)
+        self.assertFalse('glance.close_connection' in environ)
+
+    def test_short_body_closes_connection(self):
+        environ = self._call(['abc'], 6)
+        self.assertTrue(environ['glance.close_connection'])
+
+    def test_head_request(self):
+        environ = self._call([], 6, method='HEAD')
+        self.assertFalse('glance.close_connection' in environ)
+
+
+class HttpProtocolTest(test_utils.BaseTestCase):
+
+    def _serve(self):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return ['ok']
+
+        sock = eventlet.listen(('127.0.0.1', 0))
+        server = eventlet.spawn(eventlet.wsgi.server, sock, app,
+                                protocol=wsgi.HttpProtocol,
+                                log=StringIO.StringIO())
+        self.addCleanup(server.kill)
+        return sock.getsockname()[1]
+
+    def _responses(self, port, requests):
+        client = eventlet.connect(('127.0.0.1', port))
+        client.settimeout(5)
+        client.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n' *
+                       requests)
+        data = ''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                return data.count('HTTP/1.1 200 OK')
+            data += chunk
+
+    def test_max_requests(self):
+        self.config(http_keepalive_max_requests=3)
+        self.assertEqual(3, self._responses(self._serve(), 5))
+
+    def test_idle_timeout(self):
+        self.config(http_keepalive_timeout=1,
+                    http_keepalive_max_requests=0)
+        self.assertEqual(2, self._responses(self._serve(), 2))
+
+    def test_close_idle(self):
+        self.config(http_keepalive_timeout=0)
+        client = eventlet.connect(('127.0.0.1', self._serve()))
+        client.settimeout(5)
+        client.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        data = ''
+        while not data.endswith('ok'):
+            data += client.recv(4096)
+        # Let the server wait for the next request
+        eventlet.sleep(0.1)
+        self.assertEqual(1, len(wsgi.HttpProtocol.idle))
+        wsgi.HttpProtocol.close_idle()
+        self.assertEqual('', client.recv(4096))
+        self.assertEqual(set(), wsgi.HttpProtocol.idle)
+
+
+class AdmissionControllerTest(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(AdmissionControllerTest, self).setUp()
+        self.config(admission_max_data_requests=1,
+                    admission_max_metadata_requests=1,
+                    admission_data_queue_timeout=0.01,
+                    admission_metadata_queue_timeout=0.01,
+                    admission_retry_after=7)
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Length', '2')])
+            return ['ok']
+
+        self.controller = wsgi.AdmissionController(app)
+
+    def _call(self, method, path, content_type=None):
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'wsgi.url_scheme': 'http'}
+        if content_type:
+            environ['CONTENT_TYPE'] = content_type
+        responses = []
+
+        def start_response(status, headers, exc_info=None):
+            responses.append((status, dict(headers)))
+
+        result = self.controller(environ, start_response)
+        return responses[0][0], responses[0][1], result
+
+    def test_classify(self):
+        for method, path, content_type, expected in (
+                ('GET', '/v1/images/123', None, 'data'),
+                ('GET', '/v2/images/123/file', None, 'data'),
+                ('PUT', '/v2/images/123/file', 'application/octet-stream',
+                 'data'),
+                ('POST', '/v1/images', 'application/octet-stream', 'data'),
+                ('GET', '/v1/images/detail', None, 'metadata'),
+                ('HEAD', '/v1/images/123', None, 'metadata'),
+                ('GET', '/v2/images/123', None, 'metadata'),
+                ('PUT', '/v1/images/123', 'application/json', 'metadata')):
+            environ = {'REQUEST_METHOD': method, 'PATH_INFO': path}
+            if content_type:
+                environ['CONTENT_TYPE'] = content_type
+            self.assertEqual(expected, self.controller.classify(environ))
+
+    def test_rejects_when_busy(self):
+        status, headers, first = self._call('GET', '/v1/images/detail')
+        self.assertEqual('200 OK', status)
+
+        status, headers, result = self._call('GET', '/v1/images/detail')
+        self.assertEqual('503 Service Unavailable', status)
+        self.assertEqual('7', headers['Retry-After'])
+
+        # Data transfers are limited separately
+        status, headers, data = self._call('GET', '/v1/images/123')
+        self.assertEqual('200 OK', status)
+
+        stats = self.controller.stats()
+        self.assertEqual({'active': 1, 'queued': 0, 'admitted': 1,
+                          'rejected': 1}, stats['metadata'])
+        self.assertEqual(1, stats['data']['active'])
+
+    def test_slot_held_until_body_sent(self):
+        status, headers, result = self._call('GET', '/v1/images/123')
+        self.assertEqual(['ok'], list(result))
+        self.assertEqual(1, self.controller.stats()['data']['active'])
+        result.close()
+        self.assertEqual(0, self.controller.stats()['data']['active'])
+        status, headers, result = self._call('GET', '/v1/images/123')
+        self.assertEqual('200 OK', status)
+
+    def test_queued_request_admitted(self):
+        self.config(admission_metadata_queue_timeout=5)
+        self.controller = wsgi.AdmissionController(
+            self.controller.application)
+        status, headers, first = self._call('GET', '/v1/images')
+        eventlet.spawn_after(0.01, first.close)
+        status, headers, second = self._call('GET', '/v1/images')
+        self.assertEqual('200 OK', status)
+        self.assertEqual(2, self.controller.stats()['metadata']['admitted'])
+
+    def test_unlimited(self):
+        self.config(admission_max_metadata_requests=0)
+        controller = wsgi.AdmissionController(self.controller.application)
+        self.assertEqual(['data'], controller.stats().keys())
+
+
+class GetNumWorkersTest(test_utils.BaseTestCase):
+
+    def test_number(self):
+        self.config(workers='3')
+        self.assertEqual(3, wsgi.get_num_workers())
+        self.config(workers=0)
+        self.assertEqual(0, wsgi.get_num_workers())
+
+    def test_auto(self):
+        self.config(workers='auto')
+        self.assertEqual(multiprocessing.cpu_count(), wsgi.get_num_workers())
+
+    def test_invalid(self):
+        for value in ('-1', 'many'):
+            self.config(workers=value)
+            self.assertRaises(exception.WorkerCreationFailure,
+                              wsgi.get_num_workers)
+
+
+class ServerTest(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(ServerTest, self).setUp()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.signals = []
+        self.stubs.Set(os, 'kill',
+                       lambda pid, sig: self.signals.append((pid, sig)))
+        self.server = wsgi.Server()
+        self.server.logger = logging.getLogger('test')
+        self.server.children = [1, 2]
+        self.next_pid = 3
+
+        def run_child():
+            self.server.children.append(self.next_pid)
+            self.next_pid += 1
+
+        self.stubs.Set(self.server, 'run_child', run_child)
+
+    def test_reload(self):
+        self.stubs.Set(config, 'reload_config', lambda: None)
+        self.config(workers=3)
+        self.server.reload()
+        self.assertEqual([3, 4, 5], self.server.children)
+        self.assertEqual(set([1, 2]), self.server.stale_children)
+        self.assertEqual([(1, signal.SIGHUP), (2, signal.SIGHUP)],
+                         self.signals)
+
+    def test_reload_bad_config(self):
+        def reload_config():
+            raise RuntimeError('bad config')
+
+        self.stubs.Set(config, 'reload_config', reload_config)
+        self.server.reload()
+        self.assertEqual([1, 2], self.server.children)
+        self.assertEqual([], self.signals)
+
+    def test_reload_rebuilds_application(self):
+        self.stubs.Set(config, 'reload_config', lambda: None)
+        self.config(workers=1)
+        self.server.application = 'old'
+        self.server.app_factory = lambda: 'new'
+        self.server.reload()
+        self.assertEqual('new', self.server.application)
+        self.assertEqual([3], self.server.children)
+
+    def test_reload_application_fails(self):
+        def app_factory():
+            raise RuntimeError('bad pipeline')
+
+        self.stubs.Set(config, 'reload_config', lambda: None)
+        self.server.application = 'old'
+        self.server.app_factory = app_factory
+        self.server.reload()
+        self.assertEqual('old', self.server.application)
+        self.assertEqual([1, 2], self.server.children)
+        self.assertEqual([], self.signals)
+
+    def test_reload_bad_workers(self):
+        self.stubs.Set(config, 'reload_config', lambda: None)
+        for workers in ('-1', '0'):
+            self.config(workers=workers)
+            self.server.reload()
+            self.assertEqual([1, 2], self.server.children)
+            self.assertEqual([], self.signals)
+
+    def test_reload_fork_fails(self):
+        def run_child():
+            if self.server.children:
+                raise OSError('fork failed')
+            self.server.children.append(3)
+
+        self.stubs.Set(config, 'reload_config', lambda: None)
+        self.stubs.Set(self.server, 'run_child', run_child)
+        self.config(workers=2)
+        self.server.application = 'old'
+        self.server.app_factory = lambda: 'new'
+        self.server.reload()
+        self.assertEqual('old', self.server.application)
+        self.assertEqual([1, 2], self.server.children)
+        self.assertEqual(set([3]), self.server.stale_children)
+        self.assertEqual([(3, signal.SIGHUP)], self.signals)
+
+    def test_drained_children_not_respawned(self):
+        self.server.sock = None
+        self.server.children = [2]
+        self.server.stale_children = set([1])
+        exits = [(1, 0), (2, 0)]
+
+        def wait():
+            if len(exits) == 1:
+                self.server.running = False
+            return exits.pop(0)
+
+        self.stubs.Set(os, 'wait', wait)
+        self.server.wait_on_children()
+        self.assertEqual(set(), self.server.stale_children)
+        self.assertEqual([3], self.server.children)
+
+    def _stub_waitpid(self, running):
+        def waitpid(pid, options):
+            if pid in running and options == os.WNOHANG:
+                return 0, 0
+            running.discard(pid)
+            return pid, 0
+
+        self.stubs.Set(os, 'waitpid', waitpid)
+        self.stubs.Set(wsgi.time, 'sleep', lambda seconds: None)
+
+    def test_reap_drained_children(self):
+        self._stub_waitpid(set())
+        self.server.stale_children = set([3])
+        self.server.reap_drained_children([1, 2, 3])
+        self.assertEqual([], self.signals)
+        self.assertEqual([], self.server.children)
+        self.assertEqual(set(), self.server.stale_children)
+
+    def test_reap_drained_children_kills_stragglers(self):
+        self.config(worker_drain_timeout=1)
+        self._stub_waitpid(set([2]))
+        now = [0]
+
+        def fake_time():
+            now[0] += 0.5
+            return now[0]
+
+        self.stubs.Set(wsgi.time, 'time', fake_time)
+        self.server.reap_drained_children([1, 2])
+        self.assertEqual([(2, signal.SIGKILL)], self.signals)
+
+    def test_shutdown_waits_for_children(self):
+        self.server.sock = None
+        self.server.running = False
+        self.server.shutting_down = True
+        reaped = []
+        self.stubs.Set(self.server, 'reap_drained_children', reaped.append)
+        self.server.wait_on_children()
+        self.assertEqual([[1, 2]], reaped)
+
+    def test_recycle_children(self):
+        self.server.recycle_pipe = os.pipe()
+        self.addCleanup(os.close, self.server.recycle_pipe[0])
+        self.addCleanup(os.close, self.server.recycle_pipe[1])
+        fcntl.fcntl(self.server.recycle_pipe[0], fcntl.F_SETFL,
+                    os.O_NONBLOCK)
+        os.write(self.server.recycle_pipe[1], '2\n7\n')
+        self.server.recycle_children()
+        self.assertEqual([1, 3], self.server.children)
+        self.assertEqual(set([2]), self.server.stale_children)
+        self.assertEqual([(2, signal.SIGHUP)], self.signals)
+
+        # Nothing left to read
+        self.server.recycle_children()
+        self.assertEqual([1, 3], self.server.children)
+
+    def test_serve_keepalive(self):
+        calls = []
+
+        def fake_server(sock, application, **kwargs):
+            calls.append(kwargs['keepalive'])
+
+        self.stubs.Set(eventlet.wsgi, 'server', fake_server)
+        self.server.pool = None
+        self.server._serve(None, None)
+        self.config(http_keepalive=False)
+        self.server._serve(None, None)
+        self.assertEqual([True, False], calls)
+
+    def test_serve_accept_queue(self):
+        served = []
+
+        class FakeWsgiServer(object):
+            socket_timeout = None
+
+            def process_request(self, client_socket):
+                served.append(client_socket)
+                client_socket[0].close()
+
+        self.server.sock = eventlet.listen(('127.0.0.1', 0))
+        self.addCleanup(self.server.sock.close)
+        self.server.pool = eventlet.GreenPool()
+        self.server.wsgi_server = eventlet.event.Event()
+        self.server.wsgi_server.send(FakeWsgiServer())
+        clients = [eventlet.connect(self.server.sock.getsockname())
+                   for i in range(2)]
+        for client in clients:
+            self.addCleanup(client.close)
+        self.server._serve_accept_queue()
+        self.server.pool.waitall()
+        self.assertEqual(2, len(served))
+
+    def test_get_socket_reuse_port(self):
+        if wsgi.SO_REUSEPORT is None:
+            return
+        sock = wsgi.get_socket(0, reuse_port=True)
+        self.addCleanup(sock.close)
+        self.config(bind_host='127.0.0.1',
+                    bind_port=sock.getsockname()[1])
+        second = wsgi.get_socket(0, reuse_port=True)
+        second.close()
+
+
+class RecycleMiddlewareTest(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(RecycleMiddlewareTest, self).setUp()
+        self.recycled = []
+        self.rss = 10 * 1024 * 1024
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(utils, 'get_rss', lambda: self.rss)
+
+    def _middleware(self):
+        def app(environ, start_response):
+            return ['ok']
+
+        return wsgi.RecycleMiddleware(
+            app, lambda *args: self.recycled.append(args))
+
+    def _call(self, middleware, count):
+        for i in range(count):
+            self.assertEqual(['ok'], middleware({}, None))
+
+    def test_max_requests(self):
+        self.config(worker_max_requests=10)
+        middleware = self._middleware()
+        self.assertTrue(10 <= middleware.max_requests <= 11)
+        self._call(middleware, 9)
+        self.assertEqual([], self.recycled)
+        self._call(middleware, 5)
+        self.assertEqual(1, len(self.recycled))
+        self.assertEqual(self.rss, self.recycled[0][1])
+
+    def test_max_rss(self):
+        self.config(worker_max_rss=20)
+        middleware = self._middleware()
+        self._call(middleware, 5)
+        self.assertEqual([], self.recycled)
+        self.rss = 21 * 1024 * 1024
+        self._call(middleware, 5)
+        self.assertEqual(1, len(self.recycled))
+
+
 class TestHelpers(test_utils.BaseTestCase):
 
     def test_headers_are_unicode(self):
@@ -128,6 +128,8 @@ class FakeStoreAPI(object):
             raise exception.Forbidden()
         if context.user == USER3:
             raise exception.StorageWriteDenied()
+        if hasattr(data, 'read'):
+            data = ''.join(iter(data.read, ''))
         self.data[image_id] = (data, size or len(data))
         checksum = 'Z'
         return (image_id, size, checksum)
@@ -154,21 +156,21 @@ class FakeNotifier(object):
         log = {}
         log['notification_type'] = "WARN"
         log['event_type'] = event_type
-        log['payload'] = payload
+        log['payload'] = payload() if callable(payload) else payload
         self.log.append(log)
 
     def info(self, event_type, payload):
         log = {}
         log['notification_type'] = "INFO"
         log['event_type'] = event_type
-        log['payload'] = payload
+        log['payload'] = payload() if callable(payload) else payload
         self.log.append(log)
 
     def error(self, event_type, payload):
         log = {}
         log['notification_type'] = "ERROR"
         log['event_type'] = event_type
-        log['payload'] = payload
+        log['payload'] = payload() if callable(payload) else payload
         self.log.append(log)
 
     def get_logs(self):
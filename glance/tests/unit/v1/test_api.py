@@ -32,12 +32,14 @@ from glance.api.v1 import images
 from glance.api.v1 import router
 import glance.common.config
 import glance.context
+import glance.notifier
 from glance.db.sqlalchemy import api as db_api
 from glance.db.sqlalchemy import models as db_models
 from glance.openstack.common import cfg
 from glance.openstack.common import timeutils
 from glance.openstack.common import uuidutils
 from glance.registry.api import v1 as rserver
+import glance.registry.client
 import glance.store.filesystem
 from glance.tests.unit import base
 from glance.tests import utils as test_utils
@@ -1744,6 +1746,45 @@ class TestRegistryAPI(base.IsolatedUnitTest):
         for k, v in fixture.iteritems():
             self.assertEquals(v, res_dict['image'][k])
 
+    def test_update_image_from_state(self):
+        """Tests the registry refuses updates of images in other states"""
+        req = webob.Request.blank('/images/%s' % UUID2)
+        req.method = 'PUT'
+        req.content_type = 'application/json'
+        req.headers['X-Glance-Registry-From-State'] = 'saving'
+        req.body = json.dumps(dict(image={'status': 'active'}))
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CONFLICT)
+
+        req.headers['X-Glance-Registry-From-State'] = 'active'
+        req.body = json.dumps(dict(image={'status': 'saving'}))
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+        self.assertEquals('saving', json.loads(res.body)['image']['status'])
+
+    def test_update_image_version(self):
+        """Tests the registry refuses updates based on a stale version"""
+        req = webob.Request.blank('/images/%s' % UUID2)
+        version = json.loads(req.get_response(self.api).body)['image'][
+            'version']
+
+        req.method = 'PUT'
+        req.content_type = 'application/json'
+        req.body = json.dumps(dict(image={'name': 'ping'}))
+        req.headers['X-Glance-Registry-Version'] = str(version - 1)
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CONFLICT)
+
+        req.headers['X-Glance-Registry-Version'] = 'bogus'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.BAD_REQUEST)
+
+        req.headers['X-Glance-Registry-Version'] = str(version)
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 200)
+        self.assertEquals(version + 1,
+                          json.loads(res.body)['image']['version'])
+
     def test_update_image_not_existing(self):
         """
         Tests proper exception is raised if attempt to update
@@ -2267,6 +2308,153 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         res = req.get_response(self.api)
         self.assertEquals(res.status_int, webob.exc.HTTPBadRequest.code)
 
+        # The image is not reserved
+        images = db_api.image_get_all(self.context)
+        self.assertEquals(len(self.FIXTURES), len(images))
+
+    def _record_registry_requests(self):
+        requests = []
+        orig_do_request = glance.registry.client.RegistryClient.do_request
+
+        def fake_do_request(client, method, action, **kwargs):
+            requests.append((method, action))
+            return orig_do_request(client, method, action, **kwargs)
+
+        self.stubs.Set(glance.registry.client.RegistryClient, 'do_request',
+                       fake_do_request)
+        return requests
+
+    def test_add_image_registry_requests(self):
+        """Tests an image is added with data in two registry requests"""
+        requests = self._record_registry_requests()
+        fixture_headers = {'x-image-meta-store': 'file',
+                           'x-image-meta-disk-format': 'vhd',
+                           'x-image-meta-container-format': 'ovf',
+                           'x-image-meta-name': 'fake image #3'}
+
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        for k, v in fixture_headers.iteritems():
+            req.headers[k] = v
+
+        req.headers['Content-Type'] = 'application/octet-stream'
+        req.body = "chunk00000remainder"
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CREATED)
+        res_body = json.loads(res.body)['image']
+        self.assertEquals('active', res_body['status'])
+        self.assertEquals(19, res_body['size'])
+        self.assertEquals(hashlib.md5("chunk00000remainder").hexdigest(),
+                          res_body['checksum'])
+        # Reserved in 'saving', then activated; the image is not
+        # fetched in between
+        image_path = '/images/%s' % res_body['id']
+        self.assertEquals([('POST', '/images'), ('PUT', image_path)],
+                          [r for r in requests if r[0] != 'GET'])
+        self.assertFalse(('GET', image_path) in requests)
+
+    def test_add_image_upload_notification(self):
+        """Tests image.upload is sent with the activated image"""
+        notifications = []
+
+        def fake_info(notifier, event_type, payload):
+            notifications.append((event_type, payload))
+
+        self.stubs.Set(glance.notifier.Notifier, 'info', fake_info)
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        req.headers['x-image-meta-store'] = 'file'
+        req.headers['x-image-meta-disk-format'] = 'vhd'
+        req.headers['x-image-meta-container-format'] = 'ovf'
+        req.headers['x-image-meta-name'] = 'fake image #3'
+        req.headers['Content-Type'] = 'application/octet-stream'
+        req.body = "chunk00000remainder"
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CREATED)
+
+        event_types = [event_type for event_type, _payload in notifications]
+        self.assertEquals(['image.create', 'image.prepare', 'image.upload',
+                           'image.activate', 'image.update'], event_types)
+        payload = notifications[2][1]
+        self.assertEquals('active', payload['status'])
+        self.assertEquals(19, payload['size'])
+        self.assertTrue(payload['location'].startswith('file://'))
+        self.assertEquals(0, payload['sparse_bytes'])
+
+    def test_upload_to_image_no_longer_queued(self):
+        """Tests an upload is refused if the image leaves 'queued'"""
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        req.headers['x-image-meta-name'] = 'fake image #3'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CREATED)
+        image_meta = json.loads(res.body)['image']
+        self.assertEquals('queued', image_meta['status'])
+
+        # Another request starts uploading after this one has checked
+        # the image is queued
+        orig_update = glance.registry.update_image_metadata
+
+        def fake_update(context, image_id, values, *args, **kwargs):
+            if values.get('status') == 'saving':
+                orig_update(context, image_id, {'status': 'saving'})
+            return orig_update(context, image_id, values, *args, **kwargs)
+
+        self.stubs.Set(glance.registry, 'update_image_metadata', fake_update)
+        req = webob.Request.blank("/images/%s" % image_meta['id'])
+        req.method = 'PUT'
+        req.headers['Content-Type'] = 'application/octet-stream'
+        req.headers['x-image-meta-disk-format'] = 'vhd'
+        req.headers['x-image-meta-container-format'] = 'ovf'
+        req.body = "chunk00000remainder"
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CONFLICT)
+
+        req = webob.Request.blank("/images/%s" % image_meta['id'])
+        req.method = 'HEAD'
+        res = req.get_response(self.api)
+        self.assertEquals('saving', res.headers['x-image-meta-status'])
+
+    def _copy_from_request(self):
+        req = webob.Request.blank("/images")
+        req.context = self.context
+        req.headers['x-image-meta-store'] = 'file'
+        req.headers['x-glance-api-copy-from'] = 'http://example.com/image'
+        return req
+
+    def test_copy_from_cloned_in_store(self):
+        """Tests a copy the store clones does not open the source"""
+        def fake_clone(store, image_id, source):
+            return 'file:///tmp/clone', 19, None
+
+        def fake_get_from_backend(context, uri, **kwargs):
+            self.fail('source opened for a cloned image')
+
+        self.stubs.Set(images.Controller, '_clone_in_store',
+                       staticmethod(fake_clone))
+        self.stubs.Set(images, 'get_from_backend', fake_get_from_backend)
+        image_meta = {'id': uuidutils.generate_uuid(), 'status': 'saving',
+                      'size': 0}
+        location, update_data, sparse_bytes = images.Controller()._upload(
+            self._copy_from_request(), image_meta)
+        self.assertEquals('file:///tmp/clone', location)
+        self.assertEquals({'size': 19}, update_data)
+        self.assertEquals(0, sparse_bytes)
+
+    def test_copy_from_not_cloned_opens_source(self):
+        """Tests a copy the store cannot clone streams the source"""
+        def fake_get_from_backend(context, uri, **kwargs):
+            self.assertEquals('http://example.com/image', uri)
+            return StringIO.StringIO('chunk00000remainder'), 19
+
+        self.stubs.Set(images, 'get_from_backend', fake_get_from_backend)
+        image_meta = {'id': uuidutils.generate_uuid(), 'status': 'saving',
+                      'size': 0}
+        location, update_data, sparse_bytes = images.Controller()._upload(
+            self._copy_from_request(), image_meta)
+        self.assertTrue(location.startswith('file://'))
+        self.assertEquals(19, update_data['size'])
+
     def test_add_image_basic_file_store(self):
         """Tests to add a basic image in the file store"""
         fixture_headers = {'x-image-meta-store': 'file',
@@ -3403,7 +3591,7 @@ class TestImageSerializer(base.IsolatedUnitTest):
         }
 
         def fake_info(_event_type, _payload):
-            self.assertEqual(_payload, expected_payload)
+            self.assertEqual(_payload(), expected_payload)
             called['notified'] = True
 
         self.stubs.Set(self.serializer.notifier, 'info', fake_info)
@@ -3432,7 +3620,7 @@ class TestImageSerializer(base.IsolatedUnitTest):
         }
 
         def fake_error(_event_type, _payload):
-            self.assertEqual(_payload, expected_payload)
+            self.assertEqual(_payload(), expected_payload)
             called['notified'] = True
 
         self.stubs.Set(self.serializer.notifier, 'error', fake_error)
@@ -55,7 +55,8 @@ class TestImagesController(base.StoreClearingUnitTest):
 
     def test_upload_download(self):
         request = unit_test_utils.get_fake_request()
-        self.controller.upload(request, unit_test_utils.UUID2, 'YYYY', 4)
+        self.controller.upload(request, unit_test_utils.UUID2,
+                               StringIO.StringIO('YYYY'), 4)
         output = self.controller.download(request, unit_test_utils.UUID2)
         self.assertEqual(set(['data', 'meta']), set(output.keys()))
         self.assertEqual(4, output['meta']['size'])
@@ -64,7 +65,8 @@ class TestImagesController(base.StoreClearingUnitTest):
 
     def test_upload_download_prepare_notification(self):
         request = unit_test_utils.get_fake_request()
-        self.controller.upload(request, unit_test_utils.UUID2, 'YYYY', 4)
+        self.controller.upload(request, unit_test_utils.UUID2,
+                               StringIO.StringIO('YYYY'), 4)
         output = self.controller.download(request, unit_test_utils.UUID2)
         output_log = self.notifier.get_logs()
         prepare_payload = output['meta'].copy()
@@ -73,6 +75,7 @@ class TestImagesController(base.StoreClearingUnitTest):
         prepare_payload['location'] = None
         prepare_payload['status'] = 'queued'
         del prepare_payload['updated_at']
+        del prepare_payload['version']
         prepare_log = {
             'notification_type': "INFO",
             'event_type': "image.prepare",
@@ -82,14 +85,18 @@ class TestImagesController(base.StoreClearingUnitTest):
         prepare_updated_at = output_log[0]['payload']['updated_at']
         del output_log[0]['payload']['updated_at']
         self.assertTrue(prepare_updated_at <= output['meta']['updated_at'])
+        prepare_version = output_log[0]['payload'].pop('version')
+        self.assertTrue(prepare_version < output['meta']['version'])
         self.assertEqual(output_log[0], prepare_log)
 
     def test_upload_download_upload_notification(self):
         request = unit_test_utils.get_fake_request()
-        self.controller.upload(request, unit_test_utils.UUID2, 'YYYY', 4)
+        self.controller.upload(request, unit_test_utils.UUID2,
+                               StringIO.StringIO('YYYY'), 4)
         output = self.controller.download(request, unit_test_utils.UUID2)
         output_log = self.notifier.get_logs()
         upload_payload = output['meta'].copy()
+        upload_payload['sparse_bytes'] = 0
         upload_log = {
             'notification_type': "INFO",
             'event_type': "image.upload",
@@ -100,7 +107,8 @@ class TestImagesController(base.StoreClearingUnitTest):
 
     def test_upload_download_activate_notification(self):
         request = unit_test_utils.get_fake_request()
-        self.controller.upload(request, unit_test_utils.UUID2, 'YYYY', 4)
+        self.controller.upload(request, unit_test_utils.UUID2,
+                               StringIO.StringIO('YYYY'), 4)
         output = self.controller.download(request, unit_test_utils.UUID2)
         output_log = self.notifier.get_logs()
         activate_payload = output['meta'].copy()
@@ -141,7 +149,8 @@ class TestImagesController(base.StoreClearingUnitTest):
 
     def test_upload_download_no_size(self):
         request = unit_test_utils.get_fake_request()
-        self.controller.upload(request, unit_test_utils.UUID2, 'YYYY', None)
+        self.controller.upload(request, unit_test_utils.UUID2,
+                               StringIO.StringIO('YYYY'), None)
         output = self.controller.download(request, unit_test_utils.UUID2)
         self.assertEqual(set(['data', 'meta']), set(output.keys()))
         self.assertEqual(4, output['meta']['size'])
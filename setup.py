@@ -51,6 +51,7 @@ setuptools.setup(
              'bin/glance-cache-manage',
              'bin/glance-cache-cleaner',
              'bin/glance-control',
+             'bin/glance-importer',
              'bin/glance-manage',
              'bin/glance-registry',
              'bin/glance-replicator',
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure how fast pages of images are listed, and the memory used to list
+one page, through glance.db.sqlalchemy.api.image_get_all, which reads
+rows with a plain SELECT, and through the Image model query it replaced.
+Both include the conversion made by the registry's make_image_dict.
+
+    python tools/benchmarks/db_read_path.py \\
+        [--connection URL] [--images N] [--properties N] [--page N] \\
+        [--duration S]
+
+Memory is the growth of the peak RSS of a process forked to list a single
+page. By default a SQLite database in a temporary directory is used; pass
+--connection to measure against MySQL or PostgreSQL.
+"""
+
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import gettext
+gettext.install('glance', unicode=1)
+
+import sqlalchemy.orm as sa_orm
+
+from glance.common import config
+from glance import context
+from glance.db.sqlalchemy import api as db_api
+from glance.db.sqlalchemy import models
+from glance.openstack.common import cfg
+from glance.openstack.common import uuidutils
+from glance.registry.api.v1 import images
+
+CONF = cfg.CONF
+
+
+def orm_image_get_all(ctx, limit):
+    """Lists images as image_get_all did, loading Image models."""
+    session = db_api.get_session()
+    query = session.query(models.Image)\
+                   .options(sa_orm.joinedload(models.Image.properties))
+    query = db_api.paginate_query(query, models.Image, limit,
+                                  ['created_at', 'created_at', 'id'],
+                                  sort_dir='desc')
+    return query.all()
+
+
+def core_image_get_all(ctx, limit):
+    return db_api.image_get_all(ctx, limit=limit)
+
+
+PATHS = [
+    ('orm', orm_image_get_all),
+    ('core', core_image_get_all),
+]
+
+
+def list_page(ctx, path, limit):
+    return [images.make_image_dict(image) for image in path(ctx, limit)]
+
+
+def create_images(ctx, count, properties):
+    for i in range(count):
+        db_api.image_create(ctx, {
+            'id': uuidutils.generate_uuid(),
+            'name': 'image-%d' % i,
+            'status': 'active',
+            'is_public': True,
+            'disk_format': 'raw',
+            'container_format': 'bare',
+            'size': 1024,
+            'properties': dict(('key%d' % j, 'value%d' % j)
+                               for j in range(properties))})
+
+
+def run_forked(func, *args):
+    """Runs func in a child process and returns the integer it returns."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        db_api.configure_db()
+        result = func(*args)
+        os.write(write_fd, str(result or 0))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 64)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+def page_memory(ctx, path, limit):
+    """Returns the peak RSS growth, in KiB, from listing one page."""
+    # Warm up the connection and code paths on a single image
+    list_page(ctx, path, 1)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    page = list_page(ctx, path, limit)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert len(page) == limit
+    return after - before
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--connection', default=None,
+                      help='Defaults to a temporary SQLite database')
+    parser.add_option('--images', type='int', default=2000)
+    parser.add_option('--properties', type='int', default=5,
+                      help='Properties per image')
+    parser.add_option('--page', type='int', default=1000,
+                      help='Images per page')
+    parser.add_option('--duration', type='float', default=5.0)
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config.parse_args(args=[])
+        connection = (options.connection or
+                      'sqlite:///%s' % os.path.join(tmpdir, 'glance.sqlite'))
+        CONF.set_override('sql_connection', connection)
+        ctx = context.RequestContext(is_admin=True)
+
+        # Keep the heap of this process, which the memory measurements
+        # are forked from, clear of the images created
+        def setup():
+            models.register_models(db_api.get_engine())
+            create_images(ctx, options.images, options.properties)
+
+        run_forked(setup)
+        memory = dict((name, run_forked(page_memory, ctx, path,
+                                        options.page))
+                      for name, path in PATHS)
+
+        db_api.configure_db()
+        print '%-6s %12s %16s' % ('path', 'rows/s', 'KiB per page')
+        for name, path in PATHS:
+            deadline = time.time() + options.duration
+            start = time.time()
+            rows = 0
+            while time.time() < deadline:
+                rows += len(list_page(ctx, path, options.page))
+            elapsed = time.time() - start
+            print '%-6s %12.1f %16d' % (name, rows / elapsed, memory[name])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure list+get throughput of the SQLAlchemy DB API from concurrent green
+threads, as in one registry worker, while another green thread keeps
+running a deliberately slow query, with DB calls made inline and through
+the native thread pool (sql_use_tpool).
+
+    python tools/benchmarks/db_tpool.py \\
+        [--connection URL] [--images N] [--concurrency N] [--duration S]
+
+By default a SQLite database in a temporary directory is used; pass
+--connection to measure against MySQL or PostgreSQL.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import gettext
+gettext.install('glance', unicode=1)
+
+import eventlet
+
+from glance.common import config
+from glance import context
+from glance.db.sqlalchemy import api as db_api
+from glance.db.sqlalchemy import models
+from glance.openstack.common import cfg
+from glance.openstack.common import uuidutils
+
+CONF = cfg.CONF
+
+SETTINGS = [
+    ('inline', {'sql_use_tpool': False}),
+    ('tpool', {'sql_use_tpool': True}),
+]
+
+# Takes a few hundred milliseconds on SQLite, without touching any table
+SLOW_QUERY = ("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 "
+              "FROM c WHERE x < 2000000) SELECT count(*) FROM c")
+
+
+@db_api.dispatch
+def slow_query():
+    session = db_api.get_session()
+    return session.execute(SLOW_QUERY).scalar()
+
+
+def create_images(ctx, count):
+    image_ids = []
+    for i in range(count):
+        image = db_api.image_create(ctx, {
+            'id': uuidutils.generate_uuid(),
+            'name': 'image-%d' % i,
+            'status': 'active',
+            'is_public': True,
+            'disk_format': 'raw',
+            'container_format': 'bare',
+            'size': 1024,
+            'properties': {'kernel_id': 'abc', 'ramdisk_id': 'def'}})
+        image_ids.append(image['id'])
+    return image_ids
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--connection', default=None,
+                      help='Defaults to a temporary SQLite database')
+    parser.add_option('--images', type='int', default=200)
+    parser.add_option('--concurrency', type='int', default=10)
+    parser.add_option('--duration', type='float', default=5.0)
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config.parse_args(args=[])
+        connection = (options.connection or
+                      'sqlite:///%s' % os.path.join(tmpdir, 'glance.sqlite'))
+        CONF.set_override('sql_connection', connection)
+        db_api.configure_db()
+        models.register_models(db_api.get_engine())
+        ctx = context.RequestContext(is_admin=True)
+        image_ids = create_images(ctx, options.images)
+
+        print '%-10s %14s %14s' % ('settings', 'list+get/s', 'slow queries')
+        for name, overrides in SETTINGS:
+            for key, value in overrides.items():
+                CONF.set_override(key, value)
+            deadline = time.time() + options.duration
+            counts = {'calls': 0, 'slow': 0}
+
+            def client(index):
+                while time.time() < deadline:
+                    db_api.image_get_all(ctx, limit=20)
+                    db_api.image_get(ctx, image_ids[index % len(image_ids)])
+                    counts['calls'] += 1
+                    index += 1
+                    eventlet.sleep(0)
+
+            def slow():
+                while time.time() < deadline:
+                    slow_query()
+                    counts['slow'] += 1
+                    eventlet.sleep(0)
+
+            pool = eventlet.GreenPool()
+            pool.spawn_n(slow)
+            for i in range(options.concurrency):
+                pool.spawn_n(client, i)
+            pool.waitall()
+
+            print '%-10s %14.1f %14d' % (
+                name, counts['calls'] / options.duration, counts['slow'])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure glance.store.filesystem.Store.add throughput, and how much of the
+written image is left in the page cache, under different write settings.
+
+    python tools/benchmarks/filesystem_write.py \\
+        [--datadir DIR] [--size-mb N] [--iterations N]
+
+The data directory should be on the device being evaluated; by default a
+temporary directory is used.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import gettext
+gettext.install('glance', unicode=1)
+
+from glance.common import config
+from glance.common import utils
+from glance.openstack.common import cfg
+from glance.openstack.common import uuidutils
+import glance.store.filesystem
+
+CONF = cfg.CONF
+
+SETTINGS = [
+    ('64K writes, no sync', {'filesystem_store_write_chunk_size': 64}),
+    ('1M writes, no sync', {}),
+    ('1M + prealloc', {'filesystem_store_preallocate': True}),
+    ('sync at end', {'filesystem_store_preallocate': True,
+                     'filesystem_store_sync': 'end'}),
+    ('periodic sync', {'filesystem_store_preallocate': True,
+                       'filesystem_store_sync': 'periodic'}),
+]
+
+
+class RandomReader(object):
+    """Reads `size` bytes of incompressible, non-zero data."""
+
+    def __init__(self, size, block):
+        self.left = size
+        self.block = block
+
+    def read(self, length):
+        length = min(length, self.left)
+        self.left -= length
+        data = self.block * (length // len(self.block) + 1)
+        return data[:length]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--datadir', default=None,
+                      help='Defaults to a temporary directory')
+    parser.add_option('--size-mb', type='int', default=512)
+    parser.add_option('--iterations', type='int', default=3)
+    options, args = parser.parse_args()
+
+    tmpdir = options.datadir or tempfile.mkdtemp()
+    try:
+        config.parse_args(args=[])
+        CONF.set_override('filesystem_store_datadir', tmpdir)
+        size = options.size_mb * 1024 * 1024
+        block = os.urandom(1024 * 1024)
+
+        print '%-22s %12s %18s' % ('settings', 'MB/s', 'cached after add')
+        for name, overrides in SETTINGS:
+            CONF.clear_override('filesystem_store_write_chunk_size')
+            CONF.clear_override('filesystem_store_preallocate')
+            CONF.clear_override('filesystem_store_sync')
+            for key, value in overrides.items():
+                CONF.set_override(key, value)
+            store = glance.store.filesystem.Store()
+
+            elapsed = 0.0
+            cached = 0
+            for i in range(options.iterations):
+                image_id = uuidutils.generate_uuid()
+                start = time.time()
+                location, _size, _checksum = store.add(
+                    image_id, RandomReader(size, block), size)
+                elapsed += time.time() - start
+                path = location[len('file://'):]
+                cached += utils.get_page_cache_residency(path) or 0
+                os.unlink(path)
+
+            print '%-22s %12.1f %17.1f%%' % (
+                    name, options.size_mb * options.iterations / elapsed,
+                    100.0 * cached / (size * options.iterations))
+    finally:
+        if not options.datadir:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure glance.db.sqlalchemy.api.image_update latency, and the number of
+SQL statements it issues, as the number of image properties grows.
+
+    python tools/benchmarks/image_update_properties.py \\
+        [--sql-connection URL] [--iterations N]
+
+Each iteration changes half of the properties, adds a new one and, with
+purge_props, drops one.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import gettext
+gettext.install('glance', unicode=1)
+
+import sqlalchemy
+
+from glance.common import config
+import glance.context
+import glance.db.sqlalchemy.api as db_api
+from glance.db.sqlalchemy import models
+from glance.openstack.common import cfg
+
+CONF = cfg.CONF
+
+PROPERTY_COUNTS = [0, 5, 10, 20, 40, 80]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sql-connection', default=None,
+                      help='Defaults to a temporary sqlite file')
+    parser.add_option('--iterations', type='int', default=50)
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config.parse_args(args=[])
+        sql_connection = (options.sql_connection or
+                          'sqlite:///%s' % os.path.join(tmpdir, 'bench.db'))
+        CONF.set_override('sql_connection', sql_connection)
+        db_api.configure_db()
+        models.register_models(db_api.get_engine())
+
+        statements = [0]
+
+        def count(*args, **kwargs):
+            statements[0] += 1
+
+        sqlalchemy.event.listen(db_api.get_engine(), 'before_cursor_execute',
+                                count)
+
+        context = glance.context.RequestContext(is_admin=True)
+        print '%10s %15s %15s' % ('properties', 'ms/update', 'statements')
+        for count_props in PROPERTY_COUNTS:
+            properties = dict(('key%d' % i, 'value%d' % i)
+                              for i in range(count_props))
+            image = db_api.image_create(context, {'status': 'active',
+                                                  'properties': properties})
+
+            statements[0] = 0
+            start = time.time()
+            for i in range(options.iterations):
+                new_props = dict(properties)
+                for j, key in enumerate(sorted(properties)):
+                    if j % 2:
+                        new_props[key] = 'value%d-%d' % (j, i)
+                new_props['extra%d' % i] = 'new'
+                db_api.image_update(context, image['id'],
+                                    {'properties': new_props},
+                                    purge_props=True)
+            elapsed = time.time() - start
+
+            print '%10d %15.2f %15.1f' % (
+                    count_props, elapsed * 1000 / options.iterations,
+                    float(statements[0]) / options.iterations)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
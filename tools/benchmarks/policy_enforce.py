@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2012 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure how many policy checks per second glance.api.policy.Enforcer can
+make, compared with walking the parsed rule tree directly.
+
+    python tools/benchmarks/policy_enforce.py [--calls N]
+"""
+
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import gettext
+gettext.install('glance', unicode=1)
+
+import glance.api.policy
+from glance.common import config
+import glance.context
+from glance.openstack.common import cfg
+from glance.openstack.common import policy
+
+CONF = cfg.CONF
+
+RULES = {
+    'context_is_admin': 'role:admin',
+    'admin_or_owner': 'rule:context_is_admin or tenant:%(owner)s',
+    'default': 'rule:admin_or_owner',
+    'get_image': 'rule:admin_or_owner',
+    'get_images': '',
+    'modify_image': 'rule:admin_or_owner and not role:read_only',
+    'publicize_image': 'role:admin',
+}
+
+ACTIONS = ['get_image', 'get_images', 'modify_image', 'publicize_image']
+
+
+def run(calls, func):
+    start = time.time()
+    for i in xrange(calls):
+        func(i, ACTIONS[i % len(ACTIONS)])
+    return calls / (time.time() - start)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--calls', type='int', default=100000)
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        policy_file = os.path.join(tmpdir, 'policy.json')
+        with open(policy_file, 'w') as fap:
+            json.dump(RULES, fap)
+        config.parse_args(args=[])
+
+        target = {'owner': 'tenant1'}
+        creds = {'roles': ['member'], 'tenant': 'tenant1', 'user': 'user1'}
+        # One context per simulated request, with one check per action
+        contexts = [glance.context.RequestContext(**creds)
+                    for i in xrange(options.calls / len(ACTIONS) + 1)]
+
+        parsed = policy.Rules(dict((k, policy.parse_rule(v))
+                                   for k, v in RULES.items()), 'default')
+        policy.set_rules(parsed)
+        results = [('tree walk, no file polling',
+                    run(options.calls,
+                        lambda i, a: policy.check(a, target, creds)))]
+
+        scenarios = [
+            ('enforcer, stat every call', 0, 0),
+            ('enforcer, throttled stat', 5, 0),
+            ('enforcer, throttled stat, decision ttl', 5, 5),
+        ]
+        for name, interval, ttl in scenarios:
+            CONF.set_override('policy_file', policy_file)
+            CONF.set_override('policy_file_check_interval', interval)
+            CONF.set_override('policy_cache_ttl', ttl)
+            enforcer = glance.api.policy.Enforcer()
+
+            def check(i, action):
+                enforcer.check(contexts[i / len(ACTIONS)], action, target)
+
+            results.append((name, run(options.calls, check)))
+
+        for name, rate in results:
+            print '%-45s %12.0f checks/sec' % (name, rate)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
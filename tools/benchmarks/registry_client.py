@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure the latency of v1 API metadata calls (HEAD /images/<id> and
+GET /images/detail) with registry calls sent over HTTP to a registry
+server and made in-process (registry_client_mode).
+
+    python tools/benchmarks/registry_client.py \\
+        [--connection URL] [--images N] [--requests N]
+
+The registry server runs in a forked process and the v1 API is called
+in-process, so the figures exclude the API server's own HTTP handling.
+By default a SQLite database in a temporary directory is used.
+"""
+
+import optparse
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import gettext
+gettext.install('glance', unicode=1)
+
+import routes
+import webob
+
+from glance.api.middleware import context as context_middleware
+from glance.api.v1 import router
+from glance.common import config
+from glance.common import wsgi
+from glance import context
+from glance.db.sqlalchemy import api as db_api
+from glance.db.sqlalchemy import models
+from glance.openstack.common import cfg
+from glance.openstack.common import uuidutils
+from glance import registry
+from glance.registry.api import v1 as rserver
+import glance.store.filesystem
+
+CONF = cfg.CONF
+
+SETTINGS = [
+    ('http', {'registry_client_mode': 'http'}),
+    ('local', {'registry_client_mode': 'local'}),
+]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_registry(port):
+    pid = os.fork()
+    if pid:
+        return pid
+    CONF.set_override('bind_host', '127.0.0.1')
+    CONF.set_override('workers', 0)
+    app = context_middleware.UnauthenticatedContextMiddleware(
+        rserver.API(routes.Mapper()))
+    server = wsgi.Server()
+    server.start(app, port)
+    server.wait()
+    os._exit(0)
+
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+def create_images(count):
+    ctx = context.RequestContext(is_admin=True)
+    image_ids = []
+    for i in range(count):
+        image = db_api.image_create(ctx, {
+            'id': uuidutils.generate_uuid(),
+            'name': 'image-%d' % i,
+            'status': 'active',
+            'is_public': True,
+            'disk_format': 'raw',
+            'container_format': 'bare',
+            'size': 1024,
+            'properties': {'kernel_id': 'abc', 'ramdisk_id': 'def'}})
+        image_ids.append(image['id'])
+    return image_ids
+
+
+def measure(app, path, method, count):
+    start = time.time()
+    for i in range(count):
+        res = webob.Request.blank(path, method=method).get_response(app)
+        assert res.status_int == 200, res.status
+    return (time.time() - start) * 1000.0 / count
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--connection', default=None,
+                      help='Defaults to a temporary SQLite database')
+    parser.add_option('--images', type='int', default=100)
+    parser.add_option('--requests', type='int', default=500)
+    options, args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    pid = None
+    try:
+        config.parse_args(args=[])
+        connection = (options.connection or
+                      'sqlite:///%s' % os.path.join(tmpdir, 'glance.sqlite'))
+        CONF.set_override('sql_connection', connection)
+        CONF.set_override('filesystem_store_datadir', tmpdir)
+
+        port = free_port()
+        CONF.set_override('registry_host', '127.0.0.1')
+        CONF.set_override('registry_port', port)
+        pid = start_registry(port)
+
+        db_api.configure_db()
+        models.register_models(db_api.get_engine())
+        image_ids = create_images(options.images)
+        wait_for_server(port)
+
+        app = context_middleware.UnauthenticatedContextMiddleware(
+            router.API(routes.Mapper()))
+
+        print '%-8s %16s %22s' % ('mode', 'HEAD image (ms)',
+                                  'GET detail x20 (ms)')
+        for name, overrides in SETTINGS:
+            for key, value in overrides.items():
+                CONF.set_override(key, value)
+            registry.configure_registry_client()
+
+            head = measure(app, '/images/%s' % image_ids[0], 'HEAD',
+                           options.requests)
+            detail = measure(app, '/images/detail?limit=20', 'GET',
+                             options.requests)
+            print '%-8s %16.2f %22.2f' % (name, head, detail)
+    finally:
+        if pid:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
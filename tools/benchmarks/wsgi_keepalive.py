@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measure requests/sec for small metadata calls (GET / on the versions
+controller) served by glance.common.wsgi.Server, with and without HTTP
+keep-alive.
+
+    python tools/benchmarks/wsgi_keepalive.py \\
+        [--requests N] [--concurrency N]
+
+The server runs in a forked process; each client thread keeps a single
+httplib connection, which is reopened whenever the server closes it.
+"""
+
+import httplib
+import optparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                                os.pardir, os.pardir,
+                                                os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+import gettext
+gettext.install('glance', unicode=1)
+
+from glance.api import versions
+from glance.common import config
+from glance.common import wsgi
+from glance.openstack.common import cfg
+
+CONF = cfg.CONF
+
+SETTINGS = [
+    ('keep-alive off', {'http_keepalive': False}),
+    ('keep-alive on', {'http_keepalive': True}),
+]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(port, overrides):
+    pid = os.fork()
+    if pid:
+        return pid
+    for key, value in overrides.items():
+        CONF.set_override(key, value)
+    CONF.set_override('bind_host', '127.0.0.1')
+    CONF.set_override('workers', 0)
+    server = wsgi.Server()
+    server.start(versions.Controller(), port)
+    server.wait()
+    os._exit(0)
+
+
+def wait_for_server(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+def run_client(port, requests, counts):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    connections = 1
+    for i in range(requests):
+        if conn.sock is None and i:
+            connections += 1
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        resp.read()
+        if resp.will_close:
+            conn.close()
+    conn.close()
+    counts.append(connections)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--requests', type='int', default=2000,
+                      help='Requests sent by each client thread')
+    parser.add_option('--concurrency', type='int', default=4)
+    options, args = parser.parse_args()
+
+    config.parse_args(args=[])
+
+    print '%-16s %12s %14s' % ('settings', 'requests/s', 'connections')
+    for name, overrides in SETTINGS:
+        port = free_port()
+        pid = start_server(port, overrides)
+        try:
+            wait_for_server(port)
+            counts = []
+            threads = [threading.Thread(target=run_client,
+                                        args=(port, options.requests,
+                                              counts))
+                       for i in range(options.concurrency)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - start
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+        total = options.requests * options.concurrency
+        print '%-16s %12.1f %14d' % (name, total / elapsed, sum(counts))
+
+
+if __name__ == '__main__':
+    main()